@@ -0,0 +1,125 @@
+#!/usr/bin/python
+"""
+Sends align and pair masking jobs to a running MaskPrimers.py serve process
+"""
+
+# Imports
+import json
+import os
+import socket
+import sys
+from argparse import ArgumentParser, SUPPRESS
+
+
+def sendJob(socket_path, job, timeout=None):
+    """
+    Sends one job to a MaskPrimers.py serve socket
+
+    Arguments:
+      socket_path : Unix socket of the serve process.
+      job : dictionary of job fields, as accepted by MaskPrimers.runMaskJob.
+      timeout : optional socket timeout in seconds.
+
+    Returns:
+      dict: the decoded response.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(job) + '\n').encode())
+        with sock.makefile('rb') as handle:
+            line = handle.readline()
+
+    return json.loads(line.decode())
+
+
+def runLocal(job):
+    """
+    Runs a job in this process, as MaskPrimers.py would without the server
+
+    MaskPrimers is only imported here, so the client does not load presto while
+    the server is up.
+
+    Arguments:
+      job : dictionary of job fields, as accepted by MaskPrimers.runMaskJob.
+
+    Returns:
+      dict: the response of MaskPrimers.runMaskJob.
+    """
+    from MaskPrimers import runMaskJob
+
+    return runMaskJob(job)
+
+
+def getArgParser():
+    """
+    Defines the ArgumentParser
+
+    Returns:
+      argparse.ArgumentParser: argument parser object.
+    """
+    parser = ArgumentParser(description=__doc__,
+                            epilog='Options not given use the MaskPrimers.py defaults.')
+    parser.add_argument('command', choices=('align', 'pair', 'stop'),
+                        help='MaskPrimers.py subcommand to run, or stop to shut the server down.')
+    parser.add_argument('-S', action='store', dest='socket_path',
+                        default=os.environ.get('NANOIG_MASK_SOCKET'),
+                        help='Server socket; defaults to $NANOIG_MASK_SOCKET.')
+    parser.add_argument('-s', action='store', dest='seq_file', default=SUPPRESS,
+                        help='Input sequence file.')
+    parser.add_argument('-p', action='store', dest='primer_file', default=SUPPRESS,
+                        help='A FASTA file containing (forward) primer sequences.')
+    parser.add_argument('-r', action='store', dest='rev_primer_file', default=SUPPRESS,
+                        help='A FASTA file containing reverse primer sequences, for pair.')
+    parser.add_argument('-o', action='store', dest='out_file', default=SUPPRESS,
+                        help='Output file written by the server; standard output if not given.')
+    parser.add_argument('--append', action='store_true', dest='append', default=SUPPRESS,
+                        help='Append to the output file instead of replacing it.')
+    parser.add_argument('--maxerror', action='store', dest='max_error', type=float, default=SUPPRESS)
+    parser.add_argument('--revmaxerror', action='store', dest='rev_max_error', type=float, default=SUPPRESS)
+    parser.add_argument('--maxlen', action='store', dest='max_len', type=int, default=SUPPRESS)
+    parser.add_argument('--gap', nargs=2, action='store', dest='gap_penalty', type=float, default=SUPPRESS)
+    parser.add_argument('--revpr', action='store_true', dest='rev_primer', default=SUPPRESS)
+    parser.add_argument('--skiprc', action='store_true', dest='skip_rc', default=SUPPRESS)
+    parser.add_argument('--mode', action='store', dest='mode', choices=('cut', 'mask', 'trim', 'tag'),
+                        default=SUPPRESS)
+    parser.add_argument('--barcode', action='store_true', dest='barcode', default=SUPPRESS)
+    parser.add_argument('--bf', action='store', dest='barcode_field', default=SUPPRESS)
+    parser.add_argument('--pf', action='store', dest='primer_field', default=SUPPRESS)
+    parser.add_argument('--rpf', action='store', dest='rev_primer_field', default=SUPPRESS)
+    parser.add_argument('--stdout', action='store_true', dest='stdout', default=SUPPRESS,
+                        help='Return N stripped single line FASTA, as MaskPrimers.py pair --stdout.')
+    parser.add_argument('--prefix', action='store', dest='prefix', default=SUPPRESS,
+                        help='Prefix added to the --stdout headers as "prefix:".')
+
+    return parser
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and sends the job
+    """
+    args = getArgParser().parse_args()
+    if args.socket_path is None:
+        sys.exit('No server socket given with -S or $NANOIG_MASK_SOCKET')
+
+    job = {k: v for k, v in vars(args).items() if k != 'socket_path'}
+    for key in ('seq_file', 'primer_file', 'rev_primer_file', 'out_file'):
+        if key in job:
+            job[key] = os.path.abspath(job[key])
+
+    # A stale socket, left by a server that died, falls back to a local run
+    try:
+        response = sendJob(args.socket_path, job)
+    except (ConnectionRefusedError, FileNotFoundError) as e:
+        if args.command == 'stop':
+            sys.exit(0)
+        sys.stderr.write('No server on %s (%s), running MaskPrimers.py %s locally\n' %
+                         (args.socket_path, e.strerror, args.command))
+        response = runLocal(job)
+    if response['status'] != 0:
+        sys.stderr.write('%s\n' % response.get('error'))
+        sys.exit(response['status'])
+    sys.stdout.write(response.get('output', ''))
+    if 'pass' in response:
+        sys.stderr.write('PASS> %i\nFAIL> %i\n' % (response['pass'], response['fail']))
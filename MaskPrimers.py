@@ -7,21 +7,36 @@ __author__ = 'Jason Anthony Vander Heiden'
 from presto import __version__, __date__
 
 # Imports
+import json
 import os
+import sys
+import threading
+import multiprocessing as mp
+import numpy as np
 from argparse import ArgumentParser
 from collections import OrderedDict
+from functools import partial
+from io import StringIO
+from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
 from textwrap import dedent
+from Bio import Align, SeqIO
 
 # Presto imports
 from presto.Defaults import default_delimiter, default_out_args, default_primer_gap_penalty, default_primer_max_error, \
                             default_primer_max_len, default_primer_start, default_barcode_field, default_primer_field
 from presto.Commandline import CommonHelpFormatter, checkArgs, getCommonArgParser, parseCommonArgs
 from presto.Sequence import localAlignment, compilePrimers, extractAlignment, getDNAScoreDict, \
-                            maskSeq, reverseComplement, scoreAlignment
-from presto.IO import readPrimerFile, printLog
-from presto.Multiprocessing import SeqResult, manageProcesses, feedSeqQueue, \
+                            maskSeq, reverseComplement, scoreAlignment, PrimerAlignment
+from presto.IO import getFileType, readPrimerFile, readSeqFile, printLog, printError
+from presto.Multiprocessing import SeqData, SeqResult, manageProcesses, feedSeqQueue, \
                                    processSeqQueue, collectSeqQueue
 
+# NanoIg imports
+from NanoIgProf import profileProcess
+
+# Default number of sequences aligned together by the batch aligner
+default_block_size = 500
+
 
 def extractPrimers(data, start, length, rev_primer=False, mode='mask', barcode=False,
                    barcode_field=default_barcode_field, primer_field=default_primer_field,
@@ -104,13 +119,36 @@ def alignPrimers(data, primers, primers_regex=None, max_error=default_primer_max
     Returns:
       presto.Multiprocessing.SeqResult: result object.
     """
-    # Define result object
-    result = SeqResult(data.id, data.data)
-
     # Align primers
     align = localAlignment(data.data, primers, primers_regex=primers_regex, max_error=max_error,
                            max_len=max_len, rev_primer=rev_primer, skip_rc=skip_rc,
                            gap_penalty=gap_penalty, score_dict=score_dict)
+
+    return alignResult(data, align, max_error=max_error, mode=mode, barcode=barcode,
+                       barcode_field=barcode_field, primer_field=primer_field, delimiter=delimiter)
+
+
+def alignResult(data, align, max_error=default_primer_max_error, mode='mask', barcode=False,
+                barcode_field=default_barcode_field, primer_field=default_primer_field,
+                delimiter=default_delimiter):
+    """
+    Builds the masked sequence and log of a primer alignment
+
+    Arguments:
+      data : SeqData object containing a single SeqRecord object to process.
+      align : presto.Sequence.PrimerAlignment object of the sequence.
+      max_error : maximum acceptable error rate for a valid alignment.
+      mode : defines the action taken; one of 'cut', 'mask', 'tag' or 'trim'.
+      barcode : if True add sequence preceding primer to description.
+      barcode_field : name of the output barcode annotation.
+      primer_field : name of the output primer annotation.
+      delimiter : a tuple of delimiters for (annotations, field/values, value lists).
+
+    Returns:
+      presto.Multiprocessing.SeqResult: result object.
+    """
+    # Define result object
+    result = SeqResult(data.id, data.data)
     if not align:
         # Update log if no alignment
         result.log['ALIGN'] = None
@@ -145,6 +183,341 @@ def alignPrimers(data, primers, primers_regex=None, max_error=default_primer_max
     return result
 
 
+def pairPrimers(data, primers, rev_primers, primers_regex=None, rev_primers_regex=None,
+                max_error=default_primer_max_error, rev_max_error=default_primer_max_error,
+                max_len=default_primer_max_len, skip_rc=False, mode='mask', barcode=False,
+                barcode_field=default_barcode_field, primer_field=default_primer_field,
+                rev_primer_field=default_primer_field, gap_penalty=default_primer_gap_penalty,
+                score_dict=getDNAScoreDict(mask_score=(0, 1), gap_score=(0, 0)),
+                delimiter=default_delimiter):
+    """
+    Aligns forward primers against the head and reverse primers against the tail of a sequence
+
+    The reverse primers are aligned against the forward pass output, without
+    checking the reverse complement, exactly as a second align run with --revpr
+    --skiprc over the align pass file.
+
+    Arguments:
+      data : SeqData object containing a single SeqRecord object to process.
+      primers : dictionary of {names: forward primer sequences}.
+      rev_primers : dictionary of {names: reverse complemented reverse primer sequences}.
+      primers_regex : optional dictionary of {names: compiled forward primer regular expressions}.
+      rev_primers_regex : optional dictionary of {names: compiled reverse primer regular expressions}.
+      max_error : maximum acceptable error rate of the forward primer alignment.
+      rev_max_error : maximum acceptable error rate of the reverse primer alignment.
+      max_len : maximum length of the sequence head and tail to align.
+      skip_rc : if True do not check reverse complement sequences in the forward pass.
+      mode : defines the action taken; one of 'cut', 'mask', 'tag' or 'trim'.
+      barcode : if True add sequence preceding the forward primer to description.
+      barcode_field : name of the output barcode annotation.
+      primer_field : name of the output forward primer annotation.
+      rev_primer_field : name of the output reverse primer annotation.
+      gap_penalty : a tuple of positive (gap open, gap extend) penalties.
+      score_dict : optional dictionary of {(char1, char2): score} alignment scores
+      delimiter : a tuple of delimiters for (annotations, field/values, value lists).
+
+    Returns:
+      presto.Multiprocessing.SeqResult: result object.
+    """
+    fwd = alignPrimers(data, primers, primers_regex=primers_regex, max_error=max_error, max_len=max_len,
+                       skip_rc=skip_rc, mode=mode, barcode=barcode, barcode_field=barcode_field,
+                       primer_field=primer_field, gap_penalty=gap_penalty, score_dict=score_dict,
+                       delimiter=delimiter)
+    if not fwd:
+        return fwd
+
+    # Carry the forward annotations in the description, as when read back from a pass file
+    fwd_seq = fwd.results
+    fwd_seq.description = fwd_seq.id
+    rev = alignPrimers(SeqData(data.id, fwd_seq), rev_primers, primers_regex=rev_primers_regex,
+                       max_error=rev_max_error, max_len=max_len, rev_primer=True, skip_rc=True,
+                       mode=mode, primer_field=rev_primer_field, gap_penalty=gap_penalty,
+                       score_dict=score_dict, delimiter=delimiter)
+
+    # Define result object
+    result = SeqResult(data.id, data.data)
+    result.results = rev.results
+    result.valid = rev.valid
+    result.log.update((k, v) for k, v in fwd.log.items() if k != 'ID')
+    result.log.update(('REV_%s' % k, v) for k, v in rev.log.items() if k != 'ID')
+
+    return result
+
+
+def batchLocalAlignment(records, primers, primers_regex=None, max_error=default_primer_max_error,
+                        max_len=default_primer_max_len, rev_primer=False, skip_rc=False,
+                        gap_penalty=default_primer_gap_penalty,
+                        score_dict=getDNAScoreDict(mask_score=(0, 1), gap_score=(0, 0))):
+    """
+    Performs pairwise local alignment of a block of sequences against all primers at once
+
+    Follows presto.Sequence.localAlignment: an exact regular expression match is
+    tried first, then every remaining sequence window is aligned against every
+    primer with affine gap Smith-Waterman, scored with score_dict. The window and
+    primer sets are encoded as NumPy arrays and the dynamic programming matrices
+    of all (sequence, orientation, primer) combinations are filled together. Only
+    the selected alignment of each sequence is traced back, with the Biopython
+    aligner presto uses, so results are identical to localAlignment.
+
+    Arguments:
+      records : list of SeqRecord objects to align primers against.
+      primers : dictionary of {names: short IUPAC ambiguous sequence strings}.
+      primers_regex : optional dictionary of {names: compiled primer regular expressions}.
+      max_error : maximum acceptable error rate before aligning the reverse complement.
+      max_len : maximum length of sample sequence to align.
+      rev_primer : if True align with the tail end of the sequence.
+      skip_rc : if True do not check reverse complement sequences.
+      gap_penalty : a tuple of positive (gap open, gap extend) penalties.
+      score_dict : dictionary of alignment scores as {(char1, char2): score}.
+
+    Returns:
+      list: presto.Sequence.PrimerAlignment objects in input order.
+    """
+    if primers_regex is None:  primers_regex = compilePrimers(primers)
+    names = list(primers)
+    aligns = [None] * len(records)
+    pending = []
+
+    # Attempt regular expression match first
+    for k, seq_record in enumerate(records):
+        seq_record = seq_record.upper()
+        rec_len = len(seq_record)
+        window = min(rec_len, max_len)
+        align = PrimerAlignment(seq_record)
+        align.rev_primer = rev_primer
+        seq_list = [seq_record] if skip_rc else [seq_record, reverseComplement(seq_record)]
+        seq_list[0].annotations['seqorient'] = 'F'
+        if not skip_rc:  seq_list[1].annotations['seqorient'] = 'RC'
+        aligns[k] = align
+        scans = []
+        for rec in seq_list:
+            scan_seq = str(rec.seq)
+            scan_seq = scan_seq[:window] if not rev_primer else scan_seq[-window:]
+            scans.append(scan_seq)
+            if align.valid:  continue
+            for adpt_id, adpt_regex in primers_regex.items():
+                adpt_match = adpt_regex.search(scan_seq)
+                if adpt_match:
+                    rev_pos = rec_len - window if rev_primer else 0
+                    align.seq = rec
+                    align.primer = adpt_id
+                    align.align_seq = scan_seq
+                    align.align_primer = '-' * adpt_match.start(0) + primers[adpt_id] + \
+                                         '-' * (window - adpt_match.end(0))
+                    align.gaps = 0
+                    align.error = 0
+                    align.valid = True
+                    align.start = adpt_match.start(0) + rev_pos
+                    align.end = adpt_match.end(0) + rev_pos
+                    break
+        if not align.valid:
+            pending.append((k, seq_list, scans, rec_len - window if rev_primer else 0))
+    if not pending:
+        return aligns
+
+    # Encode windows and primers; one lane per (sequence, orientation, primer)
+    alphabet = '-.ACGTURYSWKMBDHVN'
+    lookup = np.full(256, alphabet.index('N'), dtype=np.int8)
+    for c in alphabet:  lookup[ord(c)] = alphabet.index(c)
+    table = np.array([[score_dict[(a, b)] for b in alphabet] for a in alphabet], dtype=np.float64)
+    encode = lambda x: lookup[np.frombuffer(x.encode('ascii'), dtype=np.uint8)]
+    n_orient, n_primer = len(pending[0][1]), len(names)
+    lanes = len(pending) * n_orient * n_primer
+    W = max(len(scan) for _, _, scans, _ in pending for scan in scans)
+    P = max(len(primers[x]) for x in names)
+    target = np.zeros((lanes, W), dtype=np.int8)
+    target_len = np.zeros(lanes, dtype=np.int64)
+    query = np.zeros((lanes, P), dtype=np.int8)
+    query_len = np.zeros(lanes, dtype=np.int64)
+    for p, x in enumerate(names):
+        query[p::n_primer, :len(primers[x])] = encode(primers[x])
+        query_len[p::n_primer] = len(primers[x])
+    lane = 0
+    for _, _, scans, _ in pending:
+        for scan in scans:
+            target[lane:lane + n_primer, :len(scan)] = encode(scan)
+            target_len[lane:lane + n_primer] = len(scan)
+            lane += n_primer
+
+    # Affine gap Smith-Waterman scores of all lanes, keeping one window row at a time
+    open_score, extend_score = -gap_penalty[0], -gap_penalty[1]
+    H = np.zeros((P + 1, lanes))
+    Ix = np.full((P + 1, lanes), -np.inf)
+    best_score = np.zeros(lanes)
+    col_valid = np.arange(1, P + 1)[:, None] <= query_len[None, :]
+    for i in range(1, W + 1):
+        sub = table[target[:, i - 1][:, None], query].T
+        H_row = np.zeros((P + 1, lanes))
+        Ix = np.maximum(H + open_score, Ix + extend_score)
+        Iy = np.full(lanes, -np.inf)
+        for j in range(1, P + 1):
+            Iy = np.maximum(H_row[j - 1] + open_score, Iy + extend_score)
+            H_row[j] = np.maximum(np.maximum(H[j - 1] + sub[j - 1], 0), np.maximum(Ix[j], Iy))
+        H = H_row
+        row = np.where(col_valid, H[1:], 0).max(axis=0)
+        best_score = np.where(i <= target_len, np.maximum(best_score, row), best_score)
+    error = 1.0 - best_score / query_len
+
+    # Lowest error primer, checking the reverse complement only if the forward fails
+    sub_matrix = Align.substitution_matrices.Array(data=score_dict)
+    pw_aligner = Align.PairwiseAligner(mode='local', substitution_matrix=sub_matrix,
+                                       open_gap_score=open_score, extend_gap_score=extend_score)
+    for q, (k, seq_list, scans, rev_pos) in enumerate(pending):
+        best_lane, best_error = None, None
+        for o in range(n_orient):
+            for p in range(n_primer):
+                l = (q * n_orient + o) * n_primer + p
+                if best_score[l] > 0 and (best_error is None or error[l] < best_error):
+                    best_lane, best_error = l, error[l]
+            if best_error is not None and best_error <= max_error:  break
+        if best_lane is None:  continue
+
+        # Trace back the selected alignment only
+        o, adpt_id = (best_lane // n_primer) % n_orient, names[best_lane % n_primer]
+        align_top = pw_aligner.align(scans[o], primers[adpt_id])[0]
+        align_coord = align_top.coordinates
+        align_str = align_top.format('fasta').replace('\n', '').split('>')[1:]
+
+        align = aligns[k]
+        align.seq = seq_list[o]
+        align.primer = adpt_id
+        align.align_seq = align_top.target[:align_coord[0][0]] + align_str[0] + \
+                          align_top.target[align_coord[0][-1]:]
+        align.align_primer = '-' * align_coord[0][0] + align_str[1] + \
+                             '-' * len(align_top.target[align_coord[0][-1]:])
+        align.gaps = align_top.counts().gaps
+        align.error = float(best_error)
+        align.valid = True
+        align.start = align_coord[0][0] + rev_pos
+        align.end = align_coord[0][-1] + rev_pos
+
+    return aligns
+
+
+def alignPrimerBlock(block, primers, primers_regex=None, max_error=default_primer_max_error,
+                     max_len=default_primer_max_len, rev_primer=False, skip_rc=False, mode='mask',
+                     barcode=False, barcode_field=default_barcode_field, primer_field=default_primer_field,
+                     gap_penalty=default_primer_gap_penalty, score_dict=getDNAScoreDict(mask_score=(0, 1), gap_score=(0, 0)),
+                     delimiter=default_delimiter):
+    """
+    Performs batched local alignment of primers against a block of sequences
+
+    Arguments:
+      block : list of SeqData objects each containing a single SeqRecord object to process.
+      other arguments : as in alignPrimers.
+
+    Returns:
+      list: presto.Multiprocessing.SeqResult objects in block order.
+    """
+    aligns = batchLocalAlignment([data.data for data in block], primers, primers_regex=primers_regex,
+                                 max_error=max_error, max_len=max_len, rev_primer=rev_primer,
+                                 skip_rc=skip_rc, gap_penalty=gap_penalty, score_dict=score_dict)
+
+    return [alignResult(data, align, max_error=max_error, mode=mode, barcode=barcode,
+                        barcode_field=barcode_field, primer_field=primer_field, delimiter=delimiter)
+            for data, align in zip(block, aligns)]
+
+
+def processSeqBlockQueue(alive, data_queue, result_queue, process_func, process_args={},
+                         block_size=default_block_size):
+    """
+    Pulls blocks of sequences from the data queue, processes them together and feeds the results queue
+
+    Arguments:
+      alive : multiprocessing.Value boolean controlling whether processing continues.
+      data_queue : multiprocessing.Queue holding data to process.
+      result_queue : multiprocessing.Queue to hold processed results.
+      process_func : function processing a list of SeqData objects into a list of results.
+      process_args : dictionary of arguments to pass to process_func.
+      block_size : maximum number of sequences processed together.
+
+    Returns:
+      None
+    """
+    block = []
+    try:
+        # Iterator over data queue until sentinel object reached
+        while alive.value:
+            # Get data from queue
+            if data_queue.empty():  continue
+            else:  data = data_queue.get()
+            if data is not None:  block.append(data)
+
+            # Align once the block is full or the sentinel is reached
+            if block and (data is None or len(block) >= block_size):
+                for result in process_func(block, **process_args):
+                    result_queue.put(result)
+                block = []
+
+            # Exit upon reaching sentinel
+            if data is None:  break
+        else:
+            sys.stderr.write('PID %s> Error in sibling process detected. Cleaning up.\n' \
+                             % os.getpid())
+            return None
+    except:
+        alive.value = False
+        printError('Error processing sequence block starting with ID: %s.' % (block[0].id if block else None),
+                   exit=False)
+        raise
+
+    return None
+
+
+def collectFastaQueue(alive, result_queue, collect_queue, prefix=None):
+    """
+    Pulls from results queue and streams passing sequences to standard output as FASTA
+
+    Sequences are written on a single line with N characters removed; headers
+    are prefixed with "prefix:" if a prefix is given. No progress bar is printed.
+
+    Arguments:
+      alive : a multiprocessing.Value boolean controlling whether processing continues.
+      result_queue : Multiprocessing.Queue holding worker results.
+      collect_queue : Multiprocessing.Queue to store collector return values.
+      prefix : optional header prefix.
+
+    Returns:
+      None: Adds a dictionary with key value pairs to collect_queue containing
+           'log' defining a log object,
+           'out_files' defining the output file names
+    """
+    try:
+        seq_count = pass_count = fail_count = 0
+        while alive.value:
+            # Get result from queue
+            if result_queue.empty():  continue
+            else:  result = result_queue.get()
+            # Exit upon reaching sentinel
+            if result is None:  break
+
+            # Write passing records
+            seq_count += result.data_count
+            if result:
+                pass_count += 1
+                sys.stdout.write(strippedFasta(result.results, prefix))
+            else:
+                fail_count += 1
+        else:
+            sys.stderr.write('PID %s> Error in sibling process detected. Cleaning up.\n' \
+                             % os.getpid())
+            return None
+        sys.stdout.flush()
+
+        # Update return values
+        log = OrderedDict()
+        log['OUTPUT'] = 'stdout'
+        log['SEQUENCES'] = seq_count
+        log['PASS'] = pass_count
+        log['FAIL'] = fail_count
+        collect_queue.put({'log': log, 'out_files': []})
+    except:
+        alive.value = False
+        raise
+
+    return None
+
+
 def scorePrimers(data, primers, max_error=default_primer_max_error, start=default_primer_start, rev_primer=False, mode='mask',
                  barcode=False, barcode_field=default_barcode_field, primer_field=default_primer_field,
                  score_dict=getDNAScoreDict(mask_score=(0, 1), gap_score=(0, 0)),
@@ -209,7 +582,8 @@ def scorePrimers(data, primers, max_error=default_primer_max_error, start=defaul
 
 def maskPrimers(seq_file, primer_file, align_func, align_args={},
                 out_file=None, out_args=default_out_args,
-                nproc=None, queue_size=None):
+                nproc=None, queue_size=None, block_size=None, rev_primer_file=None,
+                stdout=False, prefix=None):
     """
     Masks or cuts primers from sample sequences using local alignment
 
@@ -223,13 +597,20 @@ def maskPrimers(seq_file, primer_file, align_func, align_args={},
       nproc : the number of processQueue processes;
               if None defaults to the number of CPUs.
       queue_size : maximum size of the argument queue;
-                   if None defaults to 2*nproc.
+                   if None defaults to 2*nproc, or block_size*nproc with block_size.
+      block_size : number of sequences aligned together by the batch aligner;
+                   if None each sequence is aligned separately. Only used by alignPrimers.
+      rev_primer_file : name of the file containing reverse primer sequences. Only used by pairPrimers.
+      stdout : if True write passing sequences to standard output as N stripped FASTA
+               and print the log to standard error instead of writing output files.
+      prefix : optional header prefix of the standard output sequences.
                  
     Returns:
       list: a list of successful output file names.
     """
     # Define subcommand label dictionary
-    cmd_dict = {alignPrimers: 'align', scorePrimers: 'score', extractPrimers: 'extract'}
+    cmd_dict = {alignPrimers: 'align', pairPrimers: 'pair', scorePrimers: 'score', extractPrimers: 'extract'}
+    log_handle = sys.stderr if stdout else sys.stdout
     
     # Print parameter info
     log = OrderedDict()
@@ -238,8 +619,11 @@ def maskPrimers(seq_file, primer_file, align_func, align_args={},
     log['SEQ_FILE'] = os.path.basename(seq_file)
     if primer_file is not None:
         log['PRIMER_FILE'] = os.path.basename(primer_file)
+    if rev_primer_file is not None:
+        log['REV_PRIMER_FILE'] = os.path.basename(rev_primer_file)
     if 'mode' in align_args: log['MODE'] = align_args['mode']
     if 'max_error' in align_args: log['MAX_ERROR'] = align_args['max_error']
+    if 'rev_max_error' in align_args: log['REV_MAX_ERROR'] = align_args['rev_max_error']
     if 'start' in align_args: log['START_POS'] = align_args['start']
     if 'length' in align_args: log['LENGTH'] = align_args['length']
     if 'max_len' in align_args: log['MAX_LEN'] = align_args['max_len']
@@ -252,8 +636,11 @@ def maskPrimers(seq_file, primer_file, align_func, align_args={},
     if 'barcode' in align_args and align_args['barcode']:
         log['BARCODE_FIELD'] = align_args['barcode_field']
     log['PRIMER_FIELD'] = align_args['primer_field']
+    if 'rev_primer_field' in align_args: log['REV_PRIMER_FIELD'] = align_args['rev_primer_field']
+    if align_func is alignPrimers and block_size:
+        log['BLOCK'] = block_size
     log['NPROC'] = nproc
-    printLog(log)
+    printLog(log, handle=log_handle)
 
     # Define alignment arguments and compile primers for align mode
     if primer_file is not None:
@@ -262,7 +649,11 @@ def maskPrimers(seq_file, primer_file, align_func, align_args={},
             primers = {k: reverseComplement(v) for k, v in primers.items()}
         align_args['primers'] = primers
         align_args['score_dict'] = getDNAScoreDict(mask_score=(0, 1), gap_score=(0, 0))
-    if align_func is alignPrimers:
+    if rev_primer_file is not None:
+        rev_primers = {k: reverseComplement(v) for k, v in readPrimerFile(rev_primer_file).items()}
+        align_args['rev_primers'] = rev_primers
+        align_args['rev_primers_regex'] = compilePrimers(rev_primers)
+    if align_func is alignPrimers or align_func is pairPrimers:
         align_args['primers_regex'] = compilePrimers(primers)
     align_args['delimiter'] = out_args['delimiter']
 
@@ -273,12 +664,23 @@ def maskPrimers(seq_file, primer_file, align_func, align_args={},
     work_func = processSeqQueue
     work_args = {'process_func': align_func,
                  'process_args': align_args}
+    if align_func is alignPrimers and block_size:
+        work_func = processSeqBlockQueue
+        work_args = {'process_func': alignPrimerBlock,
+                     'process_args': align_args,
+                     'block_size': block_size}
+        # Let the feeder queue whole blocks ahead of the workers
+        if queue_size is None:
+            queue_size = block_size * (nproc or os.cpu_count() or 1)
     # Define collector function and arguments
     collect_func = collectSeqQueue
     collect_args = {'seq_file': seq_file,
                     'label': 'primers',
                     'out_file': out_file,
                     'out_args': out_args}
+    if stdout:
+        collect_func = collectFastaQueue
+        collect_args = {'prefix': prefix}
     
     # Call process manager
     result = manageProcesses(feed_func, work_func, collect_func, 
@@ -287,11 +689,182 @@ def maskPrimers(seq_file, primer_file, align_func, align_args={},
 
     # Print log
     result['log']['END'] = 'MaskPrimers'
-    printLog(result['log'])
+    printLog(result['log'], handle=log_handle)
         
     return result['out_files']
 
 
+def strippedFasta(record, prefix=None):
+    """
+    Formats a sequence as a single line FASTA entry with N characters removed
+
+    Arguments:
+      record : SeqRecord object.
+      prefix : optional header prefix, added as "prefix:".
+
+    Returns:
+      str: FASTA entry.
+    """
+    header = record.id if prefix is None else '%s:%s' % (prefix, record.id)
+
+    return '>%s\n%s\n' % (header, str(record.seq).replace('N', ''))
+
+
+def loadPrimers(primer_file, rev_primer=False, cache=None):
+    """
+    Reads and compiles a primer file, reusing a previous result while the file is unchanged
+
+    Arguments:
+      primer_file : name of the file containing primer sequences.
+      rev_primer : if True reverse complement the primers.
+      cache : optional dictionary of loaded primer sets, updated in place.
+
+    Returns:
+      tuple: (dictionary of {names: primer sequences}, dictionary of {names: compiled regular expressions}).
+    """
+    key = (os.path.abspath(primer_file), os.path.getmtime(primer_file), rev_primer)
+    if cache is not None and key in cache:
+        return cache[key]
+    primers = readPrimerFile(primer_file)
+    if rev_primer:
+        primers = {k: reverseComplement(v) for k, v in primers.items()}
+    loaded = (primers, compilePrimers(primers))
+    if cache is not None:
+        cache[key] = loaded
+
+    return loaded
+
+
+# Job options passed through to the alignment functions of the serve mode
+serve_job_args = {'align': ('max_error', 'max_len', 'rev_primer', 'skip_rc', 'mode', 'barcode',
+                            'barcode_field', 'primer_field', 'gap_penalty'),
+                  'pair': ('max_error', 'rev_max_error', 'max_len', 'skip_rc', 'mode', 'barcode',
+                           'barcode_field', 'primer_field', 'rev_primer_field', 'gap_penalty')}
+
+# Largest input aligned in the serving process instead of the worker pool
+default_inline_max = 64
+
+
+def runMaskJob(job, pool=None, cache=None, inline_max=default_inline_max):
+    """
+    Runs one align or pair job of the serve mode
+
+    Arguments:
+      job : dictionary with the command ('align' or 'pair'), seq_file, primer_file,
+            rev_primer_file for pair, the alignment options named as the align and
+            pair argument destinations and the output options: stdout, prefix,
+            out_file and append. With stdout the passing sequences are formatted as
+            by the pair --stdout option, otherwise in the input file format. The
+            output is written to out_file if given and returned otherwise.
+      pool : optional multiprocessing.Pool used for inputs larger than inline_max.
+      cache : optional dictionary of loaded primer sets.
+      inline_max : largest number of sequences aligned in the calling process.
+
+    Returns:
+      dict: response with the status, the pass and fail counts and either the
+            output or an error message.
+    """
+    try:
+        command = job.get('command', 'align')
+        align_func = {'align': alignPrimers, 'pair': pairPrimers}[command]
+        align_args = {k: job[k] for k in serve_job_args[command] if k in job}
+        if 'gap_penalty' in align_args:
+            align_args['gap_penalty'] = tuple(align_args['gap_penalty'])
+        primers, primers_regex = loadPrimers(job['primer_file'], rev_primer=job.get('rev_primer', False),
+                                             cache=cache)
+        align_args.update(primers=primers, primers_regex=primers_regex, delimiter=default_delimiter,
+                          score_dict=getDNAScoreDict(mask_score=(0, 1), gap_score=(0, 0)))
+        if command == 'pair':
+            rev_primers, rev_primers_regex = loadPrimers(job['rev_primer_file'], rev_primer=True, cache=cache)
+            align_args.update(rev_primers=rev_primers, rev_primers_regex=rev_primers_regex)
+
+        # Align small inputs in process and larger ones in the warm pool
+        data = [SeqData(seq.id, seq) for seq in readSeqFile(job['seq_file'])]
+        if pool is None or len(data) <= inline_max:
+            results = [align_func(x, **align_args) for x in data]
+        else:
+            results = pool.map(partial(align_func, **align_args), data, chunksize=inline_max)
+        passed = [x.results for x in results if x]
+
+        # Format output
+        if job.get('stdout'):
+            output = ''.join(strippedFasta(x, job.get('prefix')) for x in passed)
+        else:
+            handle = StringIO()
+            SeqIO.write(passed, handle, getFileType(job['seq_file']))
+            output = handle.getvalue()
+        response = {'status': 0, 'pass': len(passed), 'fail': len(results) - len(passed)}
+        if job.get('out_file'):
+            with open(job['out_file'], 'a' if job.get('append') else 'w') as out:
+                out.write(output)
+        else:
+            response['output'] = output
+    except (Exception, SystemExit) as e:
+        # presto reports unreadable inputs by exiting
+        response = {'status': 1, 'error': '%s: %s' % (type(e).__name__, e)}
+
+    return response
+
+
+class MaskRequestHandler(StreamRequestHandler):
+    """
+    Answers one JSON encoded job per connection with one JSON encoded response
+    """
+    def handle(self):
+        job = json.loads(self.rfile.readline().decode())
+        if job.get('command') == 'stop':
+            response = {'status': 0}
+            threading.Thread(target=self.server.shutdown).start()
+        else:
+            response = runMaskJob(job, pool=self.server.pool, cache=self.server.cache,
+                                  inline_max=self.server.inline_max)
+        self.wfile.write((json.dumps(response) + '\n').encode())
+
+
+def serveMask(socket_path=None, manifest=None, nproc=None, inline_max=default_inline_max):
+    """
+    Keeps primer sets and a worker pool loaded and runs masking jobs
+
+    Arguments:
+      socket_path : Unix socket accepting jobs until a stop command is received.
+      manifest : JSON lines file of jobs, run in order before serving the socket;
+                 one JSON response per job is printed to standard output.
+      nproc : number of worker pool processes; no pool if 1.
+      inline_max : largest number of sequences aligned in the serving process.
+
+    Returns:
+      None
+    """
+    cache = {}
+    pool = mp.Pool(nproc) if nproc is None or nproc > 1 else None
+    try:
+        if manifest is not None:
+            with open(manifest) as jobs:
+                for line in jobs:
+                    if line.strip():
+                        print(json.dumps(runMaskJob(json.loads(line), pool=pool, cache=cache,
+                                                    inline_max=inline_max)))
+                        sys.stdout.flush()
+
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = ThreadingUnixStreamServer(socket_path, MaskRequestHandler)
+            server.daemon_threads = True
+            server.pool, server.cache, server.inline_max = pool, cache, inline_max
+            sys.stderr.write('SERVE> %s\n' % socket_path)
+            try:
+                server.serve_forever()
+            finally:
+                server.server_close()
+                os.remove(socket_path)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    return None
+
+
 def getArgParser():
     """
     Defines the ArgumentParser
@@ -379,8 +952,86 @@ def getArgParser():
                              help='''Name of the barcode annotation field.''')
     group_align.add_argument('--pf', action='store', dest='primer_field', default=default_primer_field,
                              help='''Name of the annotation field containing the primer name.''')
+    group_align.add_argument('--block', action='store', dest='block_size', type=int, default=None,
+                             help='''Number of sequences aligned together by the vectorized
+                                  batch aligner. If unspecified, each sequence is aligned
+                                  separately.''')
     parser_align.set_defaults(align_func=alignPrimers)
 
+    # Pair mode argument parser
+    parser_pair = subparsers.add_parser('pair', parents=[parent_parser],
+                                        formatter_class=CommonHelpFormatter, add_help=False,
+                                        help='Find forward and reverse primer matches in a single pass.',
+                                        description='Find forward primer matches at the head and reverse '
+                                                    'primer matches at the tail of each sequence using pairwise '
+                                                    'local alignment. Equivalent to an align run with the forward '
+                                                    'primers followed by an align run with the reverse primers, '
+                                                    '--revpr and --skiprc on its pass output.')
+    group_pair = parser_pair.add_argument_group('primer pair alignment arguments')
+    group_pair.add_argument('-p', action='store', dest='primer_file', required=True,
+                            help='A FASTA file containing forward primer sequences.')
+    group_pair.add_argument('-r', action='store', dest='rev_primer_file', required=True,
+                            help='''A FASTA file containing reverse primer sequences, matched
+                                 as reverse complements against the tail-end of the sequence.''')
+    group_pair.add_argument('--maxerror', action='store', dest='max_error', type=float,
+                            default=default_primer_max_error,
+                            help='Maximum allowable error rate of the forward primer.')
+    group_pair.add_argument('--revmaxerror', action='store', dest='rev_max_error', type=float,
+                            default=default_primer_max_error,
+                            help='Maximum allowable error rate of the reverse primer.')
+    group_pair.add_argument('--maxlen', action='store', dest='max_len', type=int,
+                            default=default_primer_max_len,
+                            help='''Length of the sequence head and tail windows to scan for primers.''')
+    group_pair.add_argument('--gap', nargs=2, action='store', dest='gap_penalty',
+                            type=float, default=default_primer_gap_penalty,
+                            help='''A list of two positive values defining the gap open
+                                 and gap extension penalties for aligning the primers.''')
+    group_pair.add_argument('--skiprc', action='store_true', dest='skip_rc',
+                            help='''Specify to prevent checking of sample reverse complement
+                                 sequences for the forward primer.''')
+    group_pair.add_argument('--mode', action='store', dest='mode',
+                            choices=('cut', 'mask', 'trim', 'tag'), default='mask',
+                            help='''Specifies the action to take with both primer sequences,
+                                 as in the align subcommand.''')
+    group_pair.add_argument('--barcode', action='store_true', dest='barcode',
+                            help='''Specify to annotate reads sequences with barcode sequences
+                                 (unique molecular identifiers) found preceding the forward primer.''')
+    group_pair.add_argument('--bf', action='store', dest='barcode_field', default=default_barcode_field,
+                            help='''Name of the barcode annotation field.''')
+    group_pair.add_argument('--pf', action='store', dest='primer_field', default=default_primer_field,
+                            help='''Name of the annotation field containing the forward primer name.''')
+    group_pair.add_argument('--rpf', action='store', dest='rev_primer_field', default=default_primer_field,
+                            help='''Name of the annotation field containing the reverse primer name.''')
+    group_pair.add_argument('--stdout', action='store_true', dest='stdout',
+                            help='''Specify to write passing sequences to standard output as
+                                 FASTA with N characters removed, instead of writing the pass
+                                 and fail files. The log is printed to standard error.''')
+    group_pair.add_argument('--prefix', action='store', dest='prefix', default=None,
+                            help='''Prefix added to the standard output headers as "prefix:".''')
+    parser_pair.set_defaults(align_func=pairPrimers)
+
+    # Serve mode argument parser
+    parser_serve = subparsers.add_parser('serve', formatter_class=CommonHelpFormatter, add_help=False,
+                                         help='Run align and pair jobs from a socket or manifest.',
+                                         description='Keep primer sets and a worker pool loaded and run '
+                                                     'align and pair jobs received as JSON lines on a Unix '
+                                                     'socket or read from a manifest file. Jobs are sent '
+                                                     'with MaskClient.py.')
+    group_serve = parser_serve.add_argument_group('serve arguments')
+    group_serve.add_argument('-h', '--help', action='help', help='show this help message and exit')
+    group_serve.add_argument('--socket', action='store', dest='socket_path', default=None,
+                             help='''Unix socket to listen on until a stop command is received.''')
+    group_serve.add_argument('--manifest', action='store', dest='manifest', default=None,
+                             help='''File of JSON encoded jobs, one per line, run in order before
+                                  serving the socket. Responses are printed to standard output.''')
+    group_serve.add_argument('--nproc', action='store', dest='nproc', type=int, default=1,
+                             help='''Number of worker pool processes used for large inputs.''')
+    group_serve.add_argument('--inline', action='store', dest='inline_max', type=int,
+                             default=default_inline_max,
+                             help='''Largest number of sequences aligned in the serving process
+                                  instead of the worker pool.''')
+    parser_serve.set_defaults(align_func=serveMask)
+
     # Score mode argument parser
     parser_score = subparsers.add_parser('score', parents=[parent_parser],
                                          formatter_class=CommonHelpFormatter, add_help=False,
@@ -458,6 +1109,11 @@ if __name__ == '__main__':
     parser = getArgParser()
     checkArgs(parser)
     args = parser.parse_args()
+    profileProcess('MaskPrimers %s' % sys.argv[1])
+    if args.align_func is serveMask:
+        serveMask(socket_path=args.socket_path, manifest=args.manifest, nproc=args.nproc,
+                  inline_max=args.inline_max)
+        sys.exit()
     args_dict = parseCommonArgs(args)
     
     # Define align_args dictionary to pass to maskPrimers
@@ -481,6 +1137,28 @@ if __name__ == '__main__':
         del args_dict['barcode']
         del args_dict['barcode_field']
         del args_dict['primer_field']
+    elif args_dict['align_func'] is pairPrimers:
+        args_dict['align_args'] = {'max_error': args_dict['max_error'],
+                                   'rev_max_error': args_dict['rev_max_error'],
+                                   'max_len':args_dict['max_len'],
+                                   'skip_rc':args_dict['skip_rc'],
+                                   'gap_penalty':args_dict['gap_penalty'],
+                                   'mode': args_dict['mode'],
+                                   'barcode': args_dict['barcode'],
+                                   'barcode_field': args_dict['barcode_field'],
+                                   'primer_field': args_dict['primer_field'],
+                                   'rev_primer_field': args_dict['rev_primer_field']}
+
+        del args_dict['max_error']
+        del args_dict['rev_max_error']
+        del args_dict['max_len']
+        del args_dict['skip_rc']
+        del args_dict['gap_penalty']
+        del args_dict['mode']
+        del args_dict['barcode']
+        del args_dict['barcode_field']
+        del args_dict['primer_field']
+        del args_dict['rev_primer_field']
     elif args_dict['align_func'] is scorePrimers:
         args_dict['align_args'] = {'max_error': args_dict['max_error'],
                                    'start':args_dict['start'],
@@ -1,27 +1,84 @@
 #!/bin/bash
 
-while getopts i: flag
+pipeopts=""
+repopts=""
+
+while getopts i:t:a:n:c:e:owpb flag
 do
     case "${flag}" in
         i) input=${OPTARG};;
+        t) threads=${OPTARG};;
+        a) pipeopts="$pipeopts -a ${OPTARG}";;
+        n) pipeopts="$pipeopts -n ${OPTARG}";;
+        c) pipeopts="$pipeopts -c ${OPTARG}";;
+        o) repopts="--offline";;
+        w) watch=1;;
+        p) profile=1;;
+        b) setopts="$setopts --batch-polish";;
+        e) setopts="$setopts --exec ${OPTARG}";;
     esac
 done
 
+# Batch polishing and executor backends run the barcodes in driver mode
+if [ -n "$setopts" ]; then
+  threads=${threads:-1}
+fi
+
+# Telemetry of every stage, gathered into PIPE/trace.json at the end of the run
+if [ -n "$profile" ]; then
+  export NANOIG_TELEMETRY=$input/PIPE/telemetry.jsonl
+fi
+
 DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )"
 
 export PATH="$DIR:$PATH"
 
 echo $DIR
 
-python $DIR/NanoIgset.py $input $DIR
+# Keep one MaskPrimers.py process with the primers loaded for every clone
+export NANOIG_MASK_SOCKET=${TMPDIR:-/tmp}/nanoig-mask-$$.sock
+python $DIR/MaskPrimers.py serve --socket $NANOIG_MASK_SOCKET &
+mask_pid=$!
+
+# Stop the server if the run ends early
+trap 'kill $mask_pid 2> /dev/null; rm -f $NANOIG_MASK_SOCKET' EXIT
+
+# Wait up to 60 seconds for the server to load and bind its socket, so the first
+# barcodes do not fall back to MaskPrimers.py; without it PipeIg.sh runs MaskPrimers.py directly
+for i in $(seq 120); do
+  if [ -S "$NANOIG_MASK_SOCKET" ] || ! kill -0 $mask_pid 2> /dev/null; then
+    break
+  fi
+  sleep 0.5
+done
+if [ ! -S "$NANOIG_MASK_SOCKET" ]; then
+  echo "MaskPrimers.py serve did not start, masking runs MaskPrimers.py per clone" >&2
+fi
+
+if [ -n "$watch" ]; then
+  # Watch mode: follow the run while it is sequencing, starting each clone once its coverage is stable
+  python $DIR/NanoIgWatch.py $input $DIR -t ${threads:-1} -o "$pipeopts"
+elif [ -n "$threads" ]; then
+  # Driver mode: barcodes run concurrently sharing the thread budget
+  python $DIR/NanoIgset.py $input $DIR -t $threads -o "$pipeopts" $setopts
+else
+  python $DIR/NanoIgset.py $input $DIR -o "$pipeopts"
+
+  $DIR/Setcorr.sh
+
+  while read p; do
+    $p
+  done <$DIR/bashexec.txt
 
-$DIR/Setcorr.sh
+  cat $input/PIPE/*/Results.fasta > $input/Results.fasta
+fi
 
-while read p; do
-  $p
-done <$DIR/bashexec.txt
+python $DIR/MaskClient.py stop -S $NANOIG_MASK_SOCKET
 
 python $DIR/collage.py $input
 
-python $DIR/NanoIgRep.py $input
+python $DIR/NanoIgRep.py $input $repopts
 
+if [ -n "$NANOIG_TELEMETRY" ]; then
+  python $DIR/NanoIgProf.py -o $input/PIPE/trace.json $input/PIPE/telemetry.jsonl $input/PIPE/*/telemetry.jsonl
+fi
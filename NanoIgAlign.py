@@ -0,0 +1,193 @@
+#!/usr/bin/python
+"""
+NumPy batch pairwise alignment of many sequences against one reference sequence
+"""
+
+# Imports
+import numpy as np
+
+
+# Nucleotide codes; 4 is any other character and 5 is padding
+_code_table = np.full(256, 4, dtype=np.uint8)
+for _i, _c in enumerate('ACGT'):
+    _code_table[ord(_c)] = _i
+    _code_table[ord(_c.lower())] = _i
+pad_code = 5
+
+# Score used for cells outside the band or beyond the matrix
+_neg = -(1 << 30)
+
+_complement = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+
+def reverseComplement(seq):
+    """
+    Reverse complements a nucleotide string
+
+    Arguments:
+      seq : nucleotide sequence.
+
+    Returns:
+      str: reverse complement sequence.
+    """
+    return seq.translate(_complement)[::-1]
+
+
+def encodeSeq(seq):
+    """
+    Encodes a nucleotide string as an array of codes
+
+    Arguments:
+      seq : nucleotide sequence.
+
+    Returns:
+      numpy.ndarray: uint8 codes; A=0, C=1, G=2, T=3, other=4.
+    """
+    return _code_table[np.frombuffer(seq.encode('ascii'), dtype=np.uint8)]
+
+
+def encodeBatch(seqs):
+    """
+    Encodes nucleotide strings into a padded code matrix
+
+    Arguments:
+      seqs : list of nucleotide sequences.
+
+    Returns:
+      tuple: (uint8 matrix padded with pad_code, int array of sequence lengths).
+    """
+    lengths = np.array([len(s) for s in seqs], dtype=np.int64)
+    codes = np.full((len(seqs), max(lengths.max(initial=0), 1)), pad_code, dtype=np.uint8)
+    for r, seq in enumerate(seqs):
+        codes[r, :len(seq)] = encodeSeq(seq)
+
+    return codes, lengths
+
+
+def scoreMatrix(match=1, mismatch=-1, n_score=0):
+    """
+    Builds the substitution score lookup table
+
+    Arguments:
+      match : score of identical nucleotides.
+      mismatch : score of different nucleotides.
+      n_score : score of any alignment against an ambiguous character.
+
+    Returns:
+      numpy.ndarray: 6x6 int32 score table indexed by nucleotide codes.
+    """
+    table = np.full((6, 6), mismatch, dtype=np.int32)
+    np.fill_diagonal(table, match)
+    table[4, :] = table[:, 4] = n_score
+    table[pad_code, :] = table[:, pad_code] = mismatch
+
+    return table
+
+
+def alignBatch(ref, seqs, lengths, scores=None, gap=-1, ref_start_free=False, ref_end_free=False,
+               seq_start_free=False, seq_end_free=False, band=None, diagonal=0, traceback=True):
+    """
+    Aligns a batch of sequences against one reference with a linear gap penalty
+
+    The dynamic programming matrix is filled one reference row at a time for the
+    whole batch; gaps along a row are resolved with a running maximum, so each
+    row costs a fixed number of vectorized operations.
+
+    Arguments:
+      ref : reference nucleotide codes.
+      seqs : padded code matrix as returned by encodeBatch.
+      lengths : sequence lengths.
+      scores : substitution table as returned by scoreMatrix; unit scores if None.
+      gap : gap score, a negative number.
+      ref_start_free : if True leading reference bases are not penalized.
+      ref_end_free : if True trailing reference bases are not penalized.
+      seq_start_free : if True leading sequence bases are not penalized.
+      seq_end_free : if True trailing sequence bases are not penalized.
+      band : half width of the diagonal band; no band if None.
+      diagonal : sequence offset of the band centre relative to the reference.
+      traceback : if False only scores and end positions are returned.
+
+    Returns:
+      list: one (score, ref_start, seq_start, ref_end, seq_end, ops) tuple per
+            sequence; ops is a string of M (aligned pair), D (reference base
+            against a gap) and I (sequence base against a gap) operations.
+            Start positions and ops are None without traceback.
+    """
+    if scores is None:
+        scores = scoreMatrix()
+    n = len(ref)
+    R, m = seqs.shape
+    cols = np.arange(m + 1, dtype=np.int64)
+    last = np.asarray(lengths, dtype=np.int64)
+    rows = np.arange(R)
+
+    ptr = np.zeros((n + 1, R, m + 1), dtype=np.int8) if traceback else None
+    H = np.full((R, m + 1), _neg, dtype=np.int64)
+    hi0 = m if band is None else min(m, diagonal + band)
+    H[:, :hi0 + 1] = 0 if seq_start_free else gap * cols[:hi0 + 1]
+    if traceback:
+        ptr[0] = 2
+    end_col = np.empty((n + 1, R), dtype=np.int64)
+    end_col[0] = H[rows, last]
+
+    for i in range(1, n + 1):
+        lo, hi = (0, m) if band is None else (max(0, i + diagonal - band), min(m, i + diagonal + band))
+        prev = H
+        H = np.full((R, m + 1), _neg, dtype=np.int64)
+        if lo > hi:
+            end_col[i] = H[rows, last]
+            continue
+        start = max(lo, 1)
+        D = np.full((R, hi - lo + 1), _neg, dtype=np.int64)
+        row_ptr = np.ones((R, hi - lo + 1), dtype=np.int8)
+        if lo == 0:
+            D[:, 0] = 0 if ref_start_free else gap * i
+        if start <= hi:
+            diag = prev[:, start - 1:hi] + scores[ref[i - 1], seqs[:, start - 1:hi]]
+            up = prev[:, start:hi + 1] + gap
+            D[:, start - lo:] = np.maximum(diag, up)
+            row_ptr[:, start - lo:] = np.where(diag >= up, 0, 1)
+        offset = gap * cols[lo:hi + 1]
+        best = np.maximum.accumulate(D - offset, axis=1) + offset
+        row_ptr[best > D] = 2
+        H[:, lo:hi + 1] = best
+        if traceback:
+            ptr[i, :, lo:hi + 1] = row_ptr
+        end_col[i] = H[rows, last]
+
+    results = []
+    for r in range(R):
+        L = int(last[r])
+        # Select the alignment end cell
+        cands = [(int(end_col[n, r]), n, L)]
+        if ref_end_free:
+            i = int(np.argmax(end_col[:, r]))
+            cands.append((int(end_col[i, r]), i, L))
+        if seq_end_free:
+            j = int(np.argmax(H[r, :L + 1]))
+            cands.append((int(H[r, j]), n, j))
+        score, i, j = max(cands, key=lambda x: x[0])
+        ref_end, seq_end = i, j
+        if not traceback:
+            results.append((score, None, None, ref_end, seq_end, None))
+            continue
+
+        # Trace back to the alignment start
+        ops = []
+        while i > 0 or j > 0:
+            if (i == 0 and seq_start_free) or (j == 0 and ref_start_free):
+                break
+            p = ptr[i, r, j]
+            if p == 0:
+                ops.append('M')
+                i -= 1
+                j -= 1
+            elif p == 1:
+                ops.append('D')
+                i -= 1
+            else:
+                ops.append('I')
+                j -= 1
+        results.append((score, i, j, ref_end, seq_end, ''.join(reversed(ops))))
+
+    return results
@@ -0,0 +1,335 @@
+#!/usr/bin/python
+"""
+Annotates consensus sequences with their closest IGHV germline gene and V-REGION identity offline
+"""
+
+# Imports
+import os
+import sys
+from argparse import ArgumentParser
+from collections import Counter, OrderedDict
+
+# NanoIg imports
+from NanoIgAlign import alignBatch, encodeBatch, encodeSeq, reverseComplement
+from NanoIgCov import readBed
+from NanoIgIO import readFasta
+
+# Germline sources shipped with NanoIg: the IGH locus and its VH gene intervals
+_package = os.path.dirname(os.path.abspath(__file__))
+default_chrom_file = os.path.join(_package, 'Chr14', 'chr14.fa')
+default_bed_file = os.path.join(_package, 'Chr14', 'UCSC_hg38_VH_genes.bed')
+
+# Columns of the V-Quest synthesis view read by the report
+summary_columns = ['Sequence Number', 'Sequence ID', 'V-GENE and allele', 'V-DOMAIN Functionality',
+                   'V-REGION identity % (nt)', 'J-GENE and allele', 'D-GENE and allele', 'CDR-IMGT lengths',
+                   'AA JUNCTION', 'Sequence analysis category']
+
+_base_code = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+
+# Separates the copy number of genes listed more than once, e.g. the two IGHV3-72 intervals
+_copy_separator = '_'
+
+
+def readGermlines(germline_file=None, chrom_file=default_chrom_file, bed_file=default_bed_file):
+    """
+    Reads the germline gene sequences
+
+    Arguments:
+      germline_file : optional germline FASTA file, e.g. an IMGT reference directory
+                      file; the gene name is the second |-separated header field
+                      when present, the first word otherwise.
+      chrom_file : IGH locus FASTA used when no germline file is given.
+      bed_file : VH gene intervals of chrom_file; IGH lies on the minus strand, so
+                 the interval sequences are reverse complemented.
+
+    Returns:
+      collections.OrderedDict: {gene name: upper case sequence}; further
+      sequences of a gene name are kept as <name>_2, <name>_3 and so on, see
+      geneName.
+    """
+    germlines = OrderedDict()
+
+    def add(name, seq):
+        key, copy = name, 1
+        while key in germlines:
+            copy += 1
+            key = '%s%s%i' % (name, _copy_separator, copy)
+        germlines[key] = seq
+
+    if germline_file is not None:
+        for header, seq in readFasta(germline_file):
+            fields = header.split('|')
+            add(fields[1] if len(fields) > 1 else header.split()[0], seq.upper().replace('.', ''))
+    else:
+        chroms = {h.split()[0]: s.upper() for h, s in readFasta(chrom_file)}
+        for chrom, start, end, name, line in readBed(bed_file):
+            add(name, reverseComplement(chroms[chrom][start:end]))
+
+    return germlines
+
+
+def geneName(key):
+    """
+    Returns the gene name of a readGermlines key, without its copy suffix
+    """
+    return key.split(_copy_separator, 1)[0]
+
+
+def minimizers(seq, k=15, w=10):
+    """
+    Computes the (w, k) minimizers of a sequence
+
+    Arguments:
+      seq : upper case nucleotide sequence.
+      k : k-mer length, at most 31.
+      w : number of consecutive k-mers per window.
+
+    Returns:
+      list: (hash, position) tuples of the distinct window minimizers;
+            k-mers with ambiguous bases are skipped.
+    """
+    mask = (1 << (2 * k)) - 1
+    kmers = []
+    value, valid = 0, 0
+    for i, c in enumerate(seq):
+        code = _base_code.get(c)
+        if code is None:
+            valid = 0
+            continue
+        value = ((value << 2) | code) & mask
+        valid += 1
+        if valid >= k:
+            # Invertible integer mix to avoid a lexicographic minimizer bias
+            h = (value * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+            kmers.append((h ^ (h >> 29), i - k + 1))
+
+    picked = OrderedDict()
+    for i in range(max(1, len(kmers) - w + 1)):
+        window = kmers[i:i + w]
+        if window:
+            best = min(window)
+            picked[best[1]] = best
+
+    return list(picked.values())
+
+
+class MinimizerIndex:
+    """
+    Minimizer index of the germline genes
+    """
+    def __init__(self, germlines, k=15, w=10):
+        """
+        Initializer
+
+        Arguments:
+          germlines : dictionary of {gene name: sequence}.
+          k : k-mer length.
+          w : minimizer window.
+        """
+        self.k, self.w = k, w
+        self.names = list(germlines)
+        self.table = {}
+        for g, name in enumerate(self.names):
+            for h, pos in minimizers(germlines[name], k, w):
+                self.table.setdefault(h, []).append((g, pos))
+
+    def candidates(self, seq, n=5, prefix=None):
+        """
+        Ranks the genes sharing minimizers with a sequence
+
+        Arguments:
+          seq : upper case nucleotide sequence.
+          n : maximum number of candidates.
+          prefix : optional gene name prefix, e.g. IGHV.
+
+        Returns:
+          list: (gene name, shared minimizers, median germline minus sequence offset)
+                tuples, most shared first.
+        """
+        votes, offsets = Counter(), {}
+        for h, pos in minimizers(seq, self.k, self.w):
+            for g, gpos in self.table.get(h, ()):
+                votes[g] += 1
+                offsets.setdefault(g, []).append(gpos - pos)
+        ranked = []
+        for g, count in votes.most_common():
+            if prefix is not None and not self.names[g].startswith(prefix):
+                continue
+            diag = sorted(offsets[g])[len(offsets[g]) // 2]
+            ranked.append((self.names[g], count, diag))
+            if len(ranked) == n:
+                break
+
+        return ranked
+
+
+def alignIdentity(seq, genes, germlines, diagonals, band=32):
+    """
+    Aligns a sequence against candidate germline genes in one banded batch
+
+    The sequence and the germline genes may both start and end anywhere, so
+    leader, intron and D-J segments are left unaligned.
+
+    Arguments:
+      seq : upper case nucleotide sequence.
+      genes : candidate gene names.
+      germlines : dictionary of {gene name: sequence}.
+      diagonals : germline minus sequence offset of each candidate.
+      band : half width of the diagonal band around the candidate offsets.
+
+    Returns:
+      list: (score, percent identity, aligned length) per candidate.
+    """
+    codes, lengths = encodeBatch([germlines[g] for g in genes])
+    centre = sorted(diagonals)[len(diagonals) // 2]
+    width = band + max(abs(d - centre) for d in diagonals)
+    hits = alignBatch(encodeSeq(seq), codes, lengths, ref_start_free=True, ref_end_free=True,
+                      seq_start_free=True, seq_end_free=True, band=width, diagonal=centre)
+
+    results = []
+    for gene, hit in zip(genes, hits):
+        score, i, j, ops = hit[0], hit[1], hit[2], hit[5]
+        germ, matches = germlines[gene], 0
+        for op in ops:
+            if op == 'M':
+                matches += seq[i] == germ[j]
+                i, j = i + 1, j + 1
+            elif op == 'D':
+                i += 1
+            else:
+                j += 1
+        results.append((score, 100.0 * matches / len(ops) if ops else 0.0, len(ops)))
+
+    return results
+
+
+def orientSeq(seq, index, prefix='IGHV'):
+    """
+    Orients a sequence on the strand sharing the most minimizers with a germline gene
+
+    Arguments:
+      seq : upper case nucleotide sequence.
+      index : MinimizerIndex of the germline genes.
+      prefix : gene name prefix of the genes voting, e.g. IGHV.
+
+    Returns:
+      str: the sequence or its reverse complement.
+    """
+    rc = reverseComplement(seq)
+    votes = [index.candidates(s, n=1, prefix=prefix) for s in (seq, rc)]
+    if votes[1] and (not votes[0] or votes[1][0][1] > votes[0][0][1]):
+        return rc
+
+    return seq
+
+
+def bestGene(seq, index, germlines, prefix, n=5, band=32):
+    """
+    Finds the closest germline gene of a family
+
+    Arguments:
+      seq : upper case nucleotide sequence.
+      index : MinimizerIndex of the germline genes.
+      germlines : dictionary of {gene name: sequence}.
+      prefix : gene name prefix, e.g. IGHV.
+      n : number of minimizer candidates aligned.
+      band : half width of the alignment band.
+
+    Returns:
+      tuple: (list of equally best gene names, percent identity), or (None, None).
+    """
+    ranked = index.candidates(seq, n=n, prefix=prefix)
+    if not ranked:
+        return None, None
+    genes = [r[0] for r in ranked]
+    results = alignIdentity(seq, genes, germlines, [r[2] for r in ranked], band=band)
+    top = max(results)[:2]
+    best = []
+    for g, r in zip(genes, results):
+        if r[:2] == top and geneName(g) not in best:
+            best.append(geneName(g))
+
+    return best, top[1]
+
+
+def annotateRecords(records, index, germlines, n=5, band=32):
+    """
+    Annotates sequences with the columns of the V-Quest synthesis view
+
+    Only the V gene, V-REGION identity and, when the germlines include IGHJ
+    genes, the J gene are filled; the other columns are left empty. Drafts and
+    masked consensus sequences come in either orientation, so every sequence
+    is first oriented on its V gene, as V-Quest does.
+
+    Arguments:
+      records : list of (header, sequence) tuples.
+      index : MinimizerIndex of the germline genes.
+      germlines : dictionary of {gene name: sequence}.
+      n : number of minimizer candidates aligned per sequence.
+      band : half width of the alignment band.
+
+    Returns:
+      list: one list of summary_columns values per sequence.
+    """
+    rows = []
+    for number, (header, seq) in enumerate(records, start=1):
+        seq = orientSeq(seq.upper(), index)
+        row = OrderedDict((c, '') for c in summary_columns)
+        row['Sequence Number'], row['Sequence ID'] = str(number), header
+        v_genes, v_identity = bestGene(seq, index, germlines, 'IGHV', n=n, band=band)
+        if v_genes is not None:
+            row['V-GENE and allele'] = ' or '.join('Homsap %s' % g for g in v_genes)
+            row['V-REGION identity % (nt)'] = '%.2f' % v_identity
+        j_genes, j_identity = bestGene(seq, index, germlines, 'IGHJ', n=n, band=band)
+        if j_genes is not None:
+            row['J-GENE and allele'] = ' or '.join('Homsap %s' % g for g in j_genes)
+        rows.append(list(row.values()))
+
+    return rows
+
+
+def getArgParser():
+    """
+    Defines the ArgumentParser
+
+    Returns:
+      argparse.ArgumentParser: argument parser object.
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-i', action='store', dest='seq_file', required=True,
+                        help='Input FASTA file, e.g. Results.fasta.')
+    parser.add_argument('-o', action='store', dest='out_file', required=True,
+                        help='Output table in the semicolon separated V-Quest synthesis format.')
+    parser.add_argument('-g', action='store', dest='germline_file', default=None,
+                        help='''Germline FASTA file, e.g. IMGT IGHV and IGHJ reference sequences;
+                             the VH genes of the bundled IGH locus are used if not given.''')
+    parser.add_argument('--chrom', action='store', dest='chrom_file', default=default_chrom_file,
+                        help='IGH locus FASTA file.')
+    parser.add_argument('--bed', action='store', dest='bed_file', default=default_bed_file,
+                        help='VH gene intervals of the IGH locus.')
+    parser.add_argument('-k', action='store', dest='k', type=int, default=15,
+                        help='Minimizer k-mer length.')
+    parser.add_argument('-w', action='store', dest='w', type=int, default=10,
+                        help='Minimizer window.')
+    parser.add_argument('-n', action='store', dest='candidates', type=int, default=5,
+                        help='Number of candidate genes aligned per sequence.')
+    parser.add_argument('--band', action='store', dest='band', type=int, default=32,
+                        help='Half width of the alignment band.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and writes the annotation table
+    """
+    args = getArgParser().parse_args()
+
+    germlines = readGermlines(args.germline_file, chrom_file=args.chrom_file, bed_file=args.bed_file)
+    index = MinimizerIndex(germlines, k=args.k, w=args.w)
+    rows = annotateRecords(list(readFasta(args.seq_file)), index, germlines, n=args.candidates, band=args.band)
+    with open(args.out_file, 'w') as out:
+        out.write(';'.join(summary_columns) + '\n')
+        for row in rows:
+            out.write(';'.join(row) + '\n')
+    sys.stderr.write('SEQUENCES> %i\nGERMLINES> %i\n' % (len(rows), len(germlines)))
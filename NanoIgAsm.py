@@ -0,0 +1,258 @@
+#!/usr/bin/python
+"""
+Searches the canu correctedErrorRate of a clone assembly, reusing the read correction
+"""
+
+# Imports
+import glob
+import hashlib
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+
+# canu parameters shared by the correction and assembly runs
+default_canu_params = ['MhapMerSize=23', 'minReadLength=200', 'minOverlapLength=100',
+                       'genomeSize=1.0k', 'rawErrorRate=0.5']
+
+# Candidate correctedErrorRate values, searched in ascending order
+default_error_rates = [0.4, 0.6, 0.8, 1.0]
+
+
+def canuCommand(canu, out_dir, mode, read_type, reads, params, threads=None, error_rate=None):
+    """
+    Builds a canu command line
+
+    Arguments:
+      canu : canu executable.
+      out_dir : canu output folder.
+      mode : canu stage selector, e.g. -correct or -trim-assemble.
+      read_type : canu read type option, e.g. -nanopore-raw.
+      reads : input read file.
+      params : list of additional canu parameters.
+      threads : maxThreads value; canu default if None.
+      error_rate : correctedErrorRate value; canu default if None.
+
+    Returns:
+      list: command arguments.
+    """
+    cmd = [canu, mode, '-d', out_dir, '-p', 'ighv'] + list(params)
+    if error_rate is not None:
+        cmd.append('correctedErrorRate=%s' % error_rate)
+    if threads is not None:
+        cmd.append('maxThreads=%i' % threads)
+    cmd += [read_type, reads]
+
+    return cmd
+
+
+def hasContigs(out_dir):
+    """
+    Checks for a non-empty canu contig file
+
+    Arguments:
+      out_dir : canu output folder.
+
+    Returns:
+      bool: True if ighv.contigs.fasta exists and is not empty.
+    """
+    contigs = os.path.join(out_dir, 'ighv.contigs.fasta')
+
+    return os.path.exists(contigs) and os.path.getsize(contigs) > 0
+
+
+def readsDigest(reads):
+    """
+    Computes the SHA-256 digest of a read file
+
+    Arguments:
+      reads : read file.
+
+    Returns:
+      str: hexadecimal digest.
+    """
+    h = hashlib.sha256()
+    with open(reads, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def resetAssembly(out_dir, digest):
+    """
+    Removes the correction and assembly folders of other input reads
+
+    canu resumes from an existing output folder, so the correction/ and
+    erate-<rate> folders are only kept when they were made from reads with the
+    same digest, recorded in reads.sha256.
+
+    Arguments:
+      out_dir : assembly folder.
+      digest : digest of the input reads returned by readsDigest.
+
+    Returns:
+      bool: True if the earlier runs were kept.
+    """
+    digest_file = os.path.join(out_dir, 'reads.sha256')
+    if os.path.exists(digest_file):
+        with open(digest_file) as f:
+            if f.read().strip() == digest:
+                return True
+
+    for path in [os.path.join(out_dir, 'correction')] + glob.glob(os.path.join(out_dir, 'erate-*')):
+        shutil.rmtree(path, ignore_errors=True)
+    for name in ('ighv.contigs.fasta', 'erate.txt', 'reads.sha256'):
+        if os.path.exists(os.path.join(out_dir, name)):
+            os.remove(os.path.join(out_dir, name))
+    with open(digest_file, 'w') as f:
+        f.write('%s\n' % digest)
+
+    return False
+
+
+def correctReads(canu, reads, out_dir, params=default_canu_params, threads=None):
+    """
+    Runs the error rate independent canu read correction once
+
+    Arguments:
+      canu : canu executable.
+      reads : raw nanopore reads.
+      out_dir : correction output folder; an existing run is resumed, so it
+                must come from the same reads, see resetAssembly.
+      params : list of canu parameters.
+      threads : maxThreads value; canu default if None.
+
+    Returns:
+      str: corrected read file, or None if correction failed.
+    """
+    corrected = os.path.join(out_dir, 'ighv.correctedReads.fasta.gz')
+    if not os.path.exists(corrected):
+        subprocess.call(canuCommand(canu, out_dir, '-correct', '-nanopore-raw', reads, params, threads))
+
+    return corrected if os.path.exists(corrected) and os.path.getsize(corrected) > 0 else None
+
+
+def _stop(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except OSError:
+        pass
+    proc.wait()
+
+
+def searchErrorRate(canu, corrected, out_dir, rates=default_error_rates, params=default_canu_params,
+                    threads=None, parallel=2, poll=5):
+    """
+    Assembles corrected reads at several correctedErrorRate values concurrently
+
+    Candidates run in ascending order, up to parallel at a time, sharing the
+    thread budget. As soon as a candidate yields contigs all running and pending
+    candidates with a higher error rate are dropped, so the lowest error rate
+    producing contigs is selected as in the sequential search.
+
+    Arguments:
+      canu : canu executable.
+      corrected : corrected read file returned by correctReads.
+      out_dir : parent folder of the per-rate erate-<rate> assembly folders.
+      rates : candidate correctedErrorRate values.
+      params : list of canu parameters.
+      threads : total thread budget; all CPUs if None.
+      parallel : maximum number of concurrent canu runs.
+      poll : seconds between status checks.
+
+    Returns:
+      tuple: (selected error rate or None, number of attempted rates).
+    """
+    pending = sorted(rates)
+    threads = threads or os.cpu_count() or 1
+    share = max(1, threads // max(1, min(parallel, len(pending))))
+    running = {}
+    best = None
+    attempts = 0
+
+    while pending or running:
+        while pending and len(running) < parallel and (best is None or pending[0] < best):
+            rate = pending.pop(0)
+            rate_dir = os.path.join(out_dir, 'erate-%s' % rate)
+            cmd = canuCommand(canu, rate_dir, '-trim-assemble', '-nanopore-corrected', corrected,
+                              params, share, rate)
+            running[rate] = subprocess.Popen(cmd, start_new_session=True)
+            attempts += 1
+        if not running:
+            break
+        time.sleep(poll)
+
+        for rate, proc in list(running.items()):
+            if rate not in running or proc.poll() is None:
+                continue
+            del running[rate]
+            if hasContigs(os.path.join(out_dir, 'erate-%s' % rate)) and (best is None or rate < best):
+                best = rate
+                pending = [r for r in pending if r < best]
+                for other in [r for r in running if r > best]:
+                    _stop(running.pop(other))
+
+    return best, attempts
+
+
+def getArgParser():
+    """
+    Defines the ArgumentParser
+
+    Returns:
+      argparse.ArgumentParser: argument parser object.
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-s', action='store', dest='seq_file', required=True,
+                        help='Filtered clone reads in FASTQ format.')
+    parser.add_argument('-d', action='store', dest='out_dir', required=True,
+                        help='Assembly folder; receives ighv.contigs.fasta of the selected error rate.')
+    parser.add_argument('--canu', action='store', dest='canu', required=True,
+                        help='canu executable.')
+    parser.add_argument('--rates', action='store', dest='rates', default=','.join(str(r) for r in default_error_rates),
+                        help='Comma separated correctedErrorRate candidates.')
+    parser.add_argument('-t', action='store', dest='threads', type=int, default=None,
+                        help='Total thread budget shared by the canu runs.')
+    parser.add_argument('-j', action='store', dest='parallel', type=int, default=2,
+                        help='Number of error rates assembled concurrently.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and runs the assembly search
+    """
+    args = getArgParser().parse_args()
+    rates = [float(r) for r in args.rates.split(',')]
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    # Resume the correction and assemblies only for the same reads
+    resetAssembly(args.out_dir, readsDigest(args.seq_file))
+    corrected = correctReads(args.canu, os.path.abspath(args.seq_file), os.path.join(args.out_dir, 'correction'),
+                             threads=args.threads)
+    if corrected is None:
+        sys.stderr.write('canu read correction produced no reads for %s\n' % args.seq_file)
+        sys.exit(1)
+
+    rate, attempts = searchErrorRate(args.canu, os.path.abspath(corrected), args.out_dir, rates=rates,
+                                     threads=args.threads, parallel=args.parallel)
+    log = 'RATE> %s\nATTEMPTS> %i\n' % (rate, attempts)
+    sys.stderr.write(log)
+    with open(os.path.join(args.out_dir, 'erate.txt'), 'w') as f:
+        f.write(log)
+    if rate is None:
+        sys.stderr.write('No contigs for any correctedErrorRate in %s\n' % args.rates)
+        sys.exit(1)
+
+    # Expose the selected assembly where the downstream steps expect it
+    rate_dir = os.path.join(args.out_dir, 'erate-%s' % rate)
+    shutil.copyfile(os.path.join(rate_dir, 'ighv.contigs.fasta'), os.path.join(args.out_dir, 'ighv.contigs.fasta'))
+    for other in rates:
+        if other != rate:
+            shutil.rmtree(os.path.join(args.out_dir, 'erate-%s' % other), ignore_errors=True)
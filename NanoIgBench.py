@@ -0,0 +1,426 @@
+#!/usr/bin/python
+"""
+Benchmarks the barcode pipeline on synthetic nanopore IGHV amplicon runs
+"""
+
+# Imports
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from collections import Counter, OrderedDict
+from itertools import product
+
+# NanoIg imports
+from NanoIgAlign import reverseComplement
+from NanoIgAnnot import geneName, readGermlines
+from NanoIgCluster import clusterReads
+from NanoIgCons import readPrimers
+from NanoIgIO import writeFastq
+from NanoIgProf import readRecords
+
+_package = os.path.dirname(os.path.abspath(__file__))
+
+# IGHJ4 segment ending where the JH primer anneals
+default_jh = 'TACTTTGACTACTGGGGCCAGGGA'
+
+# Substitution, insertion and deletion rates of a R9.4 read
+default_errors = (0.04, 0.02, 0.03)
+
+# Sub-clone checks: clonal fractions of one V gene, the rest polyclonal, and the number of sub-clones to find
+default_subclone_cases = (((0.5, 0.5), 2), ((0.6, 0.4), 2), ((1.0,), 1), ((0.9,), 1),
+                          ((0.4, 0.3), 2), ((0.3, 0.3), 2), ((0.25, 0.15), 2), ((0.2, 0.2), 2),
+                          ((0.5,), 1), ((0.3,), 1))
+
+
+def buildAmplicon(gene, germline, fwd_primers, rev_primer, junction):
+    """
+    Builds the FR1 to JH amplicon of a rearrangement
+
+    Arguments:
+      gene : V gene name, e.g. IGHV3-23; its family selects the forward primer.
+      germline : V gene sequence.
+      fwd_primers : dictionary of {family: primer sequence}.
+      rev_primer : JH primer sequence, annealing to the reverse strand.
+      junction : N-D-N sequence joining the V and J genes.
+
+    Returns:
+      str: primer tailed amplicon sequence.
+    """
+    family = gene.split('-')[0]
+    primer = fwd_primers.get(family, next(iter(fwd_primers.values())))
+    # Anneal the primer where it has the fewest mismatches, leaving the 3' part of the V exon
+    offsets = range(max(1, len(germline) - len(primer) - 150))
+    best = min(offsets, key=lambda i: sum(a != b for a, b in zip(primer, germline[i:i + len(primer)])))
+
+    return primer + germline[best + len(primer):] + junction + default_jh + reverseComplement(rev_primer)
+
+
+def nanoporeRead(seq, rng, errors=default_errors):
+    """
+    Adds nanopore like errors to a sequence
+
+    Deletions are twice as likely within homopolymers and erroneous bases get
+    low qualities.
+
+    Arguments:
+      seq : template sequence.
+      rng : random.Random object.
+      errors : (substitution, insertion, deletion) rates.
+
+    Returns:
+      tuple: (read sequence, quality string).
+    """
+    sub, ins, dele = errors
+    bases, quals = [], []
+    for i, c in enumerate(seq):
+        homopolymer = i > 0 and seq[i - 1] == c
+        r = rng.random()
+        if r < dele * (2 if homopolymer else 1):
+            continue
+        r = rng.random()
+        if r < ins:
+            bases.append(rng.choice('ACGT'))
+            quals.append(rng.randint(2, 7))
+        r = rng.random()
+        if r < sub:
+            bases.append(rng.choice([b for b in 'ACGT' if b != c]))
+            quals.append(rng.randint(2, 7))
+        else:
+            bases.append(c)
+            quals.append(rng.randint(8, 20))
+
+    return ''.join(bases), ''.join(chr(33 + q) for q in quals)
+
+
+def simulateBarcode(germlines, fwd_primers, rev_primer, depth, clones, rng, errors=default_errors):
+    """
+    Simulates the reads of one barcode
+
+    Arguments:
+      germlines : dictionary of {V gene name: sequence} of the V genes long
+                  enough to hold an amplicon.
+      fwd_primers : dictionary of {family: primer sequence}.
+      rev_primer : JH primer sequence.
+      depth : number of reads.
+      clones : fractions of the reads coming from each clonal rearrangement; the
+               rest comes from polyclonal rearrangements of random genes.
+      rng : random.Random object.
+      errors : (substitution, insertion, deletion) rates.
+
+    Returns:
+      tuple: (list of (header, sequence, quality) reads, Counter of reads per V gene).
+    """
+    genes = list(germlines)
+
+    def junction():
+        return ''.join(rng.choice('ACGT') for i in range(rng.randint(8, 20)))
+    clonal = [rng.choice(genes) for f in clones]
+    templates = [buildAmplicon(g, germlines[g], fwd_primers, rev_primer, junction()) for g in clonal]
+
+    reads, truth = [], Counter()
+    for n in range(depth):
+        r, k = rng.random(), 0
+        while k < len(clones) and r >= clones[k]:
+            r -= clones[k]
+            k += 1
+        if k < len(clones):
+            gene, template = clonal[k], templates[k]
+        else:
+            gene = rng.choice(genes)
+            template = buildAmplicon(gene, germlines[gene], fwd_primers, rev_primer, junction())
+        if rng.random() < 0.5:
+            template = reverseComplement(template)
+        seq, qual = nanoporeRead(template, rng, errors=errors)
+        reads.append(('read%i gene=%s' % (n, geneName(gene)), seq, qual))
+        truth[geneName(gene)] += 1
+
+    return reads, truth
+
+
+def simulateRun(data_dir, barcodes, depth, clones, seed=1, errors=default_errors, chunk_size=4000):
+    """
+    Writes a synthetic run folder
+
+    Arguments:
+      data_dir : run folder receiving fastq/barcodeXX/chunk_N.fastq files.
+      barcodes : number of barcodes.
+      depth : reads per barcode.
+      clones : clonal read fractions of every barcode.
+      seed : random seed; the same seed writes the same run.
+      errors : (substitution, insertion, deletion) rates.
+      chunk_size : reads per FASTQ chunk.
+
+    Returns:
+      dict: {barcode: Counter of reads per V gene}.
+    """
+    rng = random.Random(seed)
+    germlines = OrderedDict((g, s) for g, s in readGermlines().items() if len(s) >= 300)
+    fwd_primers = readPrimers(os.path.join(_package, 'For_primers.fasta'))
+    rev_primer = next(iter(readPrimers(os.path.join(_package, 'Rev_primer.fasta')).values()))
+
+    truth = OrderedDict()
+    for b in range(1, barcodes + 1):
+        barcode = 'barcode%02i' % b
+        folder = os.path.join(data_dir, 'fastq', barcode)
+        os.makedirs(folder, exist_ok=True)
+        reads, truth[barcode] = simulateBarcode(germlines, fwd_primers, rev_primer, depth, clones, rng,
+                                                errors=errors)
+        for c in range(0, len(reads), chunk_size):
+            with open(os.path.join(folder, 'chunk_%i.fastq' % (c // chunk_size)), 'w') as out:
+                for record in reads[c:c + chunk_size]:
+                    writeFastq(out, record)
+
+    return truth
+
+
+def checkSubclones(depth=1000, seeds=4, cases=default_subclone_cases, errors=default_errors, min_recall=0.8):
+    """
+    Checks that NanoIgCluster splits the rearrangements of one V gene
+
+    Every case simulates the reads of a gene from clonal rearrangements sharing
+    the V gene but not the junction, the rest from rearrangements of their own,
+    and splits them as NanoIgPipe.py does.
+
+    Arguments:
+      depth : reads per simulated gene.
+      seeds : random seeds run per case.
+      cases : (clonal fractions, expected number of sub-clones) tuples.
+      errors : (substitution, insertion, deletion) rates.
+      min_recall : minimum fraction of the reads of every clonal rearrangement
+                   in its own sub-clone; the polyclonal reads may go anywhere.
+
+    Returns:
+      list: (fractions, seed, passed, [(sub-clone size, {rearrangement: reads})]) tuples.
+    """
+    germlines = OrderedDict((g, s) for g, s in readGermlines().items() if len(s) >= 300)
+    fwd_primers = readPrimers(os.path.join(_package, 'For_primers.fasta'))
+    rev_primers = list(readPrimers(os.path.join(_package, 'Rev_primer.fasta')).values())
+
+    results = []
+    for (clones, expected), seed in product(cases, range(seeds)):
+        rng = random.Random(seed)
+        gene = rng.choice(list(germlines))
+
+        def template():
+            junction = ''.join(rng.choice('ACGT') for i in range(rng.randint(8, 20)))
+            return buildAmplicon(gene, germlines[gene], fwd_primers, rev_primers[0], junction)
+        templates = [template() for f in clones]
+
+        seqs, labels = [], []
+        for n in range(depth):
+            r, k = rng.random(), 0
+            while k < len(clones) and r >= clones[k]:
+                r -= clones[k]
+                k += 1
+            seq = templates[k] if k < len(clones) else template()
+            if rng.random() < 0.5:
+                seq = reverseComplement(seq)
+            seqs.append(nanoporeRead(seq, rng, errors=errors)[0])
+            labels.append(k)
+
+        clusters = clusterReads(seqs, list(fwd_primers.values()), rev_primers, assign_all=True)
+        found = [(len(m), Counter(labels[i] for i in m)) for m in clusters]
+        # Each clonal rearrangement has most of its reads in a sub-clone of its own
+        total = Counter(labels)
+        best = [max(range(len(found)), key=lambda c: found[c][1][k]) if found else None for k in range(len(clones))]
+        passed = len(found) == expected and len(set(best)) == len(clones) and \
+            all(found[c][1][k] >= min_recall * total[k] for k, c in enumerate(best))
+        results.append((clones, seed, passed, found))
+
+    return results
+
+
+def stageTimes(telemetry_files):
+    """
+    Sums the telemetry records of a run per stage
+
+    Clone stages such as draft-barcode01-IGHV3-23 are summed under draft.
+
+    Arguments:
+      telemetry_files : telemetry JSON lines files.
+
+    Returns:
+      collections.OrderedDict: {stage: {'calls', 'skipped', 'wall', 'cpu', 'max_rss_mb'}}.
+    """
+    stages = OrderedDict()
+    for name, record in readRecords(telemetry_files):
+        stage = record['name'].split('-')[0]
+        s = stages.setdefault(stage, {'calls': 0, 'skipped': 0, 'wall': 0.0, 'cpu': 0.0, 'max_rss_mb': 0.0})
+        s['calls'] += 1
+        s['skipped'] += bool(record.get('skipped'))
+        s['wall'] += record['wall']
+        s['cpu'] += record['cpu_user'] + record['cpu_sys']
+        s['max_rss_mb'] = max(s['max_rss_mb'], record['max_rss_kb'] / 1024.0)
+
+    return stages
+
+
+def runBenchmark(data_dir, threads, pipe_opts=''):
+    """
+    Runs the barcode pipeline of a synthetic run from scratch
+
+    Arguments:
+      data_dir : run folder written by simulateRun.
+      threads : thread budget of the NanoIgset.py driver.
+      pipe_opts : additional PipeIg.sh options.
+
+    Returns:
+      tuple: (exit status, end to end wall time, stage times, {barcode: candidate genes}).
+    """
+    for name in ('PIPE', 'Results.fasta'):
+        path = os.path.join(data_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    env = dict(os.environ)
+    env['NANOIG_TELEMETRY'] = os.path.join(data_dir, 'PIPE', 'telemetry.jsonl')
+    cmd = [sys.executable, os.path.join(_package, 'NanoIgset.py'), data_dir, _package, '-t', str(threads),
+           '-o', pipe_opts]
+    start = time.time()
+    with open(os.path.join(data_dir, 'bench.log'), 'w') as log:
+        status = subprocess.call(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+    wall = time.time() - start
+
+    barcodes = sorted(os.listdir(os.path.join(data_dir, 'fastq')))
+    files = [env['NANOIG_TELEMETRY']] + [os.path.join(data_dir, 'PIPE', b, 'telemetry.jsonl') for b in barcodes]
+    found = {}
+    for b in barcodes:
+        bed = os.path.join(data_dir, 'PIPE', 'Clonality', b, 'Clonal_candidate.bed')
+        if os.path.exists(bed):
+            with open(bed) as f:
+                found[b] = set(line.split('\t')[3].strip() for line in f if line.strip())
+
+    return status, wall, stageTimes(files), found
+
+
+def compareReports(old, new, tolerance=1.2):
+    """
+    Compares the stage wall times of two benchmark reports
+
+    Arguments:
+      old : earlier report dictionary.
+      new : current report dictionary.
+      tolerance : slowdown ratio above which a stage is a regression.
+
+    Returns:
+      list: (configuration, stage, old wall, new wall) tuples of the regressions.
+    """
+    def rows(report):
+        return {(r['config'], r['stage']): r['wall'] for r in report['rows']}
+    old_rows, regressions = rows(old), []
+    for key, wall in sorted(rows(new).items()):
+        if key in old_rows and old_rows[key] > 0.5 and wall > tolerance * old_rows[key]:
+            regressions.append(key + (old_rows[key], wall))
+
+    return regressions
+
+
+def getArgParser():
+    """
+    Defines the ArgumentParser
+
+    Returns:
+      argparse.ArgumentParser: argument parser object.
+    """
+    parser = ArgumentParser(description=__doc__,
+                            epilog='bwa, canu and medaka must be installed as for a NanoIg run, '
+                                   'unless -o selects alternatives, e.g. "-a fast -c minimizer".')
+    parser.add_argument('-w', action='store', dest='work_dir', required=True,
+                        help='Work folder receiving the synthetic runs and the report.')
+    parser.add_argument('-b', action='store', dest='barcodes', default='1,4',
+                        help='Comma separated barcode counts.')
+    parser.add_argument('-d', action='store', dest='depths', default='2000',
+                        help='Comma separated reads per barcode.')
+    parser.add_argument('-t', action='store', dest='threads', default='1',
+                        help='Comma separated thread budgets.')
+    parser.add_argument('--clones', action='store', dest='clones', default='0.6',
+                        help='Comma separated clonal read fractions of every barcode.')
+    parser.add_argument('--errors', action='store', dest='errors', default=','.join(str(e) for e in default_errors),
+                        help='Substitution, insertion and deletion rates.')
+    parser.add_argument('--seed', action='store', dest='seed', type=int, default=1,
+                        help='Random seed of the synthetic runs.')
+    parser.add_argument('-o', action='store', dest='pipe_opts', default='',
+                        help='Additional PipeIg.sh options, e.g. "-a fast".')
+    parser.add_argument('--simulate', action='store_true', dest='simulate_only',
+                        help='Only write the synthetic runs.')
+    parser.add_argument('--subclones', action='store_true', dest='check_subclones',
+                        help='Only check the sub-clone split of NanoIgCluster.py on same V gene rearrangements '
+                             '(two or one, with up to 60%% polyclonal reads) at -d reads and exit 1 if a case fails.')
+    parser.add_argument('--compare', action='store', dest='compare_file', default=None,
+                        help='Earlier bench.json; stages slower than --tolerance times are reported.')
+    parser.add_argument('--tolerance', action='store', dest='tolerance', type=float, default=1.2,
+                        help='Slowdown ratio of a regression.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and runs the benchmark grid
+    """
+    args = getArgParser().parse_args()
+    clones = [float(c) for c in args.clones.split(',')]
+    errors = tuple(float(e) for e in args.errors.split(','))
+
+    if args.check_subclones:
+        failed = 0
+        for fractions, seed, passed, found in checkSubclones(depth=int(args.depths.split(',')[0]), errors=errors):
+            print('%s seed %i> %s %s' % ('/'.join('%g' % f for f in fractions), seed, 'PASS' if passed else 'FAIL',
+                                         ' '.join('%i%s' % (size, dict(c)) for size, c in found)))
+            failed += not passed
+        sys.exit(1 if failed else 0)
+
+    report = {'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                          'cpus': os.cpu_count()},
+              'settings': vars(args), 'rows': []}
+    for barcodes, depth in product([int(b) for b in args.barcodes.split(',')],
+                                   [int(d) for d in args.depths.split(',')]):
+        data_dir = os.path.abspath(os.path.join(args.work_dir, 'b%i_d%i' % (barcodes, depth)))
+        if not os.path.isdir(os.path.join(data_dir, 'fastq')):
+            truth = simulateRun(data_dir, barcodes, depth, clones, seed=args.seed, errors=errors)
+            with open(os.path.join(data_dir, 'truth.json'), 'w') as f:
+                json.dump(truth, f, indent=1)
+        with open(os.path.join(data_dir, 'truth.json')) as f:
+            truth = json.load(f)
+        if args.simulate_only:
+            continue
+
+        for threads in [int(t) for t in args.threads.split(',')]:
+            config = 'b%i_d%i_t%i' % (barcodes, depth, threads)
+            status, wall, stages, found = runBenchmark(data_dir, threads, pipe_opts=args.pipe_opts)
+            expected = {b: set(g for g, n in genes.items() if n >= 500) for b, genes in truth.items()}
+            recall = sum(len(expected[b] & found.get(b, set())) for b in expected)
+            total = sum(len(e) for e in expected.values())
+            for stage, s in stages.items():
+                report['rows'].append(dict(config=config, stage=stage, **s))
+            report['rows'].append({'config': config, 'stage': 'total', 'calls': 1, 'skipped': 0, 'wall': wall,
+                                   'cpu': sum(s['cpu'] for s in stages.values()), 'status': status,
+                                   'max_rss_mb': max([s['max_rss_mb'] for s in stages.values()] or [0]),
+                                   'clones_found': recall, 'clones_expected': total})
+            print('%s> %.1f s, status %i, clones %i/%i' % (config, wall, status, recall, total))
+
+    if args.simulate_only:
+        sys.exit()
+    with open(os.path.join(args.work_dir, 'bench.json'), 'w') as out:
+        json.dump(report, out, indent=1)
+    with open(os.path.join(args.work_dir, 'bench.tsv'), 'w') as out:
+        out.write('config\tstage\tcalls\tskipped\twall\tcpu\tmax_rss_mb\n')
+        for r in report['rows']:
+            out.write('%s\t%s\t%i\t%i\t%.2f\t%.2f\t%.1f\n' % (r['config'], r['stage'], r['calls'], r['skipped'],
+                                                           r['wall'], r['cpu'], r['max_rss_mb']))
+
+    if args.compare_file:
+        with open(args.compare_file) as f:
+            regressions = compareReports(json.load(f), report, tolerance=args.tolerance)
+        for config, stage, old, new in regressions:
+            print('REGRESSION> %s %s %.1f s -> %.1f s' % (config, stage, old, new))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,313 @@
+#!/usr/bin/python
+"""
+Runs a pipeline stage unless a checkpoint shows its outputs are current for the same inputs and parameters
+"""
+
+# Imports
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+# NanoIg imports
+from NanoIgProf import scanCounts, telemetryFile, usageRecord, usageSnapshot, writeRecord
+
+# Digests of unchanged files are reused from this file of the checkpoint folder
+digest_file = 'digests.json'
+
+
+def readJson(name, default):
+    """
+    Reads a JSON file
+
+    Arguments:
+      name : file name.
+      default : value returned if the file is missing or unreadable.
+
+    Returns:
+      object: the decoded content or default.
+    """
+    try:
+        with open(name) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def writeJson(name, value):
+    """
+    Writes a JSON file, replacing it atomically
+
+    Arguments:
+      name : file name.
+      value : JSON serializable object.
+
+    Returns:
+      None
+    """
+    tmp = '%s.%i' % (name, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(value, f, indent=1, sort_keys=True)
+    os.replace(tmp, name)
+
+
+def fileDigest(path, cache):
+    """
+    Computes the content digest of a file or folder
+
+    Files whose size and modification time match the cache entry are not read again.
+
+    Arguments:
+      path : file or folder name.
+      cache : dictionary of {absolute path: [size, mtime_ns, digest]}, updated in place.
+
+    Returns:
+      str: sha256 hex digest; for folders, of the names and digests of all files
+           below it; None if the path does not exist.
+    """
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        h = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for f in sorted(files):
+                name = os.path.join(root, f)
+                h.update(('%s\t%s\n' % (os.path.relpath(name, path), fileDigest(name, cache))).encode())
+        return h.hexdigest()
+    if not os.path.exists(path):
+        return None
+
+    st = os.stat(path)
+    entry = cache.get(path)
+    if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+        return entry[2]
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    cache[path] = [st.st_size, st.st_mtime_ns, h.hexdigest()]
+
+    return cache[path][2]
+
+
+def stageKey(name, inputs, params, cache):
+    """
+    Computes the checkpoint key of a stage
+
+    Arguments:
+      name : stage name.
+      inputs : input files and folders.
+      params : list of parameter strings, e.g. model=r941_min_high_g303.
+      cache : digest cache.
+
+    Returns:
+      str: sha256 hex digest of the stage name, parameters and input contents.
+    """
+    h = hashlib.sha256(name.encode())
+    for p in params:
+        h.update(('param\t%s\n' % p).encode())
+    for i in inputs:
+        h.update(('input\t%s\n' % fileDigest(i, cache)).encode())
+
+    return h.hexdigest()
+
+
+def stageCurrent(check_dir, name, inputs=(), params=(), outputs=()):
+    """
+    Tells whether the checkpoint of a stage run in process is current
+
+    Arguments:
+      check_dir : checkpoint folder.
+      name : stage name.
+      inputs : input files and folders.
+      params : list of parameter strings.
+      outputs : output files.
+
+    Returns:
+      bool: True if the stage can be skipped, as in runStage.
+    """
+    os.makedirs(check_dir, exist_ok=True)
+    cache_file = os.path.join(check_dir, digest_file)
+    cache = readJson(cache_file, {})
+    record = readJson(os.path.join(check_dir, '%s.json' % name), None)
+    current = record is not None and record.get('key') == stageKey(name, inputs, params, cache) and \
+        record.get('outputs') == {o: fileDigest(o, cache) for o in outputs} and \
+        None not in record['outputs'].values()
+    writeJson(cache_file, cache)
+
+    return current
+
+
+def recordStage(check_dir, name, inputs=(), params=(), outputs=()):
+    """
+    Records the checkpoint of a stage whose outputs were written outside runStage
+
+    Arguments:
+      check_dir : checkpoint folder.
+      name : stage name.
+      inputs : input files and folders.
+      params : list of parameter strings.
+      outputs : output files.
+
+    Returns:
+      None
+    """
+    os.makedirs(check_dir, exist_ok=True)
+    cache_file = os.path.join(check_dir, digest_file)
+    cache = readJson(cache_file, {})
+    record = {'key': stageKey(name, inputs, params, cache), 'params': list(params),
+              'outputs': {o: fileDigest(o, cache) for o in outputs}}
+    writeJson(os.path.join(check_dir, '%s.json' % name), record)
+    writeJson(cache_file, cache)
+
+
+def removeOutputs(outputs):
+    """
+    Removes the output files and folders of a stage
+
+    Arguments:
+      outputs : output files and folders.
+
+    Returns:
+      None
+    """
+    for output in outputs:
+        if os.path.isdir(output) and not os.path.islink(output):
+            shutil.rmtree(output)
+        elif os.path.lexists(output):
+            os.remove(output)
+
+
+def runStage(check_dir, name, command, inputs=(), params=(), outputs=(), defer_file=None):
+    """
+    Runs a stage command unless its checkpoint is current
+
+    A checkpoint is current when it was recorded with the same key and every
+    output still has the recorded content. The checkpoint and the outputs are
+    removed before the command runs, so a failed run leaves no stale outputs,
+    and the checkpoint is only written back when it succeeds. With telemetry on, the
+    stage is recorded with the counts it prints to standard error.
+
+    A deferred stage is not run: its arguments are written to defer_file for a
+    batch runner, e.g. NanoIgPolish.py, which calls recordStage once the
+    outputs exist.
+
+    Arguments:
+      check_dir : checkpoint folder.
+      name : stage name, unique within check_dir.
+      command : bash command line, run with pipefail.
+      inputs : input files and folders.
+      params : list of parameter strings.
+      outputs : output files.
+      defer_file : JSON file receiving the stage instead of running it; removed
+                   when the checkpoint is current.
+
+    Returns:
+      tuple: (exit status, True if the command ran).
+    """
+    start = usageSnapshot() if telemetryFile() else None
+    os.makedirs(check_dir, exist_ok=True)
+    cache_file = os.path.join(check_dir, digest_file)
+    record_file = os.path.join(check_dir, '%s.json' % name)
+    cache = readJson(cache_file, {})
+    key = stageKey(name, inputs, params, cache)
+
+    record = readJson(record_file, None)
+    if record is not None and record.get('key') == key and \
+            record.get('outputs') == {o: fileDigest(o, cache) for o in outputs} and \
+            None not in record['outputs'].values():
+        writeJson(cache_file, cache)
+        if defer_file is not None and os.path.exists(defer_file):
+            os.remove(defer_file)
+        if start is not None:
+            writeRecord(usageRecord(name, start, status=0, skipped=True))
+        return 0, False
+
+    if os.path.exists(record_file):
+        os.remove(record_file)
+    removeOutputs(outputs)
+    if defer_file is not None:
+        writeJson(defer_file, {'check_dir': os.path.abspath(check_dir), 'name': name, 'command': command,
+                               'inputs': list(inputs), 'params': list(params), 'outputs': list(outputs)})
+        writeJson(cache_file, cache)
+        if start is not None:
+            writeRecord(usageRecord(name, start, status=0, skipped=True, deferred=True))
+        return 0, False
+    if start is None:
+        status = subprocess.call(['bash', '-o', 'pipefail', '-c', command])
+    else:
+        proc = subprocess.Popen(['bash', '-o', 'pipefail', '-c', command], stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        counts = scanCounts(proc.stderr, handle=sys.stderr)
+        status = proc.wait()
+        fields = {'status': status, 'skipped': False, 'counts': counts}
+        if 'ATTEMPTS' in counts:
+            fields['canu_retries'] = counts['ATTEMPTS'] - 1
+        writeRecord(usageRecord(name, start, **fields))
+    if status == 0:
+        record = {'key': key, 'params': list(params), 'outputs': {o: fileDigest(o, cache) for o in outputs}}
+        writeJson(record_file, record)
+    writeJson(cache_file, cache)
+
+    return status, True
+
+
+def getArgParser():
+    """
+    Defines the ArgumentParser
+
+    Returns:
+      argparse.ArgumentParser: argument parser object.
+    """
+    parser = ArgumentParser(description=__doc__,
+                            epilog='Remove the checkpoint folder to force every stage to run again.')
+    parser.add_argument('-d', action='store', dest='check_dir', default=None,
+                        help='Checkpoint folder, e.g. PIPE/BarcodeXX/checkpoints.')
+    parser.add_argument('-n', action='store', dest='name', default=None,
+                        help='Stage name.')
+    parser.add_argument('-c', action='store', dest='command', default=None,
+                        help='Bash command line of the stage.')
+    parser.add_argument('-i', nargs='*', action='store', dest='inputs', default=[],
+                        help='Input files and folders of the stage.')
+    parser.add_argument('-p', nargs='*', action='store', dest='params', default=[],
+                        help='''Parameters changing the stage outputs, e.g. model=r941_min_high_g303;
+                             thread counts and other settings not changing the outputs are left out.''')
+    parser.add_argument('-o', nargs='*', action='store', dest='outputs', default=[],
+                        help='Output files of the stage.')
+    parser.add_argument('--defer', action='store', dest='defer_file', default=None,
+                        help='''Write the stage to this JSON file for a batch runner instead of
+                             running it, e.g. the polishing of every clone by NanoIgPolish.py.''')
+    parser.add_argument('-j', action='store', dest='job_file', default=None,
+                        help='''Run the stage of a --defer JSON file instead of -d, -n, -c, -i, -p and -o;
+                             the file is removed when the stage succeeds.''')
+
+    return parser
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and runs the stage
+    """
+    parser = getArgParser()
+    args = parser.parse_args()
+    if args.job_file is not None:
+        job = readJson(args.job_file, None)
+        if job is None:
+            parser.error('cannot read %s' % args.job_file)
+        status, ran = runStage(job['check_dir'], job['name'], job['command'], inputs=job['inputs'],
+                               params=job['params'], outputs=job['outputs'])
+        if status == 0:
+            os.remove(args.job_file)
+        sys.stderr.write('%s> %s\n' % ('RUN' if ran else 'SKIP', job['name']))
+        sys.exit(status)
+    if None in (args.check_dir, args.name, args.command):
+        parser.error('-d, -n and -c are required without -j')
+
+    status, ran = runStage(args.check_dir, args.name, args.command, inputs=args.inputs, params=args.params,
+                           outputs=args.outputs, defer_file=args.defer_file)
+    deferred = not ran and args.defer_file is not None and os.path.exists(args.defer_file)
+    sys.stderr.write('%s> %s\n' % ('RUN' if ran else 'DEFER' if deferred else 'SKIP', args.name))
+    sys.exit(status)
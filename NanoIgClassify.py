@@ -0,0 +1,234 @@
+#!/usr/bin/python
+"""
+Assigns reads to VH genes by minimizer votes, writing the same coverage files as NanoIgCov.py without aligning to chr14
+"""
+
+# Imports
+import hashlib
+import os
+import pickle
+import sys
+from argparse import ArgumentParser
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+# NanoIg imports
+from NanoIgAlign import reverseComplement
+from NanoIgAnnot import default_bed_file, default_chrom_file, minimizers
+from NanoIgCov import readBed, writeCoverage
+from NanoIgIO import fastq_ext, readFasta, readFastq
+
+default_cache_dir = os.environ.get('NANOIG_INDEX_CACHE',
+                                   os.path.join(os.path.expanduser('~'), '.cache', 'nanoig', 'index'))
+
+# Reads classified per worker task
+default_block_size = 2000
+
+# Index of the worker processes, set by loadWorker
+_worker_index = None
+
+
+def buildIndex(chrom_file, bed_file, k=15, w=10):
+    """
+    Builds the minimizer index of the VH gene intervals
+
+    Both strands of every interval are indexed, so reads of either orientation vote.
+
+    Arguments:
+      chrom_file : IGH locus FASTA file.
+      bed_file : VH gene intervals of chrom_file.
+      k : k-mer length.
+      w : minimizer window.
+
+    Returns:
+      dict: {'k': k, 'w': w, 'table': {minimizer hash: tuple of BED indices}}.
+    """
+    chroms = {h.split()[0]: s.upper() for h, s in readFasta(chrom_file)}
+    table = {}
+    for i, (chrom, start, end, name, line) in enumerate(readBed(bed_file)):
+        seq = chroms[chrom][start:end]
+        for strand in (seq, reverseComplement(seq)):
+            for h, pos in minimizers(strand, k, w):
+                hits = table.get(h, ())
+                if i not in hits:
+                    table[h] = hits + (i,)
+
+    return {'k': k, 'w': w, 'table': table}
+
+
+def indexFile(chrom_file, bed_file, k=15, w=10, cache_dir=default_cache_dir):
+    """
+    Returns the cached index file of a locus, building it if missing
+
+    Arguments:
+      chrom_file : IGH locus FASTA file.
+      bed_file : VH gene intervals of chrom_file.
+      k : k-mer length.
+      w : minimizer window.
+      cache_dir : index cache folder.
+
+    Returns:
+      str: pickle file name, keyed by the content of both files and k, w.
+    """
+    h = hashlib.sha256(('%i\t%i\n' % (k, w)).encode())
+    for name in (chrom_file, bed_file):
+        with open(name, 'rb') as f:
+            h.update(hashlib.sha256(f.read()).digest())
+    name = os.path.join(cache_dir, '%s.pickle' % h.hexdigest())
+    if not os.path.exists(name):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = '%s.%i' % (name, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(buildIndex(chrom_file, bed_file, k=k, w=w), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, name)
+
+    return name
+
+
+def loadWorker(index_file):
+    """
+    Loads the index of a worker process
+
+    Arguments:
+      index_file : pickle file written by indexFile.
+
+    Returns:
+      None
+    """
+    global _worker_index
+    with open(index_file, 'rb') as f:
+        _worker_index = pickle.load(f)
+
+
+def classifyRead(seq, index, min_hits=4):
+    """
+    Assigns a read to the VH genes sharing the most minimizers with it
+
+    Arguments:
+      seq : read sequence.
+      index : index dictionary as returned by buildIndex.
+      min_hits : minimum number of shared minimizers.
+
+    Returns:
+      tuple: BED indices of the equally best genes; empty if none reaches min_hits.
+    """
+    table, votes = index['table'], Counter()
+    for h, pos in minimizers(seq.upper(), index['k'], index['w']):
+        votes.update(table.get(h, ()))
+    if not votes:
+        return ()
+    best = max(votes.values())
+    if best < min_hits:
+        return ()
+
+    return tuple(sorted(i for i, v in votes.items() if v == best))
+
+
+def classifyBlock(block, min_hits=4):
+    """
+    Classifies a block of reads with the worker index
+
+    Arguments:
+      block : list of (read ID, sequence) tuples.
+      min_hits : minimum number of shared minimizers.
+
+    Returns:
+      list: (read ID, tuple of BED indices) tuples.
+    """
+    return [(read_id, classifyRead(seq, _worker_index, min_hits=min_hits)) for read_id, seq in block]
+
+
+def classifyReads(records, index_file, nproc=1, min_hits=4, block_size=default_block_size):
+    """
+    Classifies reads in blocks across a process pool
+
+    Arguments:
+      records : iterable of (read ID, sequence) tuples.
+      index_file : pickle file written by indexFile.
+      nproc : number of worker processes; 1 classifies in this process.
+      min_hits : minimum number of shared minimizers.
+      block_size : reads per task.
+
+    Returns:
+      generator: (read ID, tuple of BED indices) tuples in input order.
+    """
+    records = iter(records)
+    blocks = iter(lambda: list(islice(records, block_size)), [])
+    if nproc <= 1:
+        loadWorker(index_file)
+        for block in blocks:
+            yield from classifyBlock(block, min_hits=min_hits)
+        return
+
+    # Keep a bounded number of blocks in flight to stream large inputs
+    with ProcessPoolExecutor(max_workers=nproc, initializer=loadWorker, initargs=(index_file,)) as pool:
+        pending = []
+        for block in blocks:
+            pending.append(pool.submit(classifyBlock, block, min_hits))
+            if len(pending) >= 2 * nproc:
+                yield from pending.pop(0).result()
+        for future in pending:
+            yield from future.result()
+
+
+def getArgParser():
+    """
+    Defines the ArgumentParser
+
+    Returns:
+      argparse.ArgumentParser: argument parser object.
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-o', action='store', dest='out_dir', required=True,
+                        help='Output folder for coverage.bed, Clonal_candidate.bed and reads.tsv.')
+    parser.add_argument('-s', action='store', dest='seq_file', default=None,
+                        help='FASTA or FASTQ read file; FASTA on standard input if not given.')
+    parser.add_argument('-r', action='store', dest='chrom_file', default=default_chrom_file,
+                        help='IGH locus FASTA file.')
+    parser.add_argument('-b', action='store', dest='bed_file', default=default_bed_file,
+                        help='BED file of the VH gene intervals.')
+    parser.add_argument('-c', action='store', dest='min_count', type=int, default=500,
+                        help='Minimum read count of a clonal candidate gene.')
+    parser.add_argument('-k', action='store', dest='k', type=int, default=15,
+                        help='Minimizer k-mer length.')
+    parser.add_argument('-w', action='store', dest='w', type=int, default=10,
+                        help='Minimizer window.')
+    parser.add_argument('--hits', action='store', dest='min_hits', type=int, default=4,
+                        help='Minimum number of minimizers a read shares with its gene.')
+    parser.add_argument('--cache', action='store', dest='cache_dir', default=default_cache_dir,
+                        help='Index cache folder.')
+    parser.add_argument('--nproc', action='store', dest='nproc', type=int, default=1,
+                        help='Number of classifier processes.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and counts coverage
+    """
+    args = getArgParser().parse_args()
+
+    bed = readBed(args.bed_file)
+    index_file = indexFile(args.chrom_file, args.bed_file, k=args.k, w=args.w, cache_dir=args.cache_dir)
+    if args.seq_file is not None and args.seq_file.endswith(fastq_ext):
+        records = ((h.split(None, 1)[0], s) for h, s, q in readFastq(args.seq_file))
+    else:
+        records = ((h.split(None, 1)[0], s) for h, s in readFasta(args.seq_file or '/dev/stdin'))
+
+    counts = array('l', bytes(array('l').itemsize * len(bed)))
+    assigned, unassigned = 0, 0
+    with open(os.path.join(args.out_dir, 'reads.tsv'), 'w') as reads:
+        for read_id, hits in classifyReads(records, index_file, nproc=args.nproc, min_hits=args.min_hits):
+            if hits:
+                assigned += 1
+            else:
+                unassigned += 1
+            for i in hits:
+                counts[i] += 1
+                reads.write('%s\t%s\n' % (read_id, bed[i][3]))
+
+    writeCoverage(bed, counts, args.out_dir, min_count=args.min_count)
+    sys.stderr.write('ASSIGNED> %i\nUNASSIGNED> %i\n' % (assigned, unassigned))
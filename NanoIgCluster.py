@@ -0,0 +1,378 @@
+#!/usr/bin/python
+"""
+Splits the reads of a VH gene into sub-clones by the k-mers of their CDR3/JH end that exclude each other
+"""
+
+# Imports
+import os
+import sys
+from argparse import ArgumentParser
+from collections import Counter, OrderedDict
+from itertools import combinations
+
+# NanoIg imports
+from NanoIgAlign import reverseComplement
+from NanoIgIO import readFasta, readFastq, writeFastq
+from NanoIgStore import ReadStore, readIds, writeIds
+
+# Primers shipped with NanoIg, used to orient the reads
+_package = os.path.dirname(os.path.abspath(__file__))
+default_fwd_file = os.path.join(_package, 'For_primers.fasta')
+default_rev_file = os.path.join(_package, 'Rev_primer.fasta')
+
+_base_code = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+
+
+def kmerHashes(seq, k=11):
+    """
+    Hashes the k-mers of a sequence
+
+    Arguments:
+      seq : upper case nucleotide sequence.
+      k : k-mer length, at most 31.
+
+    Returns:
+      set: 64-bit hashes of the distinct k-mers; k-mers with ambiguous bases are skipped.
+    """
+    mask = (1 << (2 * k)) - 1
+    hashes = set()
+    value, valid = 0, 0
+    for c in seq:
+        code = _base_code.get(c)
+        if code is None:
+            valid = 0
+            continue
+        value = ((value << 2) | code) & mask
+        valid += 1
+        if valid >= k:
+            # Same integer mix as the NanoIgAnnot.py minimizers
+            h = (value * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+            hashes.add(h ^ (h >> 29))
+
+    return hashes
+
+
+def primerKmers(primers, k=8):
+    """
+    Collects the k-mers of primer sequences
+
+    Arguments:
+      primers : iterable of primer sequences.
+      k : k-mer length.
+
+    Returns:
+      dict: {primer k-mer: number of bases from the k-mer start to the primer end}.
+    """
+    return {p[i:i + k]: len(p) - i for p in primers for i in range(len(p) - k + 1)}
+
+
+def orientRead(seq, fwd_kmers, rev_kmers, k=8, window=60):
+    """
+    Orients a read from FR1 to JH and finds the end of its JH primer
+
+    Arguments:
+      seq : read sequence.
+      fwd_kmers : FR1 primer k-mers.
+      rev_kmers : k-mers of the reverse complemented JH primers, as returned by primerKmers.
+      k : primer k-mer length.
+      window : number of bases at each read end searched for primer k-mers.
+
+    Returns:
+      tuple: (oriented sequence, JH primer end, the median of the ends given by
+             its k-mers, or the read length).
+    """
+    def score(s):
+        head, tail = s[:window], s[-window:]
+        return sum(head[i:i + k] in fwd_kmers for i in range(len(head) - k + 1)) + \
+            sum(tail[i:i + k] in rev_kmers for i in range(len(tail) - k + 1))
+
+    rc = reverseComplement(seq)
+    if score(rc) > score(seq):
+        seq = rc
+    start = max(0, len(seq) - window)
+    ends = sorted(start + i + rev_kmers[seq[start + i:start + i + k]] for i in range(len(seq) - start - k + 1)
+                  if seq[start + i:start + i + k] in rev_kmers)
+
+    return seq, min(len(seq), ends[len(ends) // 2]) if ends else len(seq)
+
+
+def _popcount(bits):
+    """
+    Returns the number of set bits of an integer
+    """
+    return bin(bits).count('1')
+
+
+def _bitset(indices, n):
+    """
+    Returns the integer whose bits are set at the given read numbers
+    """
+    bits = bytearray((n + 7) // 8)
+    for i in indices:
+        bits[i >> 3] |= 1 << (i & 7)
+
+    return int.from_bytes(bits, 'little')
+
+
+def _assign(reads, signatures, min_score):
+    """
+    Assigns every read to the signature it holds the largest fraction of, if at least min_score
+    """
+    clusters = [[] for s in signatures]
+    for i, hashes in enumerate(reads):
+        scores = [len(hashes & s) / len(s) for s in signatures]
+        if scores and max(scores) >= min_score:
+            clusters[scores.index(max(scores))].append(i)
+
+    return clusters
+
+
+def clusterReads(seqs, fwd_primers, rev_primers, k=11, tail=100, skip=36, pad=50, min_reads=50, min_frac=0.1,
+                 exclusion=0.2, min_signature=15, min_score=0.1, assign_k=8, rounds=2, assign_all=False):
+    """
+    Groups the reads of a VH gene by the k-mers of their CDR3 end
+
+    Reads are oriented on the primers and the k-mers from tail to skip bases
+    before the end of the JH primer are used, if found in enough reads to be
+    sequence rather than error k-mers; the reads holding each are kept as a
+    bitset. Two sub-clones differ by k-mers that exclude each other, found
+    together in far fewer reads than their counts predict, while the k-mers of
+    polyclonal reads are too rare to be used. The k-mers excluding many others
+    are grouped, largest exclusion first, with those found together with them
+    in clearly more reads than their counts predict and excluding no k-mer of
+    the group. Groups whose k-mers are associated are one sub-clone split on
+    errors and are merged; groups excluding no other group hold k-mers shared
+    by the sub-clones, e.g. error variants of the germline, and are dropped.
+    Every read then goes to the group it holds most of, and the signature of
+    every sub-clone is refined on the shorter k-mers its reads hold and those
+    of the other sub-clones lack.
+
+    The split holds for sub-clones of at least 15% and 150 reads of the gene,
+    up to 5000 reads, with up to 60% polyclonal reads, as checked by
+    NanoIgBench.py --subclones; smaller sub-clones are left in the larger ones.
+
+    Arguments:
+      seqs : list of read sequences.
+      fwd_primers : FR1 primer sequences.
+      rev_primers : JH primer sequences, as listed in Rev_primer.fasta.
+      k : k-mer length.
+      tail : start of the used bases, counted back from the JH primer end.
+      skip : end of the used bases, counted back from the JH primer end; the
+             JH primer and FR4 are shared by the sub-clones.
+      pad : the k-mers a read holds are looked up from pad bases before
+            tail to the JH primer end, so indels do not move them out.
+      min_reads : minimum number of reads of a sub-clone.
+      min_frac : minimum fraction of the reads of a sub-clone.
+      exclusion : two k-mers exclude each other if found together in at most
+                  this fraction of the reads their counts predict; a signature
+                  k-mer is held by the reads of the other sub-clones at most
+                  at this fraction of its rate in its own reads.
+      min_signature : minimum number of k-mers of a group, and twice the
+                      minimum number of k-mers of a refined signature.
+      min_score : minimum fraction of a signature held by its reads, and
+                  minimum rate of a refined signature k-mer in its reads.
+      assign_k : length of the refined signature k-mers.
+      rounds : number of signature refinement rounds.
+      assign_all : if True the reads of no sub-clone are assigned to the one
+                   whose signature they share most.
+
+    Returns:
+      list: lists of indices into seqs, one per sub-clone, largest first,
+            reads of no sub-clone left out unless assign_all is set; a single
+            list of every read if the gene has one sub-clone.
+    """
+    fwd_kmers = primerKmers(fwd_primers)
+    rev_kmers = primerKmers(reverseComplement(p) for p in rev_primers)
+    reads, padded, short = [], [], []
+    for seq in seqs:
+        seq, end = orientRead(seq, fwd_kmers, rev_kmers)
+        window = seq[max(0, end - tail - pad):end]
+        reads.append(kmerHashes(seq[max(0, end - tail):max(0, end - skip)], k=k))
+        padded.append(kmerHashes(window, k=k))
+        short.append(kmerHashes(window, k=assign_k))
+    n = len(reads)
+    min_size = max(min_reads, min_frac * n)
+
+    # Solid k-mers: a sub-clone of min_frac of the reads holds its k-mers in
+    # a good part of its reads, while error k-mers are rarely shared
+    counts = Counter()
+    for hashes in reads:
+        counts.update(hashes)
+    solid_count = max(2, min_frac * n / 4)
+    solid = [h for h, c in counts.most_common() if c >= solid_count]
+    held = {h: [] for h in solid}
+    reads = [{h for h in hashes if h in held} for hashes in padded]
+    del padded
+    for i, hashes in enumerate(reads):
+        for h in hashes:
+            held[h].append(i)
+    bits = {h: _bitset(m, n) for h, m in held.items()}
+    count = {h: len(m) for h, m in held.items()}
+
+    # Pairs expected together in fewer than 3 reads tell nothing
+    def expected(a, b):
+        return count[a] * count[b] / n
+
+    def observed(a, b):
+        return _popcount(bits[a] & bits[b])
+
+    def associated(a, b):
+        e, o = expected(a, b), observed(a, b)
+        return o >= 3 and o >= 1.5 * e and o - e >= 3 * e ** 0.5
+
+    excludes = {h: set() for h in solid}
+    for x, a in enumerate(solid):
+        for b in solid[x + 1:]:
+            e = expected(a, b)
+            if e >= 3 and observed(a, b) <= exclusion * e:
+                excludes[a].add(b)
+                excludes[b].add(a)
+    variable = sorted((h for h in solid if len(excludes[h]) >= min_signature), key=lambda h: len(excludes[h]),
+                      reverse=True)
+
+    # Group the variable k-mers around those excluding most others
+    groups, grouped = [], set()
+    for v in variable:
+        if v in grouped:
+            continue
+        group = [v]
+        for u in variable:
+            if u not in grouped and u != v and associated(u, v) and not excludes[u].intersection(group):
+                group.append(u)
+        if len(group) >= min_signature:
+            grouped.update(group)
+            groups.append(set(group))
+
+    def share(a, b, test):
+        return sum(test(u, v) for u in a for v in b) / (len(a) * len(b))
+
+    # Merge the groups of one sub-clone, split on errors, then drop the groups of shared k-mers
+    merged = True
+    while merged:
+        merged = False
+        for a, b in combinations(range(len(groups)), 2):
+            if share(groups[a], groups[b], associated) >= 0.5:
+                groups[a] |= groups.pop(b)
+                merged = True
+                break
+    groups = [g for g in groups
+              if any(share(g, h, lambda u, v: v in excludes[u]) >= 0.5 for h in groups if h is not g)]
+
+    # Refine the signatures: the short k-mers held by min_score of the reads of a
+    # sub-clone and at most at exclusion times that rate by the reads of the others
+    signatures, sets = groups, reads
+    clusters = _assign(sets, signatures, min_score)
+    for r in range(rounds):
+        rates = []
+        for m in clusters:
+            counts = Counter()
+            for i in m:
+                counts.update(short[i])
+            rates.append({h: c / len(m) for h, c in counts.items()})
+        signatures = []
+        for c, rate in enumerate(rates):
+            others = [q for d, q in enumerate(rates) if d != c]
+            signatures.append({h for h, f in rate.items()
+                               if f >= min_score and all(q.get(h, 0) <= exclusion * f for q in others)})
+        signatures, sets = [s for s in signatures if len(s) >= min_signature / 2], short
+        clusters = _assign(sets, signatures, min_score)
+
+    kept = sorted(((m, s) for m, s in zip(clusters, signatures) if len(m) >= min_size),
+                  key=lambda x: len(x[0]), reverse=True)
+    if len(kept) < 2:
+        return [list(range(n))] if n >= min_size else []
+    clusters, signatures = [m for m, s in kept], [s for m, s in kept]
+
+    # Reads of no sub-clone go to the signature they share most, the largest sub-clone on a tie
+    if assign_all:
+        assigned = set().union(*clusters)
+        for i, hashes in enumerate(sets):
+            if i not in assigned:
+                scores = [len(hashes & s) / len(s) for s in signatures]
+                clusters[scores.index(max(scores))].append(i)
+
+    return sorted((sorted(m) for m in clusters), key=len, reverse=True)
+
+
+def cloneNames(gene, clusters):
+    """
+    Names the sub-clones of a VH gene
+
+    Arguments:
+      gene : VH gene name.
+      clusters : sub-clone read lists, largest first.
+
+    Returns:
+      list: gene for the largest sub-clone, then gene.2, gene.3 and so on.
+    """
+    return [gene if c == 0 else '%s.%i' % (gene, c + 1) for c in range(len(clusters))]
+
+
+def getArgParser():
+    """
+    Defines the ArgumentParser
+
+    Returns:
+      argparse.ArgumentParser: argument parser object.
+    """
+    parser = ArgumentParser(description=__doc__,
+                            epilog='''NanoIgPipe.py splits every candidate gene this way before sampling;
+                                   sub-clones are written as <prefix>.1, <prefix>.2, largest first.''')
+    parser.add_argument('-s', action='store', dest='seq_file', required=True,
+                        help='Input FASTQ file, or read number list with --store.')
+    parser.add_argument('-o', action='store', dest='out_prefix', required=True,
+                        help='Output prefix of the sub-clone FASTQ files, or read number lists with --store.')
+    parser.add_argument('--store', action='store', dest='store', default=None,
+                        help='Read store the read numbers refer to, see NanoIgStore.py.')
+    parser.add_argument('--fwd', action='store', dest='fwd_file', default=default_fwd_file,
+                        help='FR1 primer FASTA file.')
+    parser.add_argument('--rev', action='store', dest='rev_file', default=default_rev_file,
+                        help='JH primer FASTA file.')
+    parser.add_argument('-n', action='store', dest='min_reads', type=int, default=50,
+                        help='Minimum number of reads of a sub-clone.')
+    parser.add_argument('-f', action='store', dest='min_frac', type=float, default=0.1,
+                        help='Minimum fraction of the reads of a sub-clone.')
+    parser.add_argument('--all', action='store_true', dest='assign_all',
+                        help='Assign the reads of no sub-clone to the nearest one, as NanoIgPipe.py does.')
+    parser.add_argument('--log', action='store', dest='log_file', default=None,
+                        help='File receiving the sub-clone counts.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and clusters reads
+    """
+    args = getArgParser().parse_args()
+
+    fwd_primers = [s.upper() for h, s in readFasta(args.fwd_file)]
+    rev_primers = [s.upper() for h, s in readFasta(args.rev_file)]
+    if args.store:
+        store = ReadStore(args.store)
+        reads = readIds(args.seq_file)
+        seqs = [store.sequence(i) for i in reads]
+    else:
+        reads = list(readFastq(args.seq_file))
+        seqs = [r[1] for r in reads]
+    clusters = clusterReads(seqs, fwd_primers, rev_primers, min_reads=args.min_reads, min_frac=args.min_frac,
+                            assign_all=args.assign_all)
+
+    stats = OrderedDict([('IN', len(seqs)), ('CLUSTERS', len(clusters))])
+    for c, m in enumerate(clusters, start=1):
+        stats['CLUSTER%i' % c] = len(m)
+        if args.store:
+            writeIds('%s.%i.ids' % (args.out_prefix, c), (reads[i] for i in m))
+        else:
+            with open('%s.%i.fastq' % (args.out_prefix, c), 'w') as out:
+                for i in m:
+                    writeFastq(out, reads[i])
+    stats['UNASSIGNED'] = len(seqs) - sum(len(m) for m in clusters)
+    if args.store:
+        store.close()
+
+    log = '\n'.join('%s> %s' % (k, v) for k, v in stats.items()) + '\n'
+    sys.stderr.write(log)
+    if args.log_file:
+        with open(args.log_file, 'w') as f:
+            f.write(log)
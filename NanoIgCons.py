@@ -0,0 +1,239 @@
+#!/usr/bin/python
+"""
+Builds a draft amplicon consensus from clone reads anchored on the FR1 and JH primers
+"""
+
+# Imports
+import os
+import sys
+from argparse import ArgumentParser
+from collections import Counter, OrderedDict
+
+# NanoIg imports
+from NanoIgAlign import alignBatch, encodeBatch, encodeSeq, reverseComplement
+from NanoIgIO import meanQuality, readFasta, readFastq, writeFasta
+
+# Nucleotides indexed by alignment code
+_bases = 'ACGTN'
+
+
+def readPrimers(primer_file):
+    """
+    Reads a primer FASTA file
+
+    Arguments:
+      primer_file : FASTA file of primer sequences.
+
+    Returns:
+      collections.OrderedDict: {primer name: upper case sequence}.
+    """
+    return OrderedDict((h.strip(), s.upper()) for h, s in readFasta(primer_file))
+
+
+def _bestPrimer(windows, primers, min_score):
+    """
+    Finds the best primer match in each window
+
+    Returns:
+      list: (score, start, end) per window, or None where no primer reaches min_score.
+    """
+    codes, lengths = encodeBatch(windows)
+    best = [None] * len(windows)
+    for primer in primers:
+        hits = alignBatch(encodeSeq(primer), codes, lengths, seq_start_free=True, seq_end_free=True,
+                          traceback=False)
+        for r, hit in enumerate(hits):
+            score, end = hit[0], hit[4]
+            if score >= min_score * len(primer) and (best[r] is None or score > best[r][0]):
+                best[r] = (score, max(0, end - len(primer)), end)
+
+    return best
+
+
+def anchorReads(records, fwd_primers, rev_primers, window=100, min_score=0.4, chunk=2000):
+    """
+    Orients reads on the FR1 primer and trims them to the FR1-JH primer span
+
+    Arguments:
+      records : list of (header, sequence, quality) tuples.
+      fwd_primers : FR1 primer sequences.
+      rev_primers : JH primer sequences, as listed in Rev_primer.fasta.
+      window : number of bases at each read end searched for primers.
+      min_score : minimum alignment score per primer base for a primer match.
+      chunk : number of reads aligned per batch.
+
+    Returns:
+      list: trimmed (sequence, quality) tuples in forward orientation.
+    """
+    rev_primers = [reverseComplement(p) for p in rev_primers]
+    anchored = []
+    for c in range(0, len(records), chunk):
+        block = records[c:c + chunk]
+        fwd = [r[1].upper() for r in block]
+        rc = [reverseComplement(s) for s in fwd]
+        fwd_hits = _bestPrimer([s[:window] for s in fwd], fwd_primers, min_score)
+        rc_hits = _bestPrimer([s[:window] for s in rc], fwd_primers, min_score)
+
+        oriented = []
+        for k, record in enumerate(block):
+            f, r = fwd_hits[k], rc_hits[k]
+            if f is None and r is None:
+                continue
+            if r is None or (f is not None and f[0] >= r[0]):
+                oriented.append((fwd[k], record[2], f[1]))
+            else:
+                oriented.append((rc[k], record[2][::-1], r[1]))
+
+        tails = [s[max(start, len(s) - window):] for s, q, start in oriented]
+        tail_hits = _bestPrimer(tails, rev_primers, min_score)
+        for (seq, qual, start), tail, hit in zip(oriented, tails, tail_hits):
+            if hit is None:
+                continue
+            end = len(seq) - len(tail) + hit[2]
+            if end > start:
+                anchored.append((seq[start:end], qual[start:end]))
+
+    return anchored
+
+
+def pickBackbone(reads):
+    """
+    Selects the initial consensus backbone
+
+    Arguments:
+      reads : list of (sequence, quality) tuples.
+
+    Returns:
+      str: the highest mean quality read among the reads of the modal length.
+    """
+    mode = Counter(len(s) for s, q in reads).most_common(1)[0][0]
+    best = max((r for r in reads if len(r[0]) == mode), key=lambda r: meanQuality(r[1]))
+
+    return best[0]
+
+
+def pileupConsensus(backbone, seqs, chunk=500):
+    """
+    Calls a majority consensus of reads globally aligned to a backbone
+
+    Arguments:
+      backbone : current consensus sequence.
+      seqs : list of read sequences.
+      chunk : number of reads aligned per batch.
+
+    Returns:
+      str: consensus sequence.
+    """
+    n = len(backbone)
+    counts = [[0] * 5 for _ in range(n)]
+    inserts = [[] for _ in range(n + 1)]
+    ref = encodeSeq(backbone)
+    for c in range(0, len(seqs), chunk):
+        block = seqs[c:c + chunk]
+        codes, lengths = encodeBatch(block)
+        for seq, hit in zip(block, alignBatch(ref, codes, lengths)):
+            i, j, k = hit[1], hit[2], 0
+            for op in hit[5]:
+                if op == 'M':
+                    base = 'ACGT'.find(seq[j])
+                    if base >= 0:
+                        counts[i][base] += 1
+                    i, j, k = i + 1, j + 1, 0
+                elif op == 'D':
+                    counts[i][4] += 1
+                    i, k = i + 1, 0
+                else:
+                    slots = inserts[i]
+                    if k == len(slots):
+                        slots.append(Counter())
+                    slots[k][seq[j]] += 1
+                    j, k = j + 1, k + 1
+
+    # Majority vote over bases, deletions and inserted bases
+    half = len(seqs) / 2.0
+    consensus = []
+    for i in range(n + 1):
+        for slot in inserts[i]:
+            if sum(slot.values()) > half:
+                consensus.append(slot.most_common(1)[0][0])
+        if i < n:
+            best = max(range(4), key=counts[i].__getitem__)
+            if counts[i][4] <= counts[i][best]:
+                consensus.append(_bases[best] if counts[i][best] else backbone[i])
+
+    return ''.join(consensus)
+
+
+def buildConsensus(records, fwd_primers, rev_primers, rounds=2, min_reads=21, window=100):
+    """
+    Builds the draft consensus of one clone
+
+    Arguments:
+      records : list of (header, sequence, quality) tuples.
+      fwd_primers : FR1 primer sequences.
+      rev_primers : JH primer sequences.
+      rounds : number of realignment rounds.
+      min_reads : minimum number of primer anchored reads.
+      window : number of bases at each read end searched for primers.
+
+    Returns:
+      tuple: (consensus sequence or None, number of anchored reads).
+    """
+    reads = anchorReads(records, fwd_primers, rev_primers, window=window)
+    if len(reads) < min_reads:
+        return None, len(reads)
+    consensus = pickBackbone(reads)
+    seqs = [s for s, q in reads]
+    for _ in range(rounds):
+        consensus = pileupConsensus(consensus, seqs)
+
+    return consensus, len(reads)
+
+
+def getArgParser():
+    """
+    Defines the ArgumentParser
+
+    Returns:
+      argparse.ArgumentParser: argument parser object.
+    """
+    parser = ArgumentParser(description=__doc__,
+                            epilog='Exits with status 2 if the clone cannot be resolved, so canu can be used instead.')
+    parser.add_argument('-s', action='store', dest='seq_file', required=True,
+                        help='Filtered clone reads in FASTQ format.')
+    parser.add_argument('-o', action='store', dest='out_file', required=True,
+                        help='Output FASTA file, used in place of Filtered_contigs.fasta.')
+    parser.add_argument('--fwd', action='store', dest='fwd_file', required=True,
+                        help='FR1 primer FASTA file.')
+    parser.add_argument('--rev', action='store', dest='rev_file', required=True,
+                        help='JH primer FASTA file.')
+    parser.add_argument('--minreads', action='store', dest='min_reads', type=int, default=21,
+                        help='Minimum number of primer anchored reads.')
+    parser.add_argument('--rounds', action='store', dest='rounds', type=int, default=2,
+                        help='Number of realignment rounds.')
+    parser.add_argument('-m', action='store', dest='min_len', type=int, default=200,
+                        help='Minimum consensus length.')
+    parser.add_argument('-M', action='store', dest='max_len', type=int, default=350,
+                        help='Maximum consensus length.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and writes the draft consensus
+    """
+    args = getArgParser().parse_args()
+
+    records = list(readFastq(args.seq_file))
+    consensus, n = buildConsensus(records, list(readPrimers(args.fwd_file).values()),
+                                  list(readPrimers(args.rev_file).values()),
+                                  rounds=args.rounds, min_reads=args.min_reads)
+    if consensus is None or not args.min_len <= len(consensus) <= args.max_len:
+        sys.stderr.write('Fast consensus unresolved for %s: %i anchored reads\n' % (args.seq_file, n))
+        sys.exit(2)
+
+    out_dir = os.path.dirname(os.path.abspath(args.out_file))
+    os.makedirs(out_dir, exist_ok=True)
+    with open(args.out_file, 'w') as out:
+        writeFasta(out, ('fast_consensus len=%i reads=%i' % (len(consensus), n), consensus))
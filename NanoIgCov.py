@@ -0,0 +1,210 @@
+#!/usr/bin/python
+"""
+Counts VH gene coverage and clonal candidates directly from an aligner SAM stream
+"""
+
+# Imports
+import os
+import re
+import sys
+from argparse import ArgumentParser
+from array import array
+from bisect import bisect_left
+
+
+# CIGAR operations consuming reference bases
+_cigar_regex = re.compile(r'(\d+)([MIDNSHP=X])')
+_ref_ops = frozenset('MDN=X')
+
+# SAM flags excluded from the counts: unmapped, secondary and supplementary
+_skip_flags = 0x4 | 0x100 | 0x800
+
+
+def readBed(bed_file):
+    """
+    Reads the intervals of a BED file
+
+    Arguments:
+      bed_file : BED file name.
+
+    Returns:
+      list: (chrom, start, end, name, line) tuples in file order.
+    """
+    bed = []
+    with open(bed_file) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 4 or line.startswith(('#', 'track', 'browser')):
+                continue
+            bed.append((fields[0], int(fields[1]), int(fields[2]), fields[3].strip(), line.rstrip('\n')))
+
+    return bed
+
+
+class IntervalIndex:
+    """
+    Array backed overlap index over BED intervals
+
+    Attributes:
+      chroms : dictionary of {chrom: (starts, ends, max_ends, ids)} arrays
+               sorted by interval start; max_ends holds the running maximum end.
+    """
+    def __init__(self, bed):
+        """
+        Builds the index
+
+        Arguments:
+          bed : list of (chrom, start, end, ...) tuples as returned by readBed.
+        """
+        self.chroms = {}
+        by_chrom = {}
+        for i, interval in enumerate(bed):
+            by_chrom.setdefault(interval[0], []).append((interval[1], interval[2], i))
+        for chrom, intervals in by_chrom.items():
+            intervals.sort()
+            starts, ends, max_ends, ids = array('l'), array('l'), array('l'), array('l')
+            running = -1
+            for start, end, i in intervals:
+                running = max(running, end)
+                starts.append(start)
+                ends.append(end)
+                max_ends.append(running)
+                ids.append(i)
+            self.chroms[chrom] = (starts, ends, max_ends, ids)
+
+    def query(self, chrom, start, end):
+        """
+        Finds the intervals overlapping a half-open range
+
+        Arguments:
+          chrom : reference name.
+          start : 0-based range start.
+          end : 0-based exclusive range end.
+
+        Returns:
+          list: BED indices of the overlapping intervals.
+        """
+        if chrom not in self.chroms:
+            return []
+        starts, ends, max_ends, ids = self.chroms[chrom]
+        hits = []
+        k = bisect_left(starts, end) - 1
+        while k >= 0 and max_ends[k] > start:
+            if ends[k] > start:
+                hits.append(ids[k])
+            k -= 1
+
+        return hits
+
+
+def alignmentEnd(pos, cigar):
+    """
+    Calculates the reference end of an alignment
+
+    Arguments:
+      pos : 0-based alignment start.
+      cigar : CIGAR string.
+
+    Returns:
+      int: 0-based exclusive alignment end.
+    """
+    for length, op in _cigar_regex.findall(cigar):
+        if op in _ref_ops:
+            pos += int(length)
+
+    return pos
+
+
+def countSam(handle, index, n, assign=None):
+    """
+    Counts primary alignments of a SAM stream per interval
+
+    Arguments:
+      handle : SAM input handle.
+      index : IntervalIndex object.
+      n : number of indexed intervals.
+      assign : optional callback receiving (read ID, interval list) for every
+               read overlapping at least one interval.
+
+    Returns:
+      array: read count per BED index.
+    """
+    counts = array('l', bytes(array('l').itemsize * n))
+    for line in handle:
+        if line.startswith('@'):
+            continue
+        fields = line.split('\t', 6)
+        if int(fields[1]) & _skip_flags or fields[5] == '*':
+            continue
+        start = int(fields[3]) - 1
+        hits = index.query(fields[2], start, alignmentEnd(start, fields[5]))
+        for i in hits:
+            counts[i] += 1
+        if hits and assign is not None:
+            assign(fields[0], hits)
+
+    return counts
+
+
+def writeCoverage(bed, counts, out_dir, min_count=500):
+    """
+    Writes coverage.bed and Clonal_candidate.bed
+
+    Arguments:
+      bed : list of intervals as returned by readBed.
+      counts : read count per BED index.
+      out_dir : output folder.
+      min_count : minimum read count of a clonal candidate gene.
+
+    Returns:
+      list: names of the clonal candidate genes.
+    """
+    candidates = []
+    with open(os.path.join(out_dir, 'coverage.bed'), 'w') as cov, \
+         open(os.path.join(out_dir, 'Clonal_candidate.bed'), 'w') as clone:
+        for interval, count in zip(bed, counts):
+            line = '%s\t%i\n' % (interval[4], count)
+            cov.write(line)
+            if count >= min_count:
+                clone.write(line)
+                candidates.append(interval[3])
+
+    return candidates
+
+
+def getArgParser():
+    """
+    Defines the ArgumentParser
+
+    Returns:
+      argparse.ArgumentParser: argument parser object.
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-b', action='store', dest='bed_file', required=True,
+                        help='BED file of the VH gene intervals.')
+    parser.add_argument('-o', action='store', dest='out_dir', required=True,
+                        help='Output folder for coverage.bed, Clonal_candidate.bed and reads.tsv.')
+    parser.add_argument('-s', action='store', dest='sam_file', default=None,
+                        help='SAM input file; defaults to standard input.')
+    parser.add_argument('-c', action='store', dest='min_count', type=int, default=500,
+                        help='Minimum read count of a clonal candidate gene.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and counts coverage
+    """
+    args = getArgParser().parse_args()
+
+    bed = readBed(args.bed_file)
+    names = [interval[3] for interval in bed]
+    with open(os.path.join(args.out_dir, 'reads.tsv'), 'w') as reads:
+        def assign(read_id, hits):
+            for i in hits:
+                reads.write('%s\t%s\n' % (read_id, names[i]))
+        handle = open(args.sam_file) if args.sam_file else sys.stdin
+        counts = countSam(handle, IntervalIndex(bed), len(bed), assign=assign)
+
+    writeCoverage(bed, counts, args.out_dir, min_count=args.min_count)
@@ -0,0 +1,408 @@
+#!/usr/bin/python
+"""
+Runs barcode and clone jobs as shards of a local or Slurm/SGE backend, retrying failed shards
+"""
+
+# Imports
+import getpass
+import glob
+import hashlib
+import os
+import shlex
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+
+class Shard:
+    """
+    One job of a plate run
+
+    Attributes:
+      name : unique shard name, e.g. barcode01 or barcode01-IGHV3-23.
+      command : list of command arguments.
+      folder : folder receiving the job script, log and exit status files.
+      threads : threads used by the command.
+      stage_in : shell lines run before the command, e.g. input copies to node scratch.
+      stage_out : shell lines run after the command, e.g. output copies back.
+      attempts : number of submissions so far.
+      status : exit status of the last attempt; None while not finished.
+    """
+    def __init__(self, name, command, folder, threads=1, stage_in=(), stage_out=()):
+        """
+        Initializer
+
+        Arguments:
+          name : shard name.
+          command : list of command arguments.
+          folder : shard folder, created if missing.
+          threads : threads used by the command.
+          stage_in : shell lines run before the command.
+          stage_out : shell lines run after the command.
+        """
+        self.name, self.command, self.folder, self.threads = name, command, folder, threads
+        self.stage_in, self.stage_out = list(stage_in), list(stage_out)
+        self.attempts, self.status = 0, None
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, ext):
+        """
+        Returns the name of a shard file, e.g. path('log')
+        """
+        return os.path.join(self.folder, '%s.%s' % (self.name, ext))
+
+    def writeScript(self):
+        """
+        Writes the job script, which records the exit status of the command in the status file
+
+        Returns:
+          str: script file name.
+        """
+        status_file = self.path('status')
+        lines = ['#!/bin/bash', 'rm -f %s' % shlex.quote(status_file)] + self.stage_in + \
+                [' '.join(shlex.quote(c) for c in self.command), 'status=$?'] + self.stage_out + \
+                ['echo $status > %s' % shlex.quote(status_file), 'exit $status']
+        with open(self.path('sh'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.chmod(self.path('sh'), 0o755)
+        if os.path.exists(status_file):
+            os.remove(status_file)
+
+        return self.path('sh')
+
+    def readStatus(self):
+        """
+        Reads the exit status written by the job script
+
+        Returns:
+          int: exit status; -1 if the job ended without writing it, e.g. when killed.
+        """
+        try:
+            with open(self.path('status')) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return -1
+
+
+class LocalBackend:
+    """
+    Runs shards as processes of this machine
+
+    Attributes:
+      slots : maximum number of shards running at once.
+      jobs : {job ID: Popen object}.
+    """
+    def __init__(self, slots=1, options=''):
+        self.slots, self.jobs = slots, {}
+
+    def submit(self, shard):
+        """
+        Starts a shard
+
+        Arguments:
+          shard : Shard object.
+
+        Returns:
+          str: job ID.
+        """
+        with open(shard.path('log'), 'a') as log:
+            proc = subprocess.Popen(['bash', shard.writeScript()], stdout=log, stderr=subprocess.STDOUT)
+        self.jobs[str(proc.pid)] = proc
+
+        return str(proc.pid)
+
+    def running(self, job_ids):
+        """
+        Lists the jobs still running
+
+        Arguments:
+          job_ids : job IDs returned by submit.
+
+        Returns:
+          set: IDs of the jobs not finished.
+        """
+        return {j for j in job_ids if self.jobs[j].poll() is None}
+
+
+class SlurmBackend:
+    """
+    Submits shards to Slurm with sbatch
+
+    Attributes:
+      slots : None, the scheduler queues the shards.
+      options : additional sbatch arguments, e.g. "-p long --mem 16G".
+      status_files : {job ID: status file of its shard}.
+    """
+    def __init__(self, slots=None, options=''):
+        self.slots, self.options, self.status_files = None, shlex.split(options), {}
+
+    def submit(self, shard):
+        cmd = ['sbatch', '--parsable', '-J', 'nanoig-%s' % shard.name, '-o', shard.path('log'),
+               '-c', str(shard.threads)] + self.options + [shard.writeScript()]
+        job = subprocess.check_output(cmd, universal_newlines=True).strip().split(';')[0]
+        self.status_files[job] = shard.path('status')
+
+        return job
+
+    def _listed(self, job_ids):
+        """
+        Returns the IDs squeue lists, None if it cannot tell, e.g. when slurmctld is busy
+        """
+        proc = subprocess.run(['squeue', '-h', '-o', '%i', '-j', ','.join(job_ids)], stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode == 0:
+            return set(proc.stdout.split())
+        # squeue rejects IDs that already left the queue
+        if 'Invalid job id' in proc.stderr and len(job_ids) == 1:
+            return set()
+        return None
+
+    def running(self, job_ids):
+        """
+        Lists the jobs still running
+
+        A job is finished once its status file exists, or once squeue answered
+        without listing it; jobs squeue cannot tell about count as running.
+        """
+        jobs = [j for j in job_ids if not os.path.exists(self.status_files.get(j, ''))]
+        if not jobs:
+            return set()
+        try:
+            listed = self._listed(jobs)
+            if listed is None:
+                listed = set()
+                for j in jobs:
+                    found = self._listed([j])
+                    listed |= {j} if found is None else found
+        except OSError:
+            return set(jobs)
+
+        return listed & set(jobs)
+
+
+class SGEBackend:
+    """
+    Submits shards to Sun/Univa Grid Engine with qsub
+
+    Attributes:
+      slots : None, the scheduler queues the shards.
+      options : additional qsub arguments, e.g. "-q long.q"; the parallel
+                environment of the thread request is -pe smp unless given here.
+    """
+    def __init__(self, slots=None, options=''):
+        self.slots, self.options = None, shlex.split(options)
+
+    def submit(self, shard):
+        pe = [] if '-pe' in self.options else ['-pe', 'smp', str(shard.threads)]
+        cmd = ['qsub', '-terse', '-V', '-cwd', '-j', 'y', '-N', 'nanoig-%s' % shard.name, '-o', shard.path('log')] + \
+            pe + self.options + [shard.writeScript()]
+        return subprocess.check_output(cmd, universal_newlines=True).strip().split('.')[0]
+
+    def running(self, job_ids):
+        try:
+            out = subprocess.check_output(['qstat', '-u', getpass.getuser()], stderr=subprocess.DEVNULL,
+                                          universal_newlines=True)
+        except (OSError, subprocess.CalledProcessError):
+            return set(job_ids)
+        return {line.split()[0] for line in out.splitlines() if line.split()} & set(job_ids)
+
+
+# Backends by --exec name; a backend has slots, submit(shard) and running(job_ids)
+backends = {'local': LocalBackend, 'slurm': SlurmBackend, 'sge': SGEBackend}
+
+
+def runShards(shards, backend, retries=2, interval=10):
+    """
+    Runs shards to completion, resubmitting failed ones
+
+    Arguments:
+      shards : list of Shard objects, submitted in list order.
+      backend : backend object.
+      retries : number of resubmissions of a failed shard.
+      interval : seconds between polls of the backend.
+
+    Returns:
+      dict: {shard name: exit status of the last attempt}.
+    """
+    pending, jobs, start = list(shards), {}, {}
+    while pending or jobs:
+        while pending and (backend.slots is None or len(jobs) < backend.slots):
+            shard = pending.pop(0)
+            shard.attempts += 1
+            try:
+                job = backend.submit(shard)
+            except (OSError, subprocess.CalledProcessError) as e:
+                sys.stderr.write('SUBMIT> %s failed: %s\n' % (shard.name, e))
+                shard.status = -1
+                if shard.attempts <= retries:
+                    pending.append(shard)
+                continue
+            jobs[job], start[job] = shard, time.time()
+        if not jobs:
+            continue
+        time.sleep(interval if backend.slots is None else min(interval, 1))
+        running = backend.running(list(jobs))
+        for job in [j for j in jobs if j not in running]:
+            shard = jobs.pop(job)
+            shard.status = shard.readStatus()
+            seconds = time.time() - start.pop(job)
+            if shard.status == 0:
+                print('%s: done (%.1f s)' % (shard.name, seconds))
+            elif shard.attempts <= retries:
+                print('%s: FAILED exit %i, retry %i' % (shard.name, shard.status, shard.attempts))
+                pending.append(shard)
+            else:
+                print('%s: FAILED exit %i (%.1f s)' % (shard.name, shard.status, seconds))
+
+    return {shard.name: shard.status for shard in shards}
+
+
+def stageLines(path, barcode, stage_dir):
+    """
+    Builds the shell lines copying a barcode to node scratch and its outputs back
+
+    The scratch folder is named after a digest of the absolute data folder, so
+    it is the same on every node and the stage checkpoints, which record
+    absolute paths, stay valid whichever node runs the barcode, while two data
+    folders of the same name do not share it. The staged folders are removed
+    once the outputs are copied back.
+
+    Arguments:
+      path : data folder.
+      barcode : barcode name.
+      stage_dir : node scratch folder.
+
+    Returns:
+      tuple: (staged data folder, stage in lines, stage out lines).
+    """
+    path = os.path.abspath(path)
+    key = hashlib.sha256(path.encode()).hexdigest()[:16]
+    staged = os.path.join(stage_dir, '%s-%s' % (os.path.basename(os.path.normpath(path)), key))
+    folders = [os.path.join('fastq', barcode), os.path.join('PIPE', barcode), os.path.join('PIPE', 'Clonality', barcode)]
+    stage_in, copies = [], []
+    for folder in folders:
+        src, dst = shlex.quote(os.path.join(path, folder)), shlex.quote(os.path.join(staged, folder))
+        stage_in.append('mkdir -p %s %s && cp -a %s/. %s/' % (src, dst, src, dst))
+        if not folder.startswith('fastq'):
+            copies.append('cp -a %s/. %s/' % (dst, src))
+    copies.append('rm -rf %s' % ' '.join(shlex.quote(os.path.join(staged, folder)) for folder in folders))
+    stage_out = [' && '.join(copies)]
+
+    return staged, stage_in, stage_out
+
+
+def gatherResults(path, barcodes):
+    """
+    Concatenates the barcode Results.fasta fragments in barcode order
+
+    Arguments:
+      path : data folder.
+      barcodes : sorted barcode names.
+
+    Returns:
+      None
+    """
+    with open(os.path.join(path, 'Results.fasta'), 'w') as out:
+        for barcode in barcodes:
+            fragment = os.path.join(path, 'PIPE', barcode, 'Results.fasta')
+            if os.path.exists(fragment):
+                with open(fragment) as f:
+                    out.write(f.read())
+
+
+def runPlate(path, run, barcodes, commands, backend, threads=1, clones=False, retries=2, stage_dir=None,
+             interval=10):
+    """
+    Runs every barcode of a plate as a shard and gathers the results
+
+    With clones, the barcode shards stop every clone after its draft
+    (PipeIg.sh -d), the polishing of every clone is a shard of its own, and the
+    barcode shards are run again to mask the polished clones.
+
+    Arguments:
+      path : data folder.
+      run : NanoIg package folder.
+      barcodes : sorted barcode names.
+      commands : {barcode: PipeIg.sh argument list without thread count}.
+      backend : backend object.
+      threads : threads of every shard.
+      clones : shard the polishing of every clone.
+      retries : number of resubmissions of a failed shard.
+      stage_dir : node scratch folder the barcodes are copied to; no staging if None.
+      interval : seconds between polls of the backend.
+
+    Returns:
+      dict: {barcode: exit status}.
+    """
+    def barcodeShards(extra, tag):
+        shards = []
+        for barcode in barcodes:
+            cmd = commands[barcode] + extra + ['-t', str(threads)]
+            stage_in, stage_out = (), ()
+            if stage_dir is not None:
+                staged, stage_in, stage_out = stageLines(path, barcode, stage_dir)
+                cmd[cmd.index('-i') + 1] = staged
+            shards.append(Shard(barcode, cmd, os.path.join(path, 'PIPE', 'exec', tag), threads=threads,
+                                stage_in=stage_in, stage_out=stage_out))
+        return shards
+
+    if clones:
+        runShards(barcodeShards(['-d'], 'draft'), backend, retries=retries, interval=interval)
+        jobs = sorted(glob.glob(os.path.join(path, 'PIPE', '*', 'Assembly-*', 'polish.json')))
+        polish = [Shard(os.path.basename(os.path.dirname(job))[len('Assembly-'):],
+                        [sys.executable, os.path.join(run, 'NanoIgCheck.py'), '-j', job],
+                        os.path.join(path, 'PIPE', 'exec', 'polish'), threads=threads) for job in jobs]
+        runShards(polish, backend, retries=retries, interval=interval)
+    status = runShards(barcodeShards([], 'barcode'), backend, retries=retries, interval=interval)
+
+    with open(os.path.join(path, 'PIPE', 'barcode_status.tsv'), 'w') as f:
+        f.write('barcode\tstatus\n')
+        for barcode in barcodes:
+            f.write('%s\t%i\n' % (barcode, status[barcode]))
+    gatherResults(path, barcodes)
+
+    return status
+
+
+def getArgParser():
+    """
+    Defines the ArgumentParser
+
+    Returns:
+      argparse.ArgumentParser: argument parser object.
+    """
+    parser = ArgumentParser(description=__doc__,
+                            epilog='NanoIgset.py --exec runs the barcodes of a plate through this module.')
+    parser.add_argument('commands', help='File of shell commands, one shard per line, e.g. bashexec.txt.')
+    parser.add_argument('-e', action='store', dest='backend', choices=sorted(backends), default='local',
+                        help='Backend.')
+    parser.add_argument('-j', action='store', dest='slots', type=int, default=1,
+                        help='Shards running at once on the local backend.')
+    parser.add_argument('-t', action='store', dest='threads', type=int, default=1,
+                        help='Threads requested for every shard.')
+    parser.add_argument('-r', action='store', dest='retries', type=int, default=2,
+                        help='Number of resubmissions of a failed shard.')
+    parser.add_argument('-o', action='store', dest='options', default='',
+                        help='Additional sbatch or qsub arguments.')
+    parser.add_argument('-d', action='store', dest='folder', default='exec',
+                        help='Folder receiving the job scripts, logs and exit status files.')
+    parser.add_argument('--interval', action='store', dest='interval', type=float, default=10,
+                        help='Seconds between polls of the backend.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and runs the command file
+    """
+    args = getArgParser().parse_args()
+
+    with open(args.commands) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    shards = [Shard('shard%i' % (i + 1), ['bash', '-c', line], os.path.abspath(args.folder), threads=args.threads)
+              for i, line in enumerate(lines)]
+    backend = backends[args.backend](slots=args.slots, options=args.options)
+    status = runShards(shards, backend, retries=args.retries, interval=args.interval)
+    sys.exit(0 if all(code == 0 for code in status.values()) else 1)
@@ -0,0 +1,283 @@
+#!/usr/bin/python
+"""
+Removes duplicate read names and applies the length window in a single streaming pass
+"""
+
+# Imports
+import heapq
+import os
+import shutil
+import sys
+import tempfile
+from argparse import ArgumentParser
+from array import array
+from collections import OrderedDict
+from hashlib import blake2b
+
+# NanoIg imports
+from NanoIgIO import readFastq, readName, writeFastq
+from NanoIgStore import ReadStore, readIds, writeIds
+
+
+def nameHash(name):
+    """
+    Hashes a read name to a non-zero 64-bit integer
+
+    Arguments:
+      name : read identifier.
+
+    Returns:
+      int: 64-bit hash value.
+    """
+    return int.from_bytes(blake2b(name.encode(), digest_size=8).digest(), 'little') or 1
+
+
+class NameSet:
+    """
+    Open addressing set of 64-bit read name hashes with a memory cap
+
+    Attributes:
+      table : array of hash slots; 0 marks an empty slot.
+      size : number of stored hashes.
+      max_bytes : maximum table size in bytes; unbounded if None.
+    """
+    def __init__(self, max_bytes=None, capacity=1 << 12):
+        self.table = array('Q', bytes(8 * capacity))
+        self.size = 0
+        self.max_bytes = max_bytes
+
+    def __contains__(self, key):
+        table = self.table
+        mask = len(table) - 1
+        i = key & mask
+        while table[i]:
+            if table[i] == key:
+                return True
+            i = (i + 1) & mask
+
+        return False
+
+    def add(self, key):
+        """
+        Adds a hash to the set
+
+        Arguments:
+          key : non-zero 64-bit hash not already in the set.
+
+        Returns:
+          bool: False if the set is full under its memory cap and the hash was not added.
+        """
+        if 2 * (self.size + 1) > len(self.table):
+            if self.max_bytes is not None and 16 * len(self.table) > self.max_bytes:
+                return False
+            self._grow()
+        table = self.table
+        mask = len(table) - 1
+        i = key & mask
+        while table[i]:
+            i = (i + 1) & mask
+        table[i] = key
+        self.size += 1
+
+        return True
+
+    def _grow(self):
+        old = self.table
+        self.table = array('Q', bytes(16 * len(old)))
+        self.size = 0
+        for key in old:
+            if key:
+                self.add(key)
+
+
+def _lengthFilter(record, min_len, max_len, stats):
+    if max_len is not None and len(record[1]) > max_len:
+        stats['LONG'] += 1
+        return False
+    if len(record[1]) < min_len:
+        stats['SHORT'] += 1
+        return False
+    stats['OUT'] += 1
+
+    return True
+
+
+def _readSpill(name):
+    with open(name) as f:
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            ordinal, key, header = line.rstrip('\n').split('\t', 2)
+            seq = f.readline().rstrip('\n')
+            qual = f.readline().rstrip('\n')
+            yield int(ordinal), int(key), (header, seq, qual)
+
+
+def _writeSpill(handle, ordinal, key, record):
+    handle.write('%i\t%i\t%s\n%s\n%s\n' % (ordinal, key, record[0], record[1], record[2]))
+
+
+def filterReads(records, min_len=0, max_len=None, max_mem=None, tmp_dir=None, parts=16, stats=None):
+    """
+    Removes reads with duplicate names and reads outside the length window
+
+    Duplicates are detected first, keeping the first occurrence of each name,
+    followed by the maximum and minimum length filters. Once the name set
+    reaches max_mem the remaining reads are spilled to hash partitions on disk,
+    deduplicated one partition at a time and merged back in input order.
+
+    Arguments:
+      records : iterable of (header, sequence, quality) tuples.
+      min_len : minimum read length.
+      max_len : maximum read length; no limit if None.
+      max_mem : memory cap of the name set in bytes; unbounded if None.
+      tmp_dir : parent folder of the spill files; the system default if None.
+      parts : number of spill partitions.
+      stats : optional dictionary updated with IN, DUPLICATE, LONG, SHORT, OUT and SPILLED counts.
+
+    Returns:
+      generator: (header, sequence, quality) tuples passing all filters.
+    """
+    if stats is None:
+        stats = OrderedDict()
+    for key in ('IN', 'DUPLICATE', 'LONG', 'SHORT', 'OUT', 'SPILLED'):
+        stats.setdefault(key, 0)
+
+    seen = NameSet(max_mem)
+    spill_dir, spill = None, None
+    try:
+        for ordinal, record in enumerate(records):
+            stats['IN'] += 1
+            key = nameHash(readName(record[0]))
+            if key in seen:
+                stats['DUPLICATE'] += 1
+                continue
+            if spill is None:
+                if seen.add(key):
+                    if _lengthFilter(record, min_len, max_len, stats):
+                        yield record
+                    continue
+                spill_dir = tempfile.mkdtemp(prefix='NanoIgFilter.', dir=tmp_dir)
+                spill = [open(os.path.join(spill_dir, 'part%i.txt' % i), 'w') for i in range(parts)]
+            stats['SPILLED'] += 1
+            _writeSpill(spill[(key >> 32) % parts], ordinal, key, record)
+
+        if spill is None:
+            return
+
+        # Deduplicate each partition and merge the survivors back in input order
+        del seen
+        survivors = []
+        for i, handle in enumerate(spill):
+            handle.close()
+            part_seen = NameSet()
+            out_name = os.path.join(spill_dir, 'pass%i.txt' % i)
+            with open(out_name, 'w') as out:
+                for ordinal, key, record in _readSpill(handle.name):
+                    if key in part_seen:
+                        stats['DUPLICATE'] += 1
+                        continue
+                    part_seen.add(key)
+                    if _lengthFilter(record, min_len, max_len, stats):
+                        _writeSpill(out, ordinal, key, record)
+            os.remove(handle.name)
+            survivors.append(_readSpill(out_name))
+        for ordinal, key, record in heapq.merge(*survivors, key=lambda x: x[0]):
+            yield record
+    finally:
+        if spill_dir is not None:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+
+def filterIds(store, ordinals, min_len=0, max_len=None, stats=None):
+    """
+    Removes store reads with duplicate names and reads outside the length window
+
+    The read list of a clone is small enough to keep every name in memory, so
+    nothing is spilled; only names and lengths are read from the store.
+
+    Arguments:
+      store : ReadStore of the reads.
+      ordinals : iterable of read numbers.
+      min_len : minimum read length.
+      max_len : maximum read length; no limit if None.
+      stats : optional dictionary updated with IN, DUPLICATE, LONG, SHORT and OUT counts.
+
+    Returns:
+      generator: read numbers passing all filters, in input order.
+    """
+    if stats is None:
+        stats = OrderedDict()
+    for key in ('IN', 'DUPLICATE', 'LONG', 'SHORT', 'OUT'):
+        stats.setdefault(key, 0)
+
+    seen = NameSet()
+    for i in ordinals:
+        stats['IN'] += 1
+        key = nameHash(store.name(i))
+        if key in seen:
+            stats['DUPLICATE'] += 1
+            continue
+        seen.add(key)
+        length = store.length(i)
+        if max_len is not None and length > max_len:
+            stats['LONG'] += 1
+        elif length < min_len:
+            stats['SHORT'] += 1
+        else:
+            stats['OUT'] += 1
+            yield i
+
+
+def getArgParser():
+    """
+    Defines the ArgumentParser
+
+    Returns:
+      argparse.ArgumentParser: argument parser object.
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-s', action='store', dest='seq_file', required=True,
+                        help='Input FASTQ file, or read number list with --store.')
+    parser.add_argument('-o', action='store', dest='out_file', required=True,
+                        help='Output FASTQ file, or read number list with --store.')
+    parser.add_argument('-m', action='store', dest='min_len', type=int, default=200,
+                        help='Minimum read length.')
+    parser.add_argument('-M', action='store', dest='max_len', type=int, default=350,
+                        help='Maximum read length.')
+    parser.add_argument('--maxmem', action='store', dest='max_mem', type=int, default=256,
+                        help='Memory cap of the duplicate name set in MB before spilling to disk.')
+    parser.add_argument('--tmp', action='store', dest='tmp_dir', default=None,
+                        help='Folder for spill files; defaults to the output folder.')
+    parser.add_argument('--log', action='store', dest='log_file', default=None,
+                        help='File receiving the filter counts.')
+    parser.add_argument('--store', action='store', dest='store', default=None,
+                        help='Read store the read numbers refer to, see NanoIgStore.py.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and filters reads
+    """
+    args = getArgParser().parse_args()
+
+    stats = OrderedDict()
+    tmp_dir = args.tmp_dir or os.path.dirname(os.path.abspath(args.out_file))
+    if args.store:
+        with ReadStore(args.store) as store:
+            writeIds(args.out_file, filterIds(store, readIds(args.seq_file), min_len=args.min_len,
+                                              max_len=args.max_len, stats=stats))
+    else:
+        with open(args.out_file, 'w') as out:
+            for record in filterReads(readFastq(args.seq_file), min_len=args.min_len, max_len=args.max_len,
+                                      max_mem=args.max_mem << 20, tmp_dir=tmp_dir, stats=stats):
+                writeFastq(out, record)
+
+    log = '\n'.join('%s> %s' % (k, v) for k, v in stats.items()) + '\n'
+    sys.stderr.write(log)
+    if args.log_file:
+        with open(args.log_file, 'w') as f:
+            f.write(log)
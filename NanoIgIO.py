@@ -0,0 +1,129 @@
+#!/usr/bin/python
+"""
+Streaming FASTQ/FASTA input and output shared by the NanoIg stages
+"""
+
+# Imports
+import gzip
+import math
+
+
+# Phred+33 character code to error probability lookup table
+_error_table = [10 ** (-max(i - 33, 0) / 10.0) for i in range(256)]
+
+# Read file extensions recognised in a barcode folder
+fastq_ext = ('.fastq', '.fq', '.fastq.gz', '.fq.gz')
+
+
+def openFile(name, mode='rt'):
+    """
+    Opens a plain or gzip compressed file
+
+    Arguments:
+      name : file name; files ending in .gz are opened through gzip.
+      mode : file mode.
+
+    Returns:
+      file: open file handle.
+    """
+    if name.endswith('.gz'):
+        return gzip.open(name, mode)
+
+    return open(name, mode)
+
+
+def readFastq(name):
+    """
+    Iterates over the records of a four line FASTQ file
+
+    Arguments:
+      name : FASTQ file name, optionally gzip compressed.
+
+    Returns:
+      generator: (header, sequence, quality) tuples; header excludes the leading @.
+    """
+    with openFile(name) as handle:
+        while True:
+            header = handle.readline()
+            if not header:
+                break
+            seq = handle.readline().rstrip()
+            handle.readline()
+            qual = handle.readline().rstrip()
+            yield header[1:].rstrip(), seq, qual
+
+
+def readFasta(name):
+    """
+    Iterates over the records of a FASTA file with single or wrapped sequence lines
+
+    Arguments:
+      name : FASTA file name, optionally gzip compressed.
+
+    Returns:
+      generator: (header, sequence) tuples; header excludes the leading >.
+    """
+    with openFile(name) as handle:
+        header, seq = None, []
+        for line in handle:
+            line = line.rstrip()
+            if line.startswith('>'):
+                if header is not None:
+                    yield header, ''.join(seq)
+                header, seq = line[1:], []
+            elif line:
+                seq.append(line)
+        if header is not None:
+            yield header, ''.join(seq)
+
+
+def readName(header):
+    """
+    Returns the read identifier of a FASTQ/FASTA header
+
+    Arguments:
+      header : header line without the leading @ or >.
+
+    Returns:
+      str: first whitespace delimited word of the header.
+    """
+    return header.split(None, 1)[0] if header else header
+
+
+def writeFastq(handle, record):
+    """
+    Writes a (header, sequence, quality) record in FASTQ format
+
+    Arguments:
+      handle : output file handle.
+      record : (header, sequence, quality) tuple.
+    """
+    handle.write('@%s\n%s\n+\n%s\n' % record)
+
+
+def writeFasta(handle, record):
+    """
+    Writes the header and sequence of a record in single line FASTA format
+
+    Arguments:
+      handle : output file handle.
+      record : tuple starting with (header, sequence).
+    """
+    handle.write('>%s\n%s\n' % (record[0], record[1]))
+
+
+def meanQuality(qual):
+    """
+    Calculates the mean Phred quality of a read from its mean error probability
+
+    Arguments:
+      qual : Phred+33 encoded quality string.
+
+    Returns:
+      float: mean quality; 0 for an empty quality string.
+    """
+    if not qual:
+        return 0.0
+    error = sum(map(_error_table.__getitem__, qual.encode('ascii'))) / len(qual)
+
+    return -10 * math.log10(error) if error > 0 else 60.0
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+"""
+Streams the FASTQ chunks of a barcode folder, filtering reads before alignment
+"""
+
+# Imports
+import os
+import sys
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+# NanoIg imports
+from NanoIgIO import fastq_ext, meanQuality, readFastq, writeFasta, writeFastq
+from NanoIgStore import StoreWriter
+
+
+def listChunks(folder):
+    """
+    Lists the FASTQ chunks of a barcode folder
+
+    Arguments:
+      folder : barcode folder containing .fastq and .fastq.gz files.
+
+    Returns:
+      list: sorted file names; merged total.fastq files of earlier runs are skipped.
+    """
+    chunks = [os.path.join(folder, f) for f in os.listdir(folder)
+              if f.endswith(fastq_ext) and not f.startswith('total.')]
+
+    return sorted(chunks)
+
+
+def ingestReads(chunks, min_len=0, max_len=None, min_qual=0, stats=None):
+    """
+    Iterates over the reads of a list of FASTQ chunks passing the length and quality filters
+
+    Arguments:
+      chunks : list of FASTQ file names, optionally gzip compressed.
+      min_len : minimum read length.
+      max_len : maximum read length; no limit if None.
+      min_qual : minimum mean read quality.
+      stats : optional dictionary updated with IN, SHORT, LONG, LOWQUAL and OUT counts.
+
+    Returns:
+      generator: (header, sequence, quality) tuples.
+    """
+    if stats is None:
+        stats = OrderedDict()
+    for key in ('IN', 'SHORT', 'LONG', 'LOWQUAL', 'OUT'):
+        stats.setdefault(key, 0)
+
+    for chunk in chunks:
+        for record in readFastq(chunk):
+            stats['IN'] += 1
+            seq_len = len(record[1])
+            if seq_len < min_len:
+                stats['SHORT'] += 1
+            elif max_len is not None and seq_len > max_len:
+                stats['LONG'] += 1
+            elif min_qual > 0 and meanQuality(record[2]) < min_qual:
+                stats['LOWQUAL'] += 1
+            else:
+                stats['OUT'] += 1
+                yield record
+
+
+def getArgParser():
+    """
+    Defines the ArgumentParser
+
+    Returns:
+      argparse.ArgumentParser: argument parser object.
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-i', action='store', dest='folder', required=True,
+                        help='Barcode folder containing .fastq and .fastq.gz chunks.')
+    parser.add_argument('-m', action='store', dest='min_len', type=int, default=200,
+                        help='Minimum read length.')
+    parser.add_argument('-M', action='store', dest='max_len', type=int, default=350,
+                        help='Maximum read length.')
+    parser.add_argument('-q', action='store', dest='min_qual', type=float, default=0,
+                        help='Minimum mean read quality; 0 disables the quality filter.')
+    parser.add_argument('--fastq', action='store_true', dest='fastq',
+                        help='Write FASTQ instead of FASTA.')
+    parser.add_argument('-o', action='store', dest='out_file', default=None,
+                        help='Output file; defaults to standard output.')
+    parser.add_argument('--log', action='store', dest='log_file', default=None,
+                        help='File receiving the filter counts.')
+    parser.add_argument('--store', action='store', dest='store', default=None,
+                        help='Read store folder also receiving the filtered reads, see NanoIgStore.py.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and streams the filtered reads
+    """
+    args = getArgParser().parse_args()
+
+    stats = OrderedDict()
+    write = writeFastq if args.fastq else writeFasta
+    out = open(args.out_file, 'w') if args.out_file else sys.stdout
+    store = StoreWriter(args.store) if args.store else None
+    for record in ingestReads(listChunks(args.folder), min_len=args.min_len, max_len=args.max_len,
+                              min_qual=args.min_qual, stats=stats):
+        write(out, record)
+        if store is not None:
+            store.add(record)
+    out.flush()
+    if store is not None:
+        store.close()
+    if args.out_file:
+        out.close()
+
+    log = '\n'.join('%s> %s' % (k, v) for k, v in stats.items()) + '\n'
+    sys.stderr.write(log)
+    if args.log_file:
+        with open(args.log_file, 'w') as f:
+            f.write(log)
@@ -0,0 +1,336 @@
+#!/usr/bin/python
+"""
+Runs the read stages of a barcode in one process, from ingest through coverage, routing, filtering, sub-clone
+clustering and sampling
+"""
+
+# Imports
+import os
+import subprocess
+import sys
+import threading
+from argparse import ArgumentParser
+from array import array
+from collections import OrderedDict
+
+# NanoIg imports
+from NanoIgCheck import recordStage, stageCurrent
+from NanoIgClassify import classifyReads, indexFile
+from NanoIgCluster import cloneNames, clusterReads, default_fwd_file, default_rev_file
+from NanoIgCov import IntervalIndex, countSam, readBed, writeCoverage
+from NanoIgFilter import filterIds
+from NanoIgIO import readFasta, readName, writeFasta, writeFastq
+from NanoIgIngest import ingestReads, listChunks
+from NanoIgProf import telemetryFile, usageRecord, usageSnapshot, writeRecord
+from NanoIgRoute import readAssignments, readCandidates
+from NanoIgSample import sampleIds
+from NanoIgStore import ReadStore, StoreWriter
+
+
+def writeLog(log_file, stats):
+    """
+    Writes read counts to standard error and a log file
+
+    Arguments:
+      log_file : log file name.
+      stats : ordered dictionary of counts.
+
+    Returns:
+      None
+    """
+    log = ''.join('%s> %s\n' % (k, v) for k, v in stats.items())
+    sys.stderr.write(log)
+    with open(log_file, 'w') as f:
+        f.write(log)
+
+
+def checkpoint(check_dir, name, inputs, params, outputs, stage):
+    """
+    Runs an in-process stage unless its checkpoint is current
+
+    Arguments:
+      check_dir : checkpoint folder.
+      name : stage name.
+      inputs : input files and folders.
+      params : list of parameter strings.
+      outputs : output files, or a function returning them, called again once the stage ran.
+      stage : function run without arguments, returning a dictionary of counts.
+
+    Returns:
+      bool: True if the stage ran.
+    """
+    listed = outputs if callable(outputs) else lambda: outputs
+    if stageCurrent(check_dir, name, inputs=inputs, params=params, outputs=listed()):
+        sys.stderr.write('SKIP> %s\n' % name)
+        return False
+    start = usageSnapshot() if telemetryFile() else None
+    counts = stage()
+    recordStage(check_dir, name, inputs=inputs, params=params, outputs=listed())
+    if start is not None:
+        writeRecord(usageRecord(name, start, status=0, skipped=False, counts=counts))
+    sys.stderr.write('RUN> %s\n' % name)
+
+    return True
+
+
+def alignReads(records, align_cmd, index, n, assign):
+    """
+    Streams reads through an aligner and counts its SAM output per interval
+
+    Arguments:
+      records : iterable of (read ID, sequence) tuples.
+      align_cmd : aligner command reading FASTA on stdin and writing SAM.
+      index : IntervalIndex of the BED intervals.
+      n : number of BED intervals.
+      assign : callback receiving (read ID, interval list).
+
+    Returns:
+      array: read count per BED index.
+    """
+    # Aligner messages, e.g. a missing index, go to the barcode log
+    proc = subprocess.Popen(align_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+
+    # Feed the reads from a thread while the alignments are counted
+    def feed():
+        # A failing aligner closes the pipe; its exit status is reported below
+        try:
+            for record in records:
+                writeFasta(proc.stdin, record)
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    counts = countSam(proc.stdout, index, n, assign=assign)
+    feeder.join()
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, align_cmd)
+
+    return counts
+
+
+def coverageStage(chunks, store_dir, clone_dir, bed, classify, ingest_args, min_count=500):
+    """
+    Ingests the barcode reads into the read store while assigning them to VH genes
+
+    Arguments:
+      chunks : FASTQ chunk file names.
+      store_dir : read store folder.
+      clone_dir : folder receiving coverage.bed, Clonal_candidate.bed, reads.tsv and ingest.log.
+      bed : list of intervals as returned by readBed.
+      classify : function of (records, assign callback) returning the read count per BED index.
+      ingest_args : dictionary of ingestReads filter arguments.
+      min_count : minimum read count of a clonal candidate gene.
+
+    Returns:
+      dict: ingest counts.
+    """
+    stats = OrderedDict()
+    store = StoreWriter(store_dir)
+
+    def stored():
+        for record in ingestReads(chunks, stats=stats, **ingest_args):
+            store.add(record)
+            yield readName(record[0]), record[1]
+
+    with open(os.path.join(clone_dir, 'reads.tsv'), 'w') as reads:
+        def assign(read_id, hits):
+            for i in hits:
+                reads.write('%s\t%s\n' % (read_id, bed[i][3]))
+        counts = classify(stored(), assign)
+    store.close()
+    writeCoverage(bed, counts, clone_dir, min_count=min_count)
+    writeLog(os.path.join(clone_dir, 'ingest.log'), stats)
+
+    return dict(stats)
+
+
+def readClones(clone_file):
+    """
+    Reads the clone list written by clonesStage
+
+    Arguments:
+      clone_file : clone list file, one clone name per line.
+
+    Returns:
+      list: clone names; empty if the file is missing.
+    """
+    if not os.path.exists(clone_file):
+        return []
+    with open(clone_file) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def clonesStage(store_dir, clone_dir, genes, out_dir, prefix, min_len=200, max_len=350, max_reads=500, split=None):
+    """
+    Routes, filters, splits into sub-clones and samples the reads of every candidate gene in memory
+
+    Only the sampled reads of each clone are written, as the FASTQ file read
+    by the assembler and medaka, and the clone names to clones.txt.
+
+    Arguments:
+      store_dir : read store folder.
+      clone_dir : folder of reads.tsv.
+      genes : candidate gene names.
+      out_dir : folder receiving clones.txt, <prefix>-<clone>-sampled.fastq and the filter, cluster and sample logs.
+      prefix : file prefix, usually the barcode name.
+      min_len : minimum read length.
+      max_len : maximum read length.
+      max_reads : reads kept per clone; all reads if 0.
+      split : function of a list of read sequences returning the sub-clones as
+              lists of indices, largest first, holding every read if more than
+              one; None keeps one clone per gene.
+
+    Returns:
+      dict: {clone: number of sampled reads}; the sub-clones of a gene are named by NanoIgCluster.cloneNames.
+    """
+    assign = readAssignments(os.path.join(clone_dir, 'reads.tsv'), genes)
+    routed = OrderedDict((gene, array('l')) for gene in genes)
+    kept = OrderedDict()
+    with ReadStore(store_dir) as store:
+        for i in range(len(store)):
+            for gene in assign.get(store.name(i), ()):
+                routed[gene].append(i)
+        for gene, ordinals in routed.items():
+            name = '%s-%s' % (prefix, gene)
+            sys.stderr.write('%s> %i\n' % (name, len(ordinals)))
+            stats = OrderedDict()
+            passed = list(filterIds(store, ordinals, min_len=min_len, max_len=max_len, stats=stats))
+            writeLog(os.path.join(out_dir, '%s-filter.log' % name), stats)
+
+            # A gene without two sub-clones large enough stays one clone with all its reads
+            groups = [passed]
+            if split is not None:
+                clusters = split([store.sequence(i) for i in passed]) if passed else []
+                stats = OrderedDict([('IN', len(passed)), ('CLUSTERS', len(clusters))])
+                for c, m in enumerate(clusters, start=1):
+                    stats['CLUSTER%i' % c] = len(m)
+                stats['UNASSIGNED'] = len(passed) - sum(len(m) for m in clusters)
+                writeLog(os.path.join(out_dir, '%s-cluster.log' % name), stats)
+                if len(clusters) > 1:
+                    groups = [[passed[i] for i in m] for m in clusters]
+
+            for clone, members in zip(cloneNames(gene, groups), groups):
+                name = '%s-%s' % (prefix, clone)
+                stats = OrderedDict()
+                keep = sampleIds(store, members, max_reads, stats=stats)
+                writeLog(os.path.join(out_dir, '%s-sample.log' % name), stats)
+                with open(os.path.join(out_dir, '%s-sampled.fastq' % name), 'w') as out:
+                    for record in store.records(keep):
+                        writeFastq(out, record)
+                kept[clone] = len(keep)
+    with open(os.path.join(out_dir, 'clones.txt'), 'w') as f:
+        f.write(''.join('%s\n' % clone for clone in kept))
+
+    return kept
+
+
+def getArgParser():
+    """
+    Defines the ArgumentParser
+
+    Returns:
+      argparse.ArgumentParser: argument parser object.
+    """
+    parser = ArgumentParser(description=__doc__,
+                            epilog='''The coverage and clones stages are checkpointed as NanoIgCheck.py stages,
+                                   so only their outputs are written to the barcode folders. The clones
+                                   assembled by PipeIg.sh are listed in clones.txt of the output folder.''')
+    parser.add_argument('-i', action='store', dest='folder', required=True,
+                        help='Barcode folder containing .fastq and .fastq.gz chunks.')
+    parser.add_argument('-o', action='store', dest='out_dir', required=True,
+                        help='Barcode output folder, PIPE/BarcodeXX.')
+    parser.add_argument('-C', action='store', dest='clone_dir', required=True,
+                        help='Barcode coverage folder, PIPE/Clonality/BarcodeXX.')
+    parser.add_argument('-p', action='store', dest='prefix', required=True,
+                        help='Output file prefix, usually the barcode name.')
+    parser.add_argument('-d', action='store', dest='check_dir', required=True,
+                        help='Checkpoint folder.')
+    parser.add_argument('-r', action='store', dest='chrom_file', required=True,
+                        help='IGH locus FASTA file, indexed by bwa.')
+    parser.add_argument('-b', action='store', dest='bed_file', required=True,
+                        help='BED file of the VH gene intervals.')
+    parser.add_argument('-m', action='store', dest='min_len', type=int, default=200,
+                        help='Minimum read length.')
+    parser.add_argument('-M', action='store', dest='max_len', type=int, default=350,
+                        help='Maximum read length.')
+    parser.add_argument('-q', action='store', dest='min_qual', type=float, default=0,
+                        help='Minimum mean read quality; 0 disables the quality filter.')
+    parser.add_argument('-c', action='store', dest='min_count', type=int, default=500,
+                        help='Minimum read count of a clonal candidate gene.')
+    parser.add_argument('-n', action='store', dest='max_reads', type=int, default=500,
+                        help='Reads kept per clone; 0 keeps all reads.')
+    parser.add_argument('-t', action='store', dest='threads', type=int, default=8,
+                        help='Aligner threads or classifier processes.')
+    parser.add_argument('--classifier', action='store', dest='classifier', choices=('bwa', 'minimizer'),
+                        default='bwa', help='VH gene assignment.')
+    parser.add_argument('--subclone-frac', action='store', dest='subclone_frac', type=float, default=0.1,
+                        help='''Minimum fraction of the gene reads of a sub-clone assembled on its own;
+                             0 keeps one clone per gene.''')
+    parser.add_argument('--subclone-reads', action='store', dest='subclone_reads', type=int, default=50,
+                        help='Minimum number of reads of a sub-clone.')
+    parser.add_argument('--fwd', action='store', dest='fwd_file', default=default_fwd_file,
+                        help='FR1 primer FASTA file, used to orient the reads of the sub-clone clustering.')
+    parser.add_argument('--rev', action='store', dest='rev_file', default=default_rev_file,
+                        help='JH primer FASTA file.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and runs the read stages
+    """
+    args = getArgParser().parse_args()
+
+    bed = readBed(args.bed_file)
+    store_dir = os.path.join(args.out_dir, 'reads.store')
+    clone_dir = args.clone_dir
+    if args.classifier == 'minimizer':
+        index_file = indexFile(args.chrom_file, args.bed_file)
+
+        def classify(records, assign):
+            counts = array('l', bytes(array('l').itemsize * len(bed)))
+            for read_id, hits in classifyReads(records, index_file, nproc=args.threads):
+                for i in hits:
+                    counts[i] += 1
+                if hits:
+                    assign(read_id, hits)
+            return counts
+    else:
+        align_cmd = ['bwa', 'mem', '-x', 'ont2d', '-t', str(args.threads), args.chrom_file, '-']
+
+        def classify(records, assign):
+            return alignReads(records, align_cmd, IntervalIndex(bed), len(bed), assign)
+
+    ingest_args = {'min_len': args.min_len, 'max_len': args.max_len, 'min_qual': args.min_qual}
+    coverage = [os.path.join(clone_dir, f) for f in ('coverage.bed', 'Clonal_candidate.bed', 'reads.tsv')]
+    checkpoint(args.check_dir, 'coverage', [args.folder, args.chrom_file, args.bed_file],
+               ['minlen=%i' % args.min_len, 'maxlen=%i' % args.max_len, 'minqual=%s' % args.min_qual,
+                'mincount=%i' % args.min_count, 'classifier=%s' % args.classifier],
+               coverage + [store_dir],
+               lambda: coverageStage(listChunks(args.folder), store_dir, clone_dir, bed, classify, ingest_args,
+                                     min_count=args.min_count))
+
+    genes = readCandidates(coverage[1])
+    split = None
+    if args.subclone_frac > 0:
+        fwd_primers = [seq.upper() for h, seq in readFasta(args.fwd_file)]
+        rev_primers = [seq.upper() for h, seq in readFasta(args.rev_file)]
+
+        def split(seqs):
+            return clusterReads(seqs, fwd_primers, rev_primers, min_reads=args.subclone_reads,
+                                min_frac=args.subclone_frac, assign_all=True)
+
+    # The sampled files depend on the sub-clones found, so they are listed from clones.txt
+    clone_file = os.path.join(args.out_dir, 'clones.txt')
+
+    def sampled():
+        return [clone_file] + [os.path.join(args.out_dir, '%s-%s-sampled.fastq' % (args.prefix, c))
+                               for c in readClones(clone_file)]
+    checkpoint(args.check_dir, 'clones', coverage[1:] + [store_dir, args.fwd_file, args.rev_file],
+               ['minlen=%i' % args.min_len, 'maxlen=%i' % args.max_len, 'maxreads=%i' % args.max_reads,
+                'subclonefrac=%s' % args.subclone_frac, 'subclonereads=%i' % args.subclone_reads],
+               sampled,
+               lambda: clonesStage(store_dir, clone_dir, genes, args.out_dir, args.prefix, min_len=args.min_len,
+                                   max_len=args.max_len, max_reads=args.max_reads, split=split))
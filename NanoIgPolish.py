@@ -0,0 +1,236 @@
+#!/usr/bin/python
+"""
+Polishes the deferred draft contigs of every clone and barcode with a single medaka model run
+"""
+
+# Imports
+import glob
+import os
+import shutil
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+# NanoIg imports
+from NanoIgCheck import readJson, recordStage, runStage
+from NanoIgIO import readFasta, readFastq, readName, writeFasta, writeFastq
+from NanoIgProf import profileProcess
+
+# Deferred polish stage written by PipeIg.sh -d in every Assembly-* folder
+defer_name = 'polish.json'
+
+# Contig and read names are prefixed with the clone name and this separator
+separator = '|'
+
+# Largest medaka batch; smaller plates are inferred in a single batch
+default_max_batch = 500
+
+
+def readJobs(path):
+    """
+    Reads the deferred polish stages of a run
+
+    The stage inputs are the clone reads followed by the draft contigs and the
+    only output is the consensus file, as written by PipeIg.sh.
+
+    Arguments:
+      path : data folder containing PIPE.
+
+    Returns:
+      list: stage dictionaries, as written by NanoIgCheck.runStage, with the
+            additional 'file' and 'clone' keys, in barcode and clone order.
+    """
+    jobs = []
+    for name in sorted(glob.glob(os.path.join(path, 'PIPE', '*', 'Assembly-*', defer_name))):
+        job = readJson(name, None)
+        if job is None:
+            continue
+        job['file'] = name
+        job['clone'] = os.path.basename(os.path.dirname(name))[len('Assembly-'):]
+        jobs.append(job)
+
+    return jobs
+
+
+def jobModel(job):
+    """
+    Returns the medaka model of a deferred polish stage
+
+    Arguments:
+      job : stage dictionary.
+
+    Returns:
+      str: value of the model= parameter.
+    """
+    return dict(p.split('=', 1) for p in job['params'] if '=' in p)['model']
+
+
+def namespaceJobs(jobs, work_dir):
+    """
+    Writes the drafts and reads of every clone with names prefixed by the clone
+
+    Arguments:
+      jobs : stage dictionaries as returned by readJobs.
+      work_dir : batch folder.
+
+    Returns:
+      tuple: (combined draft FASTA file, list of (contig name, length) tuples,
+              list of (draft file, read file) tuples of every job).
+    """
+    drafts_file = os.path.join(work_dir, 'drafts.fasta')
+    contigs, files = [], []
+    with open(drafts_file, 'w') as drafts:
+        for job in jobs:
+            reads, draft = job['inputs'][:2]
+            prefix = job['clone'] + separator
+            job_draft = os.path.join(work_dir, '%s.draft.fasta' % job['clone'])
+            job_reads = os.path.join(work_dir, '%s.reads.fastq' % job['clone'])
+            with open(job_draft, 'w') as out:
+                for header, seq in readFasta(draft):
+                    record = (prefix + readName(header), seq)
+                    contigs.append((record[0], len(seq)))
+                    writeFasta(out, record)
+                    writeFasta(drafts, record)
+            with open(job_reads, 'w') as out:
+                for header, seq, qual in readFastq(reads):
+                    writeFastq(out, (prefix + readName(header), seq, qual))
+            files.append((job_draft, job_reads))
+
+    return drafts_file, contigs, files
+
+
+def alignJobs(files, contigs, bam_file, threads=1):
+    """
+    Aligns the reads of every clone to its own draft into one sorted BAM file
+
+    Each clone is aligned separately, so reads never pile up on the draft of
+    another clone of the same VH gene; only primary alignments are kept.
+
+    Arguments:
+      files : list of (draft file, read file) tuples.
+      contigs : list of (contig name, length) tuples of all drafts.
+      bam_file : output BAM file, indexed.
+      threads : minimap2 and samtools threads.
+
+    Returns:
+      None
+    """
+    sort_cmd = ['samtools', 'sort', '-@', str(threads), '-o', bam_file, '-']
+    sort = subprocess.Popen(sort_cmd, stdin=subprocess.PIPE, universal_newlines=True)
+    sort.stdin.write('@HD\tVN:1.6\tSO:unsorted\n')
+    sort.stdin.write(''.join('@SQ\tSN:%s\tLN:%i\n' % c for c in contigs))
+    for draft, reads in files:
+        align_cmd = ['minimap2', '-ax', 'map-ont', '--MD', '-t', str(threads), draft, reads]
+        proc = subprocess.Popen(align_cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True)
+        for line in proc.stdout:
+            if line.startswith('@') or int(line.split('\t', 2)[1]) & 2308:
+                continue
+            sort.stdin.write(line)
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, align_cmd)
+    sort.stdin.close()
+    if sort.wait() != 0:
+        raise subprocess.CalledProcessError(sort.returncode, sort_cmd)
+    subprocess.check_call(['samtools', 'index', bam_file])
+
+
+def polishBatch(jobs, work_dir, model, threads=1, max_batch=default_max_batch):
+    """
+    Polishes the drafts of a group of clones with one medaka consensus run
+
+    Drafts of a few hundred bases make one medaka sample each, so the batch
+    size is the contig count up to max_batch and the model is loaded once.
+
+    Arguments:
+      jobs : stage dictionaries sharing the model.
+      work_dir : batch folder, created if missing.
+      model : medaka model name.
+      threads : alignment and inference threads.
+      max_batch : largest medaka batch size.
+
+    Returns:
+      dict: {clone: list of (contig name, sequence) tuples of the consensus}.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    drafts_file, contigs, files = namespaceJobs(jobs, work_dir)
+    bam_file = os.path.join(work_dir, 'calls_to_draft.bam')
+    probs_file = os.path.join(work_dir, 'consensus_probs.hdf')
+    consensus_file = os.path.join(work_dir, 'consensus.fasta')
+    alignJobs(files, contigs, bam_file, threads=threads)
+    batch_size = max(1, min(max_batch, len(contigs)))
+    subprocess.check_call(['medaka', 'consensus', bam_file, probs_file, '--model', model,
+                           '--batch_size', str(batch_size), '--threads', str(threads)])
+    subprocess.check_call(['medaka', 'stitch', probs_file, drafts_file, consensus_file])
+
+    # Split the stitched consensus back into the clones
+    polished = {job['clone']: [] for job in jobs}
+    for header, seq in readFasta(consensus_file):
+        clone, contig = readName(header).split(separator, 1)
+        polished[clone].append((contig, seq))
+
+    return polished
+
+
+def getArgParser():
+    """
+    Defines the ArgumentParser
+
+    Returns:
+      argparse.ArgumentParser: argument parser object.
+    """
+    parser = ArgumentParser(description=__doc__,
+                            epilog='''Clones the batch leaves unpolished are polished one by one with
+                                   their own medaka_consensus command.''')
+    parser.add_argument('input', help='Data folder whose clones were drafted by PipeIg.sh -d.')
+    parser.add_argument('-t', action='store', dest='threads', type=int, default=1,
+                        help='Alignment and medaka inference threads.')
+    parser.add_argument('-b', action='store', dest='max_batch', type=int, default=default_max_batch,
+                        help='Largest medaka batch size.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and polishes the deferred clones
+    """
+    args = getArgParser().parse_args()
+    telemetry = profileProcess('NanoIgPolish')
+
+    path = os.path.abspath(args.input)
+    jobs = readJobs(path)
+    models = {}
+    for job in jobs:
+        models.setdefault(jobModel(job), []).append(job)
+
+    polished = {}
+    for i, (model, group) in enumerate(sorted(models.items())):
+        work_dir = os.path.join(path, 'PIPE', 'Polish', str(i + 1))
+        shutil.rmtree(work_dir, ignore_errors=True)
+        try:
+            polished.update(polishBatch(group, work_dir, model, threads=args.threads, max_batch=args.max_batch))
+        except (OSError, subprocess.CalledProcessError) as e:
+            sys.stderr.write('BATCH> %s failed: %s\n' % (model, e))
+
+    status, fallback = 0, 0
+    for job in jobs:
+        out_file = job['outputs'][0]
+        if polished.get(job['clone']):
+            with open(out_file, 'w') as out:
+                for record in polished[job['clone']]:
+                    writeFasta(out, record)
+            recordStage(job['check_dir'], job['name'], inputs=job['inputs'], params=job['params'],
+                        outputs=job['outputs'])
+            code = 0
+        else:
+            fallback += 1
+            code, ran = runStage(job['check_dir'], job['name'], job['command'], inputs=job['inputs'],
+                                 params=job['params'], outputs=job['outputs'])
+        if code == 0:
+            os.remove(job['file'])
+        status = status or code
+
+    telemetry['counts'] = {'CLONES': len(jobs), 'FALLBACK': fallback}
+    sys.stderr.write('CLONES> %i\nFALLBACK> %i\n' % (len(jobs), fallback))
+    sys.exit(status)
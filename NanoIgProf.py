@@ -0,0 +1,242 @@
+#!/usr/bin/python
+"""
+Records per stage run telemetry as JSON lines and converts it into a Chrome trace timeline
+"""
+
+# Imports
+import atexit
+import json
+import os
+import re
+import resource
+import sys
+import time
+from argparse import ArgumentParser
+
+# JSON lines file receiving the records; telemetry is off when unset. PipeIg.sh
+# points it at PIPE/<barcode>/telemetry.jsonl for the stages of each barcode.
+telemetry_env = 'NANOIG_TELEMETRY'
+
+# Count lines printed by the NanoIg and presto tools, e.g. "OUT> 512", "     PASS> 3"
+# or the "Barcode01-IGHV3-23> 640" routing counts
+_count_regex = re.compile(r'^\s*([\w.-]+)> *(\d+)\s*$')
+
+
+def telemetryFile():
+    """
+    Returns the telemetry file of the process
+
+    Returns:
+      str: the $NANOIG_TELEMETRY file name, or None if telemetry is off.
+    """
+    return os.environ.get(telemetry_env) or None
+
+
+def readIO():
+    """
+    Reads the bytes read and written by this process
+
+    Returns:
+      tuple: (read bytes, written bytes) of all read and write calls, or (0, 0)
+             where /proc/self/io is not available.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(': ') for line in f.read().splitlines())
+        return int(io['rchar']), int(io['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def usageSnapshot():
+    """
+    Takes a snapshot of the resource usage of this process and its finished children
+
+    Returns:
+      dict: time, rusage of self and children, and /proc/self/io counters.
+    """
+    return {'time': time.time(),
+            'self': resource.getrusage(resource.RUSAGE_SELF),
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN),
+            'io': readIO()}
+
+
+def usageRecord(name, start, **fields):
+    """
+    Builds a telemetry record from a starting snapshot
+
+    Block I/O of the children is counted in 512 byte blocks by the kernel and
+    covers only reads and writes that reached the storage, not the page cache.
+
+    Arguments:
+      name : stage name.
+      start : snapshot taken by usageSnapshot when the stage started.
+      fields : additional record fields, e.g. status or counts.
+
+    Returns:
+      dict: the record.
+    """
+    end = usageSnapshot()
+    self_start, self_end = start['self'], end['self']
+    child_start, child_end = start['children'], end['children']
+    record = {'name': name,
+              'pid': os.getpid(),
+              'start': start['time'],
+              'wall': end['time'] - start['time'],
+              'cpu_user': (self_end.ru_utime - self_start.ru_utime) + (child_end.ru_utime - child_start.ru_utime),
+              'cpu_sys': (self_end.ru_stime - self_start.ru_stime) + (child_end.ru_stime - child_start.ru_stime),
+              'max_rss_kb': max(self_end.ru_maxrss, child_end.ru_maxrss),
+              'read_bytes': (end['io'][0] - start['io'][0]) + 512 * (child_end.ru_inblock - child_start.ru_inblock),
+              'write_bytes': (end['io'][1] - start['io'][1]) + 512 * (child_end.ru_oublock - child_start.ru_oublock)}
+    record.update(fields)
+
+    return record
+
+
+def writeRecord(record, telemetry_file=None):
+    """
+    Appends a record to the telemetry file
+
+    Arguments:
+      record : dictionary of record fields.
+      telemetry_file : JSON lines file; $NANOIG_TELEMETRY if None.
+
+    Returns:
+      None
+    """
+    telemetry_file = telemetry_file or telemetryFile()
+    if telemetry_file is None:
+        return
+    folder = os.path.dirname(os.path.abspath(telemetry_file))
+    os.makedirs(folder, exist_ok=True)
+    # One write per line, so records of concurrent processes do not interleave
+    with open(telemetry_file, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def profileProcess(name, **fields):
+    """
+    Records the telemetry of the whole process when it exits
+
+    Arguments:
+      name : entry point name, e.g. collage.
+      fields : additional record fields.
+
+    Returns:
+      dict: the additional fields, which may be updated until the process exits,
+            e.g. with read counts.
+    """
+    if telemetryFile() is None:
+        return fields
+    start = usageSnapshot()
+    atexit.register(lambda: writeRecord(usageRecord(name, start, argv=sys.argv[1:], **fields)))
+
+    return fields
+
+
+def scanCounts(lines, handle=None):
+    """
+    Collects the read counts printed by a stage
+
+    Arguments:
+      lines : iterable of text lines, e.g. the stage standard error.
+      handle : optional handle every line is copied to.
+
+    Returns:
+      dict: {count name: last value}, e.g. {'IN': 1200, 'OUT': 1100}.
+    """
+    counts = {}
+    for line in lines:
+        if handle is not None:
+            handle.write(line)
+        match = _count_regex.match(line)
+        if match:
+            counts[match.group(1)] = int(match.group(2))
+
+    return counts
+
+
+def readRecords(files):
+    """
+    Reads telemetry records
+
+    Arguments:
+      files : JSON lines files; missing files and malformed lines are skipped.
+
+    Returns:
+      list: (file name, record) tuples.
+    """
+    records = []
+    for name in files:
+        if not os.path.exists(name):
+            continue
+        with open(name) as f:
+            for line in f:
+                try:
+                    records.append((name, json.loads(line)))
+                except ValueError:
+                    continue
+
+    return records
+
+
+def chromTrace(records):
+    """
+    Converts telemetry records into Chrome trace events
+
+    Every telemetry file becomes a trace process named after its folder, e.g.
+    the barcode, and every recording process a thread of it.
+
+    Arguments:
+      records : (file name, record) tuples as returned by readRecords.
+
+    Returns:
+      dict: Chrome trace object for chrome://tracing or Perfetto.
+    """
+    events, pids = [], {}
+    origin = min((r['start'] for f, r in records), default=0)
+    for name, record in records:
+        if name not in pids:
+            pids[name] = len(pids) + 1
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': pids[name],
+                           'args': {'name': os.path.basename(os.path.dirname(os.path.abspath(name)))}})
+        args = {k: v for k, v in record.items() if k not in ('name', 'start', 'wall', 'pid')}
+        events.append({'name': record['name'], 'ph': 'X', 'pid': pids[name], 'tid': record.get('pid', 0),
+                       'ts': int((record['start'] - origin) * 1e6), 'dur': int(record['wall'] * 1e6),
+                       'args': args})
+
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def getArgParser():
+    """
+    Defines the ArgumentParser
+
+    Returns:
+      argparse.ArgumentParser: argument parser object.
+    """
+    parser = ArgumentParser(description=__doc__,
+                            epilog='Set $%s to a JSON lines file to record the telemetry of a run.' % telemetry_env)
+    parser.add_argument('files', nargs='+', help='Telemetry JSON lines files.')
+    parser.add_argument('-o', action='store', dest='out_file', required=True,
+                        help='Output Chrome trace JSON file.')
+    parser.add_argument('-n', action='store', dest='top', type=int, default=10,
+                        help='Number of slowest stages printed.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and writes the trace
+    """
+    args = getArgParser().parse_args()
+
+    records = readRecords(args.files)
+    with open(args.out_file, 'w') as out:
+        json.dump(chromTrace(records), out)
+    for name, record in sorted(records, key=lambda x: -x[1]['wall'])[:args.top]:
+        folder = os.path.basename(os.path.dirname(os.path.abspath(name)))
+        print('%s> %s %.1f s, %.1f s CPU, %i MB' % (folder, record['name'], record['wall'],
+                                                    record['cpu_user'] + record['cpu_sys'],
+                                                    record['max_rss_kb'] // 1024))
@@ -1,18 +1,24 @@
 #!/usr/bin/python
 
-import sys, os
-import pandas as pd
-from selenium.webdriver import Firefox
-from selenium.webdriver.firefox.options import Options
+import sys, os, csv, json
+from collections import OrderedDict
 from docx import Document
 from docx.shared import Cm
 from docx.enum.section import WD_ORIENT
+from docx.enum.style import WD_STYLE_TYPE
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 from docx.shared import Pt
+from docx.table import _Cell
+
+from NanoIgAnnot import MinimizerIndex, annotateRecords, readGermlines, summary_columns
+from NanoIgIO import readFasta
+from NanoIgProf import profileProcess
+from NanoIgVquest import queryVquest
 
 
 run=__file__
 path=sys.argv[1] 
+telemetry = profileProcess('NanoIgRep')
 
 def pypath(folder):
     pyfolder=''
@@ -23,39 +29,128 @@ def pypath(folder):
 
 upper=pypath(run).replace("/NanoIg.py", "")
 
+# V-Quest synthesis columns shown in the report
+report_columns = ["Sequence ID", "V-GENE and allele", "V-DOMAIN Functionality", "V-REGION identity % (nt)",
+                  "J-GENE and allele", "D-GENE and allele", "CDR-IMGT lengths", "AA JUNCTION",
+                  "Sequence analysis category"]
+
+# Fields of the JSON and TSV summaries
+summary_fields = ["Sequence Number", "Sample"] + report_columns
+
+
+def readSummary(annotation, summary_file):
+    """
+    Reads the V-Quest synthesis rows of the NanoIg sequences in one pass
+
+    Arguments:
+      annotation : V_quest.txt or Annotation.txt.
+      summary_file : Summary_txt.txt, rewritten with the column header and the
+                     rows of the barcode sequences.
+
+    Returns:
+      list: one OrderedDict per sequence with Sequence Number, Sample (the
+            sequence ID without the consensus name) and the report_columns.
+    """
+    rows = []
+    header = None
+    with open(annotation, 'r') as infile, open(summary_file, "w") as outfile:
+        for line in infile:
+            if "Sequence Number" in line:
+                outfile.write(line)
+                header = next(csv.reader([line.rstrip("\n")], delimiter=";"))
+            elif ";barcode" in line and header is not None:
+                outfile.write(line)
+                fields = dict(zip(header, next(csv.reader([line.rstrip("\n")], delimiter=";"))))
+                row = OrderedDict([("Sequence Number", fields.get("Sequence Number", ""))])
+                seq_id = fields.get("Sequence ID", "")
+                row["Sample"] = seq_id[:seq_id.rindex(':')] if ':' in seq_id else seq_id
+                for c in report_columns:
+                    row[c] = fields.get(c, "")
+                rows.append(row)
+
+    return rows
+
+
+def writeTable(document, columns, rows):
+    """
+    Adds a table styled once through a table style instead of per text run
+
+    Arguments:
+      document : docx.Document.
+      columns : header cell texts.
+      rows : lists of cell texts.
+
+    Returns:
+      docx.table.Table: the table.
+    """
+    styles = document.styles
+    if "NanoIg Table" not in [x.name for x in styles]:
+        style = styles.add_style("NanoIg Table", WD_STYLE_TYPE.TABLE)
+        style.base_style = styles["Table Grid"]
+        style.font.name = "Arial"
+        style.font.size = Pt(7)
+    t = document.add_table(len(rows) + 1, len(columns), style="NanoIg Table")
+
+    # Fill the cells row by row; Table.cell() rebuilds the cell list on every call
+    for tr, values in zip(t._tbl.tr_lst, [columns] + rows):
+        for tc, value in zip(tr.tc_lst, values):
+            _Cell(tc, t).text = value
+
+    return t
+
 BClist = [f for f in os.listdir(pypath(path)+"/fastq")]
 
-#Interrogate IMGT/V-Quest
-
-fileObject = open(pypath(path) + "/Results.fasta", "r")
-consensus = fileObject.read()
-print(consensus)
-fileObject.close()
-
-opts = Options()
-opts.set_headless()
-assert opts.headless 
-browser = Firefox(options=opts)
-browser.get('http://www.imgt.org/IMGT_vquest/analysis')
-
-browser.find_element_by_xpath("//select[@name='species']/option[text()='Homo sapiens (human)']").click()
-browser.find_element_by_xpath("//select[@name='receptorOrLocusType']/option[text()='IG']").click()
-browser.find_element_by_id("main_form_sequences").click()
-browser.find_element_by_id("main_form_sequences").send_keys(consensus)
-browser.find_element_by_id("sv_resultType").click()
-browser.find_element_by_id("text_sv").click()
-browser.find_element_by_id("main_form_V_REGIONsearchIndeltrue").click()
-browser.find_element_by_xpath("//select[@name='sv_V_GENEordertable']/option[text()='input']").click()
-browser.find_element_by_id("main_form_0").click()
-
-results = browser.find_element_by_tag_name('pre')
-print(results.text)
-
-final = open(pypath(path) + "/V_quest.txt", "w")
-final.write(results.text)
+#Annotate offline against the IGHV germlines
+
+records = list(readFasta(pypath(path) + "/Results.fasta"))
+germlines = readGermlines()
+rows = annotateRecords(records, MinimizerIndex(germlines), germlines)
+
+final = open(pypath(path) + "/Annotation.txt", "w")
+final.write(";".join(summary_columns) + "\n")
+for row in rows:
+    final.write(";".join(row) + "\n")
 final.close()
 
-browser.close()
+#Interrogate IMGT/V-Quest unless --offline is given or it cannot be reached
+
+offline = "--offline" in sys.argv[2:]
+filled = []
+if not offline:
+    try:
+        stats = OrderedDict()
+        header, lines = queryVquest(records, stats=stats)
+        print('\n'.join('%s> %s' % (k, v) for k, v in stats.items()))
+        # A response without results, e.g. an error page, is no annotation either
+        if header is None or stats['MISSING'] == stats['IN']:
+            print('IMGT/V-Quest returned no results, reporting the offline annotation')
+            offline = True
+    except OSError as e:
+        print('IMGT/V-Quest unavailable (%s), reporting the offline annotation' % e)
+        offline = True
+
+if not offline:
+    # Sequences V-Quest left out are reported with their offline annotation, in the V-Quest columns
+    columns = next(csv.reader([header], delimiter=";"))
+    found = OrderedDict((line.split(";")[1], line.split(";")[2:]) for line in lines)
+    lines = []
+    for number, row in enumerate(rows, start=1):
+        fields = dict(zip(summary_columns, row))
+        if fields["Sequence ID"] in found:
+            values = found[fields["Sequence ID"]]
+        else:
+            filled.append(fields["Sequence ID"])
+            values = [fields.get(c, "") for c in columns[2:]]
+        lines.append(";".join([str(number), fields["Sequence ID"]] + values))
+    if filled:
+        print('OFFLINE> %i' % len(filled))
+
+    final = open(pypath(path) + "/V_quest.txt", "w")
+    final.write(header + "\n")
+    for line in lines:
+        final.write(line + "\n")
+    final.close()
+annotation = pypath(path) + ("/Annotation.txt" if offline else "/V_quest.txt")
 
 #Write Report
 
@@ -81,51 +176,23 @@ my_image = document.add_picture(pypath(path) + '/PIPE/Clonality/grid.jpg', width
 last_paragraph = document.paragraphs[-1]
 last_paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
 
-document.add_heading('IMGT V-quest Analysis', level=1)
+document.add_heading('IMGT V-quest Analysis' if not offline else 'Offline IGHV Germline Analysis', level=1)
 
 
 
-with open(pypath(path)+"/V_quest.txt", 'r') as infile, open(pypath(path)+"/Summary_txt.txt", "a") as outfile: 
-    for line in infile: 
-            if "Sequence Number" in line:
-                outfile.write(line)
+summary = readSummary(annotation, pypath(path) + "/Summary_txt.txt")
+telemetry['counts'] = {'SEQUENCES': len(summary)}
 
-with open(pypath(path)+"/V_quest.txt", 'r') as infile, open(pypath(path)+"/Summary_txt.txt", "a") as outfile: 
-    for line in infile: 
-            if ";barcode" in line:
-                outfile.write(line)
+# Machine readable summaries, written before the docx
+with open(pypath(path) + "/Summary.tsv", "w") as out:
+    out.write("\t".join(summary_fields) + "\n")
+    for row in summary:
+        out.write("\t".join(row.values()) + "\n")
+with open(pypath(path) + "/Summary.json", "w") as out:
+    json.dump({"source": "offline" if offline else "IMGT/V-Quest", "offline": filled, "sequences": summary},
+              out, indent=1)
 
-Summary = pd.read_csv(pypath(path) + "/Summary_txt.txt", sep=";", index_col="Sequence Number")
-
-subsummary= Summary[["Sequence ID", "V-GENE and allele", "V-DOMAIN Functionality", "V-REGION identity % (nt)", "J-GENE and allele", "D-GENE and allele", "CDR-IMGT lengths", "AA JUNCTION", "Sequence analysis category"]]
-newcol=[]
-oldcol=[]
-d={}
-for i in subsummary["Sequence ID"]:
-    newcol.append(i[:i.rindex(':')] + '')
-for i in subsummary["Sequence ID"]:
-    oldcol.append(i)
-for i in range(len(oldcol)):
-    d[oldcol[i]]=newcol[i]
-subsummary["Sequence ID"].replace(d, inplace=True)
-
-t = document.add_table(subsummary.shape[0]+1, subsummary.shape[1])
-
-for j in range(subsummary.shape[-1]):
-    t.cell(0,j).text = subsummary.columns[j]
-    
-for i in range(subsummary.shape[0]):
-    for j in range(subsummary.shape[-1]):
-        t.cell(i+1,j).text = str(subsummary.values[i,j])
-        
-for row in t.rows:
-    for cell in row.cells:
-        paragraphs = cell.paragraphs
-        for paragraph in paragraphs:
-            for run in paragraph.runs:
-                font = run.font
-                font.name='Arial'
-                font.size= Pt(7)
+writeTable(document, report_columns, [[row["Sample"]] + [row[c] for c in report_columns[1:]] for row in summary])
 
 
 document.save(pypath(path) + '/Summary_report.docx')
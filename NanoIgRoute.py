@@ -0,0 +1,178 @@
+#!/usr/bin/python
+"""
+Routes the reads of a barcode to all of its clonal candidate genes in a single pass
+"""
+
+# Imports
+import os
+import sys
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+# NanoIg imports
+from NanoIgIO import readName, writeFastq
+from NanoIgIngest import ingestReads, listChunks
+from NanoIgStore import ReadStore, StoreWriter
+
+
+def readCandidates(bed_file):
+    """
+    Reads the gene names of Clonal_candidate.bed
+
+    Arguments:
+      bed_file : clonal candidate BED file.
+
+    Returns:
+      list: gene names in file order.
+    """
+    with open(bed_file) as f:
+        return [line.split('\t')[3].strip() for line in f if line.strip()]
+
+
+def readAssignments(assign_file, genes):
+    """
+    Builds the read ID to gene map of the candidate genes
+
+    Arguments:
+      assign_file : reads.tsv file of (read ID, gene) lines.
+      genes : gene names to keep.
+
+    Returns:
+      dict: {read ID: tuple of gene names}.
+    """
+    keep = set(genes)
+    assign = {}
+    with open(assign_file) as f:
+        for line in f:
+            read_id, gene = line.rstrip('\n').split('\t')
+            if gene in keep:
+                hits = assign.get(read_id, ())
+                if gene not in hits:
+                    assign[read_id] = hits + (gene,)
+
+    return assign
+
+
+def routeReads(records, assign, handles, store=None):
+    """
+    Writes every read to the FASTQ files of its assigned genes
+
+    Arguments:
+      records : iterable of (header, sequence, quality) tuples.
+      assign : {read ID: tuple of gene names} as returned by readAssignments.
+      handles : dictionary of {gene: output handle}.
+      store : optional StoreWriter receiving the routed reads, whose read
+              numbers are then written to the handles instead of FASTQ.
+
+    Returns:
+      dict: {gene: number of reads written}.
+    """
+    counts = OrderedDict((gene, 0) for gene in handles)
+    for record in records:
+        genes = assign.get(readName(record[0]), ())
+        if genes and store is not None:
+            i = store.add(record)
+        for gene in genes:
+            if store is None:
+                writeFastq(handles[gene], record)
+            else:
+                handles[gene].write('%i\n' % i)
+            counts[gene] += 1
+
+    return counts
+
+
+def routeStore(store, assign, handles):
+    """
+    Writes the read numbers of the store reads to the lists of their assigned genes
+
+    Arguments:
+      store : ReadStore of the barcode reads.
+      assign : {read ID: tuple of gene names} as returned by readAssignments.
+      handles : dictionary of {gene: output handle}.
+
+    Returns:
+      dict: {gene: number of reads written}.
+    """
+    counts = OrderedDict((gene, 0) for gene in handles)
+    for i in range(len(store)):
+        for gene in assign.get(store.name(i), ()):
+            handles[gene].write('%i\n' % i)
+            counts[gene] += 1
+
+    return counts
+
+
+def getArgParser():
+    """
+    Defines the ArgumentParser
+
+    Returns:
+      argparse.ArgumentParser: argument parser object.
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-a', action='store', dest='assign_file', required=True,
+                        help='reads.tsv read to gene assignments written by NanoIgCov.py.')
+    parser.add_argument('-c', action='store', dest='bed_file', required=True,
+                        help='Clonal_candidate.bed of the barcode.')
+    parser.add_argument('-i', action='store', dest='folder', required=True,
+                        help='Barcode folder containing .fastq and .fastq.gz chunks.')
+    parser.add_argument('-o', action='store', dest='out_dir', required=True,
+                        help='Output folder for the <prefix>-<gene>.fastq files.')
+    parser.add_argument('-p', action='store', dest='prefix', required=True,
+                        help='Output file prefix, usually the barcode name.')
+    parser.add_argument('-m', action='store', dest='min_len', type=int, default=200,
+                        help='Minimum read length.')
+    parser.add_argument('-M', action='store', dest='max_len', type=int, default=350,
+                        help='Maximum read length.')
+    parser.add_argument('-q', action='store', dest='min_qual', type=float, default=0,
+                        help='Minimum mean read quality; 0 disables the quality filter.')
+    parser.add_argument('-g', nargs='+', action='store', dest='genes', default=None,
+                        help='Route only these candidate genes.')
+    parser.add_argument('-l', action='store', dest='chunk_list', default=None,
+                        help='File listing the chunks to read instead of every chunk of the barcode folder.')
+    parser.add_argument('-s', action='store', dest='store', default=None,
+                        help='''Read store of the barcode, see NanoIgStore.py; the store read numbers of
+                             every gene are written to <prefix>-<gene>.ids instead of FASTQ files.''')
+    parser.add_argument('--build', action='store_true', dest='build',
+                        help='Build the -s store from the routed reads of the chunks instead of reading it.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and routes reads
+    """
+    parser = getArgParser()
+    args = parser.parse_args()
+    if args.build and not args.store:
+        parser.error('--build requires -s')
+
+    genes = readCandidates(args.bed_file)
+    if args.genes is not None:
+        genes = [g for g in genes if g in args.genes]
+    assign = readAssignments(args.assign_file, genes)
+    ext = 'ids' if args.store else 'fastq'
+    handles = OrderedDict((gene, open(os.path.join(args.out_dir, '%s-%s.%s' % (args.prefix, gene, ext)), 'w'))
+                          for gene in genes)
+    if args.store and not args.build:
+        with ReadStore(args.store) as store:
+            counts = routeStore(store, assign, handles)
+    else:
+        if args.chunk_list is not None:
+            with open(args.chunk_list) as f:
+                chunks = [line.strip() for line in f if line.strip()]
+        else:
+            chunks = listChunks(args.folder)
+        records = ingestReads(chunks, min_len=args.min_len, max_len=args.max_len,
+                              min_qual=args.min_qual)
+        store = StoreWriter(args.store) if args.build else None
+        counts = routeReads(records, assign, handles, store=store)
+        if store is not None:
+            store.close()
+    for handle in handles.values():
+        handle.close()
+
+    for gene, count in counts.items():
+        sys.stderr.write('%s-%s> %i\n' % (args.prefix, gene, count))
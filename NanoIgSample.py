@@ -0,0 +1,143 @@
+#!/usr/bin/python
+"""
+Keeps the best reads of a clone, ranked by quality and closeness to the amplicon length mode
+"""
+
+# Imports
+import sys
+from argparse import ArgumentParser
+from array import array
+from collections import Counter, OrderedDict
+
+# NanoIg imports
+from NanoIgIO import meanQuality, readFastq, writeFastq
+from NanoIgStore import ReadStore, readIds
+
+
+def rankReads(lengths, quals, max_reads, length_weight=0.1):
+    """
+    Selects the best reads
+
+    Reads are scored by mean quality minus length_weight times the distance of
+    their length from the modal length; ties keep the earlier read, so the
+    selection is deterministic for a given input.
+
+    Arguments:
+      lengths : read lengths in input order.
+      quals : mean read qualities in input order.
+      max_reads : number of reads to keep; all reads if 0.
+      length_weight : quality penalty per base of distance from the length mode.
+
+    Returns:
+      set: input indices of the kept reads.
+    """
+    n = len(lengths)
+    if max_reads <= 0 or n <= max_reads:
+        return set(range(n))
+    mode = Counter(lengths).most_common(1)[0][0]
+    score = [quals[k] - length_weight * abs(lengths[k] - mode) for k in range(n)]
+    ranked = sorted(range(n), key=lambda k: (-score[k], k))
+
+    return set(ranked[:max_reads])
+
+
+def sampleReads(seq_file, max_reads, length_weight=0.1, stats=None):
+    """
+    Iterates over the best reads of a FASTQ file in input order
+
+    Arguments:
+      seq_file : input FASTQ file, read twice.
+      max_reads : number of reads to keep; all reads if 0.
+      length_weight : quality penalty per base of distance from the length mode.
+      stats : optional dictionary updated with IN and KEPT counts.
+
+    Returns:
+      generator: (header, sequence, quality) tuples.
+    """
+    lengths, quals = array('l'), array('f')
+    for record in readFastq(seq_file):
+        lengths.append(len(record[1]))
+        quals.append(meanQuality(record[2]))
+    keep = rankReads(lengths, quals, max_reads, length_weight=length_weight)
+    if stats is not None:
+        stats['IN'] = len(lengths)
+        stats['KEPT'] = len(keep)
+
+    for k, record in enumerate(readFastq(seq_file)):
+        if k in keep:
+            yield record
+
+
+def sampleIds(store, ordinals, max_reads, length_weight=0.1, stats=None):
+    """
+    Selects the best reads of a store read list
+
+    Arguments:
+      store : ReadStore of the reads.
+      ordinals : list of read numbers.
+      max_reads : number of reads to keep; all reads if 0.
+      length_weight : quality penalty per base of distance from the length mode.
+      stats : optional dictionary updated with IN and KEPT counts.
+
+    Returns:
+      list: kept read numbers in input order.
+    """
+    lengths = array('l', (store.length(i) for i in ordinals))
+    quals = array('f', (meanQuality(store.quality(i)) for i in ordinals))
+    keep = rankReads(lengths, quals, max_reads, length_weight=length_weight)
+    if stats is not None:
+        stats['IN'] = len(lengths)
+        stats['KEPT'] = len(keep)
+
+    return [i for k, i in enumerate(ordinals) if k in keep]
+
+
+def getArgParser():
+    """
+    Defines the ArgumentParser
+
+    Returns:
+      argparse.ArgumentParser: argument parser object.
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-s', action='store', dest='seq_file', required=True,
+                        help='Input FASTQ file, or read number list with --store.')
+    parser.add_argument('-o', action='store', dest='out_file', required=True,
+                        help='Output FASTQ file.')
+    parser.add_argument('-n', action='store', dest='max_reads', type=int, default=500,
+                        help='Number of reads to keep; 0 keeps all reads.')
+    parser.add_argument('-w', action='store', dest='length_weight', type=float, default=0.1,
+                        help='Quality penalty per base of distance from the length mode.')
+    parser.add_argument('--log', action='store', dest='log_file', default=None,
+                        help='File receiving the read counts.')
+    parser.add_argument('--store', action='store', dest='store', default=None,
+                        help='Read store the read numbers refer to, see NanoIgStore.py.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and downsamples reads
+    """
+    args = getArgParser().parse_args()
+
+    stats = OrderedDict()
+    with open(args.out_file, 'w') as out:
+        if args.store:
+            # Only the kept reads are decoded, as FASTQ for the assembler and medaka
+            with ReadStore(args.store) as store:
+                keep = sampleIds(store, readIds(args.seq_file), args.max_reads,
+                                 length_weight=args.length_weight, stats=stats)
+                for record in store.records(keep):
+                    writeFastq(out, record)
+        else:
+            for record in sampleReads(args.seq_file, args.max_reads, length_weight=args.length_weight,
+                                      stats=stats):
+                writeFastq(out, record)
+
+    log = '\n'.join('%s> %s' % (k, v) for k, v in stats.items()) + '\n'
+    sys.stderr.write(log)
+    if args.log_file:
+        with open(args.log_file, 'w') as f:
+            f.write(log)
@@ -0,0 +1,321 @@
+#!/usr/bin/python
+"""
+Memory-mapped read store with 2-bit packed sequences, quality bytes and a read index
+"""
+
+# Imports
+import json
+import mmap
+import os
+import re
+import shutil
+import sys
+from argparse import ArgumentParser
+from array import array
+from bisect import bisect_left
+
+# NanoIg imports
+from NanoIgIO import writeFasta, writeFastq
+
+# Base codes of the packed sequences; other characters are kept in other.bin
+_encode_table = str.maketrans('ACGT', '0123')
+_other_regex = re.compile('[^0123]')
+
+# Every hex digit of a packed byte holds two bases
+_decode_table = str.maketrans({'%x' % i: 'ACGT'[i >> 2] + 'ACGT'[i & 3] for i in range(16)})
+
+# Store format version written to meta.json
+store_version = 1
+
+
+def packSequence(seq):
+    """
+    Packs a sequence into 2-bit base codes
+
+    Arguments:
+      seq : sequence string.
+
+    Returns:
+      tuple: (packed bytes, four bases per byte, list of (position, character)
+             tuples of the bases other than A, C, G and T, packed as A).
+    """
+    codes = seq.translate(_encode_table)
+    other = [(m.start(), m.group()) for m in _other_regex.finditer(codes)]
+    if other:
+        codes = _other_regex.sub('0', codes)
+    if not codes:
+        return b'', other
+    codes += '0' * (-len(codes) % 4)
+
+    return int(codes, 4).to_bytes(len(codes) // 4, 'big'), other
+
+
+def unpackSequence(packed, length):
+    """
+    Unpacks 2-bit base codes
+
+    Arguments:
+      packed : packed bytes.
+      length : number of bases.
+
+    Returns:
+      str: sequence of A, C, G and T.
+    """
+    return packed.hex().translate(_decode_table)[:length]
+
+
+def readIds(id_file):
+    """
+    Reads a read number list
+
+    Arguments:
+      id_file : text file of store read numbers, one per line.
+
+    Returns:
+      list: read numbers in file order.
+    """
+    with open(id_file) as f:
+        return [int(line) for line in f if line.strip()]
+
+
+def writeIds(id_file, ordinals):
+    """
+    Writes a read number list
+
+    Arguments:
+      id_file : output file name.
+      ordinals : iterable of store read numbers.
+
+    Returns:
+      int: number of reads written.
+    """
+    count = 0
+    with open(id_file, 'w') as f:
+        for i in ordinals:
+            f.write('%i\n' % i)
+            count += 1
+
+    return count
+
+
+class StoreWriter:
+    """
+    Writes a read store folder
+
+    The folder holds seq.bin (2-bit packed sequences, each read starting on a
+    byte), qual.bin (Phred+33 quality bytes), headers.txt (FASTQ headers),
+    other.bin (position << 8 | character of every base other than A, C, G and
+    T), index.bin (base, packed byte and header offsets of every read and of
+    the end of the store) and meta.json, written last by close.
+
+    Attributes:
+      folder : store folder, replaced if it exists.
+      reads : number of reads added.
+    """
+    def __init__(self, folder):
+        """
+        Initializer
+
+        Arguments:
+          folder : store folder.
+        """
+        self.folder = folder
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder)
+        self._seq = open(os.path.join(folder, 'seq.bin'), 'wb')
+        self._qual = open(os.path.join(folder, 'qual.bin'), 'wb')
+        self._headers = open(os.path.join(folder, 'headers.txt'), 'wb')
+        self._index, self._other = array('Q', [0, 0, 0]), array('Q')
+        self.reads = 0
+
+    def add(self, record):
+        """
+        Adds a read
+
+        Arguments:
+          record : (header, sequence, quality) tuple.
+
+        Returns:
+          int: read number of the record.
+        """
+        header, seq, qual = record
+        bases, packed_bytes, header_bytes = self._index[-3:]
+        packed, other = packSequence(seq)
+        self._other.extend((bases + pos) << 8 | ord(c) for pos, c in other)
+        self._seq.write(packed)
+        self._qual.write(qual.encode('ascii'))
+        header = (header + '\n').encode()
+        self._headers.write(header)
+        self._index.extend((bases + len(seq), packed_bytes + len(packed), header_bytes + len(header)))
+        self.reads += 1
+
+        return self.reads - 1
+
+    def close(self):
+        """
+        Writes the index and metadata files
+
+        Returns:
+          None
+        """
+        for handle in (self._seq, self._qual, self._headers):
+            handle.close()
+        with open(os.path.join(self.folder, 'index.bin'), 'wb') as f:
+            self._index.tofile(f)
+        with open(os.path.join(self.folder, 'other.bin'), 'wb') as f:
+            self._other.tofile(f)
+        with open(os.path.join(self.folder, 'meta.json'), 'w') as f:
+            json.dump({'version': store_version, 'reads': self.reads, 'bases': self._index[-3]}, f)
+
+
+class ReadStore:
+    """
+    Memory-mapped read access to a store folder written by StoreWriter
+
+    Attributes:
+      folder : store folder.
+      reads : number of reads.
+    """
+    def __init__(self, folder):
+        """
+        Initializer
+
+        Arguments:
+          folder : store folder.
+        """
+        with open(os.path.join(folder, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta.get('version') != store_version:
+            raise ValueError('Unsupported read store version in %s' % folder)
+        self.folder, self.reads = folder, meta['reads']
+        self._maps = []
+        self._seq = self._map('seq.bin')
+        self._qual = self._map('qual.bin')
+        self._headers = self._map('headers.txt')
+        self._index = memoryview(self._map('index.bin')).cast('Q')
+        self._other = memoryview(self._map('other.bin')).cast('Q')
+
+    def _map(self, name):
+        with open(os.path.join(self.folder, name), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            self._maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        return self._maps[-1]
+
+    def __len__(self):
+        return self.reads
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+        Releases the memory maps
+
+        Returns:
+          None
+        """
+        self._index.release()
+        self._other.release()
+        for m in self._maps:
+            m.close()
+
+    def length(self, i):
+        """
+        Returns the length of read i
+        """
+        return self._index[3 * i + 3] - self._index[3 * i]
+
+    def header(self, i):
+        """
+        Returns the FASTQ header of read i, without the leading @
+        """
+        return self._headers[self._index[3 * i + 2]:self._index[3 * i + 5] - 1].decode()
+
+    def name(self, i):
+        """
+        Returns the read identifier of read i
+        """
+        header = self._headers[self._index[3 * i + 2]:self._index[3 * i + 5] - 1]
+        return header.split(None, 1)[0].decode() if header else ''
+
+    def sequence(self, i):
+        """
+        Returns the sequence of read i
+        """
+        start, end = self._index[3 * i], self._index[3 * i + 3]
+        seq = unpackSequence(self._seq[self._index[3 * i + 1]:self._index[3 * i + 4]], end - start)
+        k = bisect_left(self._other, start << 8)
+        if k == len(self._other) or self._other[k] >> 8 >= end:
+            return seq
+        seq = list(seq)
+        while k < len(self._other) and self._other[k] >> 8 < end:
+            seq[(self._other[k] >> 8) - start] = chr(self._other[k] & 0xff)
+            k += 1
+        return ''.join(seq)
+
+    def quality(self, i):
+        """
+        Returns the Phred+33 quality string of read i
+        """
+        return self._qual[self._index[3 * i]:self._index[3 * i + 3]].decode('ascii')
+
+    def record(self, i):
+        """
+        Returns read i as a (header, sequence, quality) tuple
+        """
+        return self.header(i), self.sequence(i), self.quality(i)
+
+    def records(self, ordinals=None):
+        """
+        Iterates over reads
+
+        Arguments:
+          ordinals : iterable of read numbers; every read if None.
+
+        Returns:
+          generator: (header, sequence, quality) tuples.
+        """
+        for i in range(self.reads) if ordinals is None else ordinals:
+            yield self.record(i)
+
+
+def getArgParser():
+    """
+    Defines the ArgumentParser
+
+    Returns:
+      argparse.ArgumentParser: argument parser object.
+    """
+    parser = ArgumentParser(description=__doc__,
+                            epilog='Stores are built by NanoIgIngest.py --store and NanoIgRoute.py --build.')
+    parser.add_argument('-s', action='store', dest='store', required=True,
+                        help='Read store folder.')
+    parser.add_argument('-i', action='store', dest='id_file', default=None,
+                        help='Read number list; every read if not given.')
+    parser.add_argument('-o', action='store', dest='out_file', default=None,
+                        help='Output file; defaults to standard output.')
+    parser.add_argument('--fasta', action='store_true', dest='fasta',
+                        help='Write FASTA instead of FASTQ.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and extracts reads
+    """
+    args = getArgParser().parse_args()
+
+    write = writeFasta if args.fasta else writeFastq
+    ordinals = readIds(args.id_file) if args.id_file else None
+    out = open(args.out_file, 'w') if args.out_file else sys.stdout
+    with ReadStore(args.store) as store:
+        for record in store.records(ordinals):
+            write(out, record)
+    out.flush()
+    if args.out_file:
+        out.close()
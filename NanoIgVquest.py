@@ -0,0 +1,249 @@
+#!/usr/bin/python
+"""
+Queries IMGT/V-Quest over HTTP in chunks, caching the result of every sequence on disk
+"""
+
+# Imports
+import hashlib
+import html
+import json
+import os
+import re
+import sys
+import urllib.parse
+import urllib.request
+from argparse import ArgumentParser
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# NanoIg imports
+from NanoIgIO import readFasta
+
+# V-Quest analysis endpoint; NANOIG_VQUEST_URL points the client at another server
+default_vquest_url = os.environ.get('NANOIG_VQUEST_URL', 'http://www.imgt.org/IMGT_vquest/analysis')
+
+# Form fields of the analysis the report reads: human IG, synthesis view as text,
+# V genes in input order and insertion/deletion search in the V-REGION
+default_vquest_params = OrderedDict([('species', 'human'),
+                                     ('receptorOrLocusType', 'IG'),
+                                     ('inputType', 'inline'),
+                                     ('resultType', 'synthesis'),
+                                     ('outputType', 'text'),
+                                     ('sv_V_GENEordertable', 'input'),
+                                     ('V_REGIONsearchIndel', 'true')])
+
+# Sequences per submission; V-Quest accepts at most 50 sequences per analysis
+default_chunk_size = 50
+
+default_cache_dir = os.environ.get('NANOIG_VQUEST_CACHE',
+                                   os.path.join(os.path.expanduser('~'), '.cache', 'nanoig', 'vquest'))
+
+
+def cacheKey(seq, params):
+    """
+    Computes the cache key of a sequence analysis
+
+    Arguments:
+      seq : nucleotide sequence.
+      params : dictionary of V-Quest form fields.
+
+    Returns:
+      str: sha256 hex digest of the parameters and the upper case sequence.
+    """
+    text = json.dumps(sorted(params.items())) + '\n' + seq.upper()
+
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def readCache(cache_dir, key):
+    """
+    Reads a cached value
+
+    Arguments:
+      cache_dir : cache folder.
+      key : cache key.
+
+    Returns:
+      str: the cached value, or None if not cached.
+    """
+    name = os.path.join(cache_dir, key[:2], key)
+    if not os.path.exists(name):
+        return None
+    with open(name) as f:
+        return f.read()
+
+
+def writeCache(cache_dir, key, value):
+    """
+    Stores a value in the cache, replacing the file atomically
+
+    Arguments:
+      cache_dir : cache folder.
+      key : cache key.
+      value : string to store.
+
+    Returns:
+      None
+    """
+    folder = os.path.join(cache_dir, key[:2])
+    os.makedirs(folder, exist_ok=True)
+    tmp = os.path.join(folder, '.%s.%i' % (key, os.getpid()))
+    with open(tmp, 'w') as f:
+        f.write(value)
+    os.replace(tmp, os.path.join(folder, key))
+
+
+def submitChunk(records, url=default_vquest_url, params=default_vquest_params, timeout=600):
+    """
+    Submits one chunk of sequences to V-Quest
+
+    Arguments:
+      records : list of (header, sequence) tuples.
+      url : analysis endpoint.
+      params : dictionary of V-Quest form fields.
+      timeout : request timeout in seconds.
+
+    Returns:
+      str: the response text; the content of the first <pre> block for HTML responses.
+    """
+    form = OrderedDict(params)
+    form['sequences'] = ''.join('>%s\n%s\n' % (h, s) for h, s in records)
+    request = urllib.request.Request(url, data=urllib.parse.urlencode(form).encode())
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        text = response.read().decode(response.headers.get_content_charset() or 'utf-8')
+
+    pre = re.search(r'<pre[^>]*>(.*?)</pre>', text, re.S | re.I)
+    if pre:
+        text = html.unescape(re.sub(r'<[^>]+>', '', pre.group(1)))
+
+    return text
+
+
+def parseSynthesis(text):
+    """
+    Parses the synthesis view text of a V-Quest analysis
+
+    Arguments:
+      text : V-Quest synthesis text with semicolon separated fields.
+
+    Returns:
+      tuple: (column header line or None, {sequence number: fields after the sequence ID}).
+    """
+    header, rows = None, {}
+    for line in text.splitlines():
+        fields = line.split(';')
+        if 'Sequence Number' in line:
+            header = line
+        elif len(fields) > 2 and fields[0].strip().isdigit():
+            rows[int(fields[0])] = fields[2:]
+
+    return header, rows
+
+
+def queryVquest(records, url=default_vquest_url, params=default_vquest_params, cache_dir=default_cache_dir,
+                chunk_size=default_chunk_size, workers=2, timeout=600, stats=None):
+    """
+    Annotates sequences with V-Quest, submitting only sequences missing from the cache
+
+    Identical sequences are submitted once. Sequences missing from a V-Quest
+    response are not cached and have no result row.
+
+    Arguments:
+      records : list of (header, sequence) tuples.
+      url : analysis endpoint.
+      params : dictionary of V-Quest form fields.
+      cache_dir : cache folder.
+      chunk_size : maximum number of sequences per submission.
+      workers : maximum number of concurrent submissions.
+      timeout : request timeout in seconds.
+      stats : optional dictionary updated with IN, CACHED, SUBMITTED and MISSING counts.
+
+    Returns:
+      tuple: (column header line or None, list of result lines in input order).
+    """
+    header_key = cacheKey('#header', params)
+    header = readCache(cache_dir, header_key)
+    keys = [cacheKey(s, params) for h, s in records]
+    cached = {k: readCache(cache_dir, k) for k in set(keys)}
+    missing = OrderedDict()
+    for (h, s), k in zip(records, keys):
+        if cached[k] is None and k not in missing:
+            missing[k] = (h, s)
+
+    # Submit the uncached sequences in chunks
+    pending = list(missing.items())
+    chunks = [pending[i:i + chunk_size] for i in range(0, len(pending), chunk_size)]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [pool.submit(submitChunk, [r for k, r in c], url=url, params=params, timeout=timeout)
+                   for c in chunks]
+        for c, future in zip(chunks, futures):
+            chunk_header, rows = parseSynthesis(future.result())
+            if chunk_header is not None and header is None:
+                header = chunk_header
+                writeCache(cache_dir, header_key, header)
+            for n, (k, r) in enumerate(c, start=1):
+                if n in rows:
+                    cached[k] = ';'.join(rows[n])
+                    writeCache(cache_dir, k, cached[k])
+
+    # Renumber and relabel the result rows in input order
+    lines, n = [], 0
+    for (h, s), k in zip(records, keys):
+        if cached[k] is not None:
+            n += 1
+            lines.append('%i;%s;%s' % (n, h, cached[k]))
+    if stats is not None:
+        stats['IN'] = len(records)
+        stats['CACHED'] = len(records) - sum(1 for k in keys if k in missing)
+        stats['SUBMITTED'] = len(missing)
+        stats['MISSING'] = len(records) - n
+
+    return header, lines
+
+
+def getArgParser():
+    """
+    Defines the ArgumentParser
+
+    Returns:
+      argparse.ArgumentParser: argument parser object.
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-i', action='store', dest='seq_file', required=True,
+                        help='Input FASTA file, e.g. Results.fasta.')
+    parser.add_argument('-o', action='store', dest='out_file', required=True,
+                        help='Output V-Quest synthesis text, e.g. V_quest.txt.')
+    parser.add_argument('--url', action='store', dest='url', default=default_vquest_url,
+                        help='V-Quest analysis endpoint.')
+    parser.add_argument('--param', action='append', dest='params', default=[], metavar='FIELD=VALUE',
+                        help='Override or add a V-Quest form field; may be repeated.')
+    parser.add_argument('--cache', action='store', dest='cache_dir', default=default_cache_dir,
+                        help='Result cache folder.')
+    parser.add_argument('--chunk', action='store', dest='chunk_size', type=int, default=default_chunk_size,
+                        help='Maximum number of sequences per submission.')
+    parser.add_argument('-j', action='store', dest='workers', type=int, default=2,
+                        help='Maximum number of concurrent submissions.')
+    parser.add_argument('--timeout', action='store', dest='timeout', type=int, default=600,
+                        help='Request timeout in seconds.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and writes the V-Quest results
+    """
+    args = getArgParser().parse_args()
+    params = OrderedDict(default_vquest_params)
+    params.update(p.split('=', 1) for p in args.params)
+
+    stats = OrderedDict()
+    header, lines = queryVquest(list(readFasta(args.seq_file)), url=args.url, params=params,
+                                cache_dir=args.cache_dir, chunk_size=args.chunk_size, workers=args.workers,
+                                timeout=args.timeout, stats=stats)
+    with open(args.out_file, 'w') as out:
+        if header is not None:
+            out.write(header + '\n')
+        for line in lines:
+            out.write(line + '\n')
+    sys.stderr.write(''.join('%s> %s\n' % (k, v) for k, v in stats.items()))
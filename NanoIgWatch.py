@@ -0,0 +1,288 @@
+#!/usr/bin/python
+"""
+Follows a sequencing run, updating VH gene coverage as FASTQ chunks arrive and starting each clone as soon as it is stable
+"""
+
+# Imports
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from array import array
+
+# NanoIg imports
+from NanoIgCov import IntervalIndex, countSam, readBed, writeCoverage
+from NanoIgIngest import ingestReads, listChunks
+from NanoIgIO import writeFasta
+
+
+class BarcodeWatch:
+    """
+    Incremental coverage of one barcode
+
+    Attributes:
+      barcode : barcode name.
+      folder : barcode FASTQ folder.
+      out_dir : PIPE/Clonality/<barcode> folder receiving coverage.bed,
+                Clonal_candidate.bed, reads.tsv and chunks.txt, the list of
+                aligned chunks; clone jobs may read them at any time, so every
+                update replaces them atomically.
+      sizes : {chunk: size at the previous poll} of the chunks not yet aligned.
+      done : aligned chunks.
+      counts : read count per BED interval.
+      history : fraction of the assigned reads per BED interval after each update.
+      started : genes whose consensus job was started.
+    """
+    def __init__(self, barcode, folder, out_dir, n):
+        """
+        Initializer
+
+        Arguments:
+          barcode : barcode name.
+          folder : barcode FASTQ folder.
+          out_dir : coverage output folder, created if missing.
+          n : number of BED intervals.
+        """
+        self.barcode, self.folder, self.out_dir = barcode, folder, out_dir
+        self.sizes, self.done = {}, set()
+        self.counts = array('l', bytes(array('l').itemsize * n))
+        self.history, self.started = [], set()
+        os.makedirs(os.path.join(out_dir, 'watch'), exist_ok=True)
+        for name in ('reads.tsv', 'chunks.txt'):
+            open(os.path.join(out_dir, name), 'w').close()
+
+    def readyChunks(self, final=False):
+        """
+        Finds the new chunks that are completely written
+
+        A chunk is complete once its size is unchanged between two polls.
+
+        Arguments:
+          final : return every new chunk, as the run has ended.
+
+        Returns:
+          list: sorted chunk file names.
+        """
+        ready = []
+        for chunk in listChunks(self.folder):
+            if chunk in self.done:
+                continue
+            size = os.path.getsize(chunk)
+            if final or self.sizes.get(chunk) == size:
+                ready.append(chunk)
+            self.sizes[chunk] = size
+
+        return ready
+
+    def update(self, chunks, align_cmd, bed, index, ingest_args, min_count=500):
+        """
+        Aligns new chunks and adds their reads to the coverage
+
+        Arguments:
+          chunks : chunk file names.
+          align_cmd : aligner command reading FASTA on stdin and writing SAM.
+          bed : list of intervals as returned by readBed.
+          index : IntervalIndex of bed.
+          ingest_args : dictionary of ingestReads filter arguments.
+          min_count : minimum read count of a clonal candidate gene.
+
+        Returns:
+          None
+        """
+        # Aligner messages, e.g. a missing index, go to the barcode log
+        proc = subprocess.Popen(align_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+
+        # Feed the filtered reads from a thread while the alignments are counted
+        def feed():
+            # A failing aligner closes the pipe; its exit status is reported below
+            try:
+                for record in ingestReads(chunks, **ingest_args):
+                    writeFasta(proc.stdin, record)
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        staging = os.path.join(self.out_dir, 'watch')
+        shutil.copyfile(os.path.join(self.out_dir, 'reads.tsv'), os.path.join(staging, 'reads.tsv'))
+        with open(os.path.join(staging, 'reads.tsv'), 'a') as reads:
+            def assign(read_id, hits):
+                for i in hits:
+                    reads.write('%s\t%s\n' % (read_id, bed[i][3]))
+            counts = countSam(proc.stdout, index, len(bed), assign=assign)
+        feeder.join()
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, align_cmd)
+
+        for i, count in enumerate(counts):
+            self.counts[i] += count
+        total = sum(self.counts)
+        self.history.append([c / total if total else 0.0 for c in self.counts])
+        self.done.update(chunks)
+        writeCoverage(bed, self.counts, staging, min_count=min_count)
+        with open(os.path.join(staging, 'chunks.txt'), 'w') as f:
+            f.write(''.join('%s\n' % c for c in sorted(self.done)))
+        for name in ('coverage.bed', 'Clonal_candidate.bed', 'reads.tsv', 'chunks.txt'):
+            os.replace(os.path.join(staging, name), os.path.join(self.out_dir, name))
+
+    def stableGenes(self, names, min_count=500, updates=2, tolerance=0.02):
+        """
+        Lists the candidate genes whose coverage is high enough and stable
+
+        Arguments:
+          names : BED interval names.
+          min_count : minimum read count.
+          updates : number of last coverage updates compared.
+          tolerance : largest change of the gene read fraction across these updates.
+
+        Returns:
+          list: gene names not started yet.
+        """
+        if len(self.history) < updates:
+            return []
+        recent = self.history[-updates:]
+        stable = []
+        for i, name in enumerate(names):
+            if self.counts[i] < min_count or name in self.started:
+                continue
+            fractions = [h[i] for h in recent]
+            if max(fractions) - min(fractions) <= tolerance:
+                stable.append(name)
+
+        return stable
+
+
+def getArgParser():
+    """
+    Defines the ArgumentParser
+
+    Returns:
+      argparse.ArgumentParser: argument parser object.
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('input', help='Run folder whose fastq/BarcodeXX folders are being written.')
+    parser.add_argument('run', help='NanoIg package folder.')
+    parser.add_argument('-t', action='store', dest='threads', type=int, default=1,
+                        help='Threads of the aligner and of each clone job.')
+    parser.add_argument('-j', action='store', dest='jobs', type=int, default=2,
+                        help='Maximum number of concurrent clone jobs.')
+    parser.add_argument('-c', action='store', dest='min_count', type=int, default=500,
+                        help='Minimum read count of a clonal candidate gene.')
+    parser.add_argument('--stable', action='store', dest='updates', type=int, default=2,
+                        help='Number of coverage updates over which a clone must be stable.')
+    parser.add_argument('--tolerance', action='store', dest='tolerance', type=float, default=0.02,
+                        help='Largest change of the gene read fraction of a stable clone.')
+    parser.add_argument('--interval', action='store', dest='interval', type=float, default=60,
+                        help='Seconds between polls of the barcode folders.')
+    parser.add_argument('--idle', action='store', dest='idle', type=float, default=1800,
+                        help='The run has ended when no chunk arrived for this many seconds.')
+    parser.add_argument('--done', action='store', dest='done_pattern', default='final_summary*.txt',
+                        help='''The run has ended when a file matching this pattern exists in the
+                             run folder; MinKNOW writes final_summary_*.txt at the end of a run.''')
+    parser.add_argument('-m', action='store', dest='min_len', type=int, default=200,
+                        help='Minimum read length.')
+    parser.add_argument('-M', action='store', dest='max_len', type=int, default=350,
+                        help='Maximum read length.')
+    parser.add_argument('-q', action='store', dest='min_qual', type=float, default=0,
+                        help='Minimum mean read quality; 0 disables the quality filter.')
+    parser.add_argument('-o', action='store', dest='pipe_opts', default='',
+                        help='Additional PipeIg.sh options passed to every clone job, e.g. "-a fast".')
+
+    return parser
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and follows the run
+    """
+    args = getArgParser().parse_args()
+
+    path, run = os.path.abspath(args.input), os.path.abspath(args.run)
+    bed_file = os.path.join(run, 'Chr14', 'UCSC_hg38_VH_genes.bed')
+    chrom_file = os.path.join(run, 'Chr14', 'chr14.fa')
+    bed = readBed(bed_file)
+    names = [interval[3] for interval in bed]
+    index = IntervalIndex(bed)
+    align_cmd = ['bwa', 'mem', '-x', 'ont2d', '-t', str(args.threads), chrom_file, '-']
+    ingest_args = {'min_len': args.min_len, 'max_len': args.max_len, 'min_qual': args.min_qual}
+    pipe_cmd = ['bash', os.path.join(run, 'PipeIg.sh'), '-i', path, '-r', run, '-t', str(args.threads),
+                '-q', str(args.min_qual)] + args.pipe_opts.split()
+
+    watches, queue, jobs, status = {}, [], {}, {}
+    start, last_chunk = time.time(), time.time()
+
+    def startJobs():
+        """
+        Starts queued clone jobs up to the job limit and collects finished ones
+        """
+        for key, (proc, log) in list(jobs.items()):
+            if proc.poll() is not None:
+                log.close()
+                status[key] = proc.returncode
+                del jobs[key]
+                print('%s> %s %s (%.0f s)' % ('DONE' if proc.returncode == 0 else 'FAILED', key[0], key[1],
+                                              time.time() - start))
+        while queue and len(jobs) < args.jobs:
+            barcode, gene = queue.pop(0)
+            log = open(os.path.join(path, 'PIPE', barcode, 'PipeIg-%s.log' % gene), 'w')
+            cmd = pipe_cmd + ['-b', barcode, '-g', gene]
+            jobs[(barcode, gene)] = (subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT), log)
+
+    final = False
+    while True:
+        ended = bool(glob.glob(os.path.join(path, args.done_pattern))) or \
+            time.time() - last_chunk > args.idle
+        for barcode in sorted(os.listdir(os.path.join(path, 'fastq'))):
+            if barcode not in watches:
+                os.makedirs(os.path.join(path, 'PIPE', barcode), exist_ok=True)
+                watches[barcode] = BarcodeWatch(barcode, os.path.join(path, 'fastq', barcode),
+                                                os.path.join(path, 'PIPE', 'Clonality', barcode), len(bed))
+            watch = watches[barcode]
+            chunks = watch.readyChunks(final=final)
+            if chunks:
+                last_chunk = time.time()
+                watch.update(chunks, align_cmd, bed, index, ingest_args, min_count=args.min_count)
+                print('CHUNKS> %s %i (%.0f s)' % (barcode, len(watch.done), time.time() - start))
+
+            # At the end of the run every remaining candidate is started
+            if final:
+                genes = [n for n, c in zip(names, watch.counts) if c >= args.min_count and n not in watch.started]
+            else:
+                genes = watch.stableGenes(names, min_count=args.min_count, updates=args.updates,
+                                          tolerance=args.tolerance)
+            for gene in genes:
+                watch.started.add(gene)
+                queue.append((barcode, gene))
+                print('CLONE> %s %s %i reads (%.0f s)' % (barcode, gene, watch.counts[names.index(gene)],
+                                                          time.time() - start))
+        startJobs()
+        if final:
+            break
+        final = ended
+        if not final:
+            time.sleep(args.interval)
+
+    while jobs or queue:
+        time.sleep(1)
+        startJobs()
+
+    # Gather the clone results in barcode and candidate order
+    with open(os.path.join(path, 'Results.fasta'), 'w') as out:
+        for barcode, watch in sorted(watches.items()):
+            with open(os.path.join(path, 'PIPE', barcode, 'Results.fasta'), 'w') as fragment:
+                for name, count in zip(names, watch.counts):
+                    clone = os.path.join(path, 'PIPE', barcode, 'Assembly-%s-%s' % (barcode, name), 'Results.fasta')
+                    if count >= args.min_count and os.path.exists(clone):
+                        with open(clone) as f:
+                            text = f.read()
+                        fragment.write(text)
+                        out.write(text)
+
+    failed = sorted('%s-%s' % key for key, code in status.items() if code != 0)
+    if failed:
+        print('Failed clones: ' + ', '.join(failed))
+        sys.exit(1)
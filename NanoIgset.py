@@ -1,35 +1,145 @@
 #!/usr/bin/python
 
-import sys, os
+import sys, os, time, subprocess
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+from NanoIgExec import backends, gatherResults, runPlate
+from NanoIgProf import profileProcess
 
 
 def pypath(folder):
     pyfolder=''
     pyfolder=folder.replace('\\','/')
     pyfolder=pyfolder.replace('\\\\','/')
-    
+
     return pyfolder
 
-path=pypath(sys.argv[1])
-run=pypath(sys.argv[2])
+
+def splitThreads(threads, barcodes):
+    """
+    Splits a global thread budget across concurrently running barcodes
+
+    Arguments:
+      threads : total number of threads available to the run.
+      barcodes : number of barcodes to process.
+
+    Returns:
+      list: number of threads assigned to each barcode, in barcode order;
+            the list length is the number of concurrent barcode jobs.
+    """
+    jobs = max(1, min(barcodes, threads))
+    share, extra = divmod(max(threads, jobs), jobs)
+
+    return [share + 1 if i < extra else share for i in range(jobs)]
+
+
+def runBarcode(barcode, cmd, log_file):
+    """
+    Runs the PipeIg.sh command of a single barcode
+
+    Arguments:
+      barcode : barcode name.
+      cmd : list of command arguments.
+      log_file : file receiving the stdout and stderr of the command.
+
+    Returns:
+      tuple: (barcode, exit status, wall time in seconds).
+    """
+    start = time.time()
+    with open(log_file, 'w') as log:
+        status = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT)
+
+    return barcode, status, time.time() - start
+
+
+def runBarcodes(BClist, commands, threads, path):
+    """
+    Runs barcodes concurrently in a process pool and records their exit status
+
+    Arguments:
+      BClist : sorted list of barcode names.
+      commands : dictionary of {barcode: command argument list without thread count}.
+      threads : total number of threads shared by all barcode jobs.
+      path : data folder.
+
+    Returns:
+      dict: {barcode: exit status}.
+    """
+    budget = splitThreads(threads, len(BClist))
+    status = {}
+
+    with ProcessPoolExecutor(max_workers=len(budget)) as pool:
+        futures = []
+        for i, BC in enumerate(BClist):
+            cmd = commands[BC] + ['-t', str(budget[i % len(budget)])]
+            log_file = os.path.join(path, 'PIPE', BC, 'PipeIg.log')
+            futures.append(pool.submit(runBarcode, BC, cmd, log_file))
+
+        with open(os.path.join(path, 'PIPE', 'barcode_status.tsv'), 'w') as f:
+            f.write('barcode\tstatus\tseconds\n')
+            for future in futures:
+                BC, code, seconds = future.result()
+                status[BC] = code
+                f.write('%s\t%i\t%.1f\n' % (BC, code, seconds))
+                print('%s: %s (%.1f s)' % (BC, 'done' if code == 0 else 'FAILED exit %i' % code, seconds))
+
+    # Gather per-barcode results in barcode order
+    gatherResults(path, BClist)
+
+    return status
+
+
+parser = ArgumentParser(description='Sets up the NanoIg work directories and barcode commands.')
+parser.add_argument('input', help='Data folder containing the fastq/BarcodeXX folders.')
+parser.add_argument('run', help='NanoIg package folder.')
+parser.add_argument('-t', action='store', dest='threads', type=int, default=None,
+                    help='''Run barcodes concurrently sharing this many threads
+                         instead of only writing bashexec.txt.''')
+parser.add_argument('-o', action='store', dest='pipe_opts', default='',
+                    help='Additional PipeIg.sh options passed to every barcode, e.g. "-a fast".')
+parser.add_argument('--batch-polish', action='store_true', dest='batch_polish',
+                    help='''With -t, draft every barcode first and polish all clones with a single
+                         NanoIgPolish.py medaka run before masking.''')
+parser.add_argument('--exec', action='store', dest='backend', choices=sorted(backends), default=None,
+                    help='''With -t, run every barcode as a NanoIgExec.py shard of this backend; on slurm
+                         and sge -t is the thread count of every shard.''')
+parser.add_argument('--clones', action='store_true', dest='clones',
+                    help='With --exec, run the polishing of every clone as a shard of its own.')
+parser.add_argument('--retries', action='store', dest='retries', type=int, default=2,
+                    help='With --exec, number of resubmissions of a failed shard.')
+parser.add_argument('--stage', action='store', dest='stage_dir', default=None,
+                    help='''With --exec, copy every barcode to this node scratch folder for its shard
+                         and its outputs back.''')
+parser.add_argument('--exec-opts', action='store', dest='exec_opts', default='',
+                    help='Additional sbatch or qsub arguments, e.g. "-p long".')
+args = parser.parse_args()
+if args.stage_dir is not None and args.clones:
+    parser.error('--stage cannot be combined with --clones, whose shards read the drafts in place')
+if args.backend is not None and args.batch_polish:
+    parser.error('--batch-polish cannot be combined with --exec; use --clones')
+telemetry = profileProcess('NanoIgset')
+
+path=pypath(args.input)
+run=pypath(args.run)
 
 BClist = [f for f in os.listdir(path+"/fastq")]
 BClist.sort()
 
 # work directory setting
 
-os.chdir(path) 
+os.chdir(path)
 
-os.mkdir(path +'/PIPE')
-os.mkdir(path +'/PIPE/Clonality')
+# Existing folders are kept, so a rerun resumes from the stage checkpoints
+os.makedirs(path +'/PIPE/Clonality', exist_ok=True)
 
 
 for subdir, dirs, files in os.walk(path+'/fastq'):
     for dir in dirs:
-        os.mkdir(os.path.join(path + '/PIPE/'+ dir))
-        os.mkdir(os.path.join(path + '/PIPE/Clonality/'+ dir))
+        os.makedirs(os.path.join(path + '/PIPE/'+ dir), exist_ok=True)
+        os.makedirs(os.path.join(path + '/PIPE/Clonality/'+ dir), exist_ok=True)
         print(os.path.join(path + '/PIPE/Clonality/'+ dir))
-        
+
 
 def find(name, path):
     for root, dirs, files in os.walk(path):
@@ -39,14 +149,42 @@ def find(name, path):
 #Run Linux script
 
 Bashlist=[]
+commands={}
 
 for BC in BClist:
     sh=run.replace("/NanoIgset.py", "") + '/PipeIg.sh'
     #sub1="bash -c " + '"' + convertpath(sh) + " -i " + convertpath(path) + " -b " + BC + " -r " + convertpath(run) + '"'
     sub1="bash " + sh + " -i " + path + " -b " + BC + " -r " + run
+    if args.pipe_opts:
+        sub1 += " " + args.pipe_opts
 
     Bashlist.append(sub1)
-    
+    commands[BC] = ['bash', sh.replace('//', '/'), '-i', path, '-b', BC, '-r', run.replace('//', '/')] + args.pipe_opts.split()
+
 with open(run+'/bashexec.txt', 'w') as f:
     for item in Bashlist:
         f.write("%s\n" % item)
+
+# Driver mode
+
+if args.threads is not None:
+    if args.backend is not None:
+        # Executor mode: every barcode is a shard of the local machine or of a cluster
+        if args.backend == 'local':
+            budget = splitThreads(args.threads, len(BClist))
+            backend, shard_threads = backends['local'](slots=len(budget)), budget[-1]
+        else:
+            backend, shard_threads = backends[args.backend](options=args.exec_opts), args.threads
+        status = runPlate(path, run.replace('//', '/'), BClist, commands, backend, threads=shard_threads,
+                          clones=args.clones, retries=args.retries, stage_dir=args.stage_dir)
+    else:
+        if args.batch_polish:
+            # The first pass stops every clone after its draft, the second one masks the polished clones
+            runBarcodes(BClist, {BC: commands[BC] + ['-d'] for BC in BClist}, args.threads, path)
+            subprocess.call([sys.executable, run.replace('//', '/') + '/NanoIgPolish.py', path, '-t', str(args.threads)])
+        status = runBarcodes(BClist, commands, args.threads, path)
+    telemetry['counts'] = {'BARCODES': len(BClist), 'FAILED': sum(1 for BC in BClist if status[BC] != 0)}
+    failed = [BC for BC in BClist if status[BC] != 0]
+    if failed:
+        print('Failed barcodes: ' + ', '.join(failed))
+        sys.exit(1)
@@ -1,61 +1,133 @@
 #!/bin/bash
 
-	while getopts i:b:r: flag
+	while getopts i:b:r:t:q:a:n:g:c:d flag
 do
     case "${flag}" in
         i) input=${OPTARG};;
 	b) barcode=${OPTARG};;
 	r) run=${OPTARG};;
+	t) threads=${OPTARG};;
+	q) minqual=${OPTARG};;
+	a) assembler=${OPTARG};;
+	n) maxreads=${OPTARG};;
+	g) clone_gene=${OPTARG};;
+	c) classifier=${OPTARG};;
+	d) defer=1;;
     esac
 done
 
+set -o pipefail
 
-cat $input/fastq/$barcode/*.fastq > $input/fastq/$barcode/total.fastq
-seqtk seq -a $input/fastq/$barcode/total.fastq > $input/fastq/$barcode/total.fasta
+# Telemetry: the stages of each barcode are recorded in its own JSON lines file
+if [ -n "$NANOIG_TELEMETRY" ]; then
+	export NANOIG_TELEMETRY=$input/PIPE/$barcode/telemetry.jsonl
+fi
 
+# Thread budget: without -t keep the historical bwa -t 8 / medaka -t 1 setting
+bwa_threads=${threads:-8}
+medaka_threads=${threads:-1}
+canu_threads=""
+if [ -n "$threads" ]; then
+	canu_threads="-t $threads"
+fi
 
-cd $input/PIPE/Clonality
-bwa mem -x ont2d -t 8 $run/Chr14/chr14.fa $input/fastq/$barcode/total.fasta | samtools sort -o $input/PIPE/Clonality/$barcode/sample.sorted.bam -T reads.tmp
-samtools index $input/PIPE/Clonality/$barcode/sample.sorted.bam
-bedtools multicov -bams $input/PIPE/Clonality/$barcode/sample.sorted.bam -bed $run/Chr14/UCSC_hg38_VH_genes.bed > $input/PIPE/Clonality/$barcode/coverage.bed
-awk '{ if($5 >= 500) { print }}' $input/PIPE/Clonality/$barcode/coverage.bed > $input/PIPE/Clonality/$barcode/Clonal_candidate.bed
-cd $input/PIPE/Clonality/$barcode/
-gnuplot $run/PlotClone
+# Read filters applied while streaming the barcode chunks
+minlen=200
+maxlen=350
+minqual=${minqual:-0}
 
+# Reads kept per clone for assembly and polishing; 0 keeps all
+maxreads=${maxreads:-500}
 
-peaks=$(wc --lines < $input/PIPE/Clonality/$barcode/Clonal_candidate.bed)
-	for j in `seq 1 $peaks`; do
-		start=$(awk NR==$j'{print $2}' $input/PIPE/Clonality/$barcode/Clonal_candidate.bed)
-		end=$(awk NR==$j'{print $3}' $input/PIPE/Clonality/$barcode/Clonal_candidate.bed)
-		gene=$(awk NR==$j'{print $4}' $input/PIPE/Clonality/$barcode/Clonal_candidate.bed)
+# Draft builder: canu (default) or fast, the in-process consensus with canu as fallback
+assembler=${assembler:-canu}
+
+# VH gene assignment: bwa (default) or minimizer, the NanoIgClassify.py vote without chr14 alignment
+classifier=${classifier:-bwa}
+
+# Deferred polishing (-d): clones stop after the draft and NanoIgPolish.py polishes
+# the drafts of the whole run at once; the next PipeIg.sh run masks them
+polishopts=""
+
+# Primer masking: the shared MaskPrimers.py serve process when NanoIg.sh runs one
+mask="python $run/MaskPrimers.py pair"
+if [ -n "$NANOIG_MASK_SOCKET" ] && [ -S "$NANOIG_MASK_SOCKET" ]; then
+	mask="python $run/MaskClient.py pair -S $NANOIG_MASK_SOCKET"
+fi
+
+# Stage checkpoints: a stage is skipped when its inputs, parameters and outputs are unchanged
+check="python $run/NanoIgCheck.py -d $input/PIPE/$barcode/checkpoints"
+clone=$input/PIPE/Clonality/$barcode
+chrom=$run/Chr14/chr14.fa
+genes_bed=$run/Chr14/UCSC_hg38_VH_genes.bed
+
+status=0
+
+# Single clone mode (-g): coverage is kept up to date by NanoIgWatch.py and only
+# the given gene is routed and assembled, into its own Assembly-*/Results.fasta
+if [ -z "$clone_gene" ]; then
+	: > $input/PIPE/$barcode/Results.fasta
+
+	# Ingest, coverage, routing, filtering, sub-clone clustering and sampling run in one process; only
+	# the coverage files, the read store, the sampled reads of every clone and its name are written
+	python $run/NanoIgPipe.py -i $input/fastq/$barcode -o $input/PIPE/$barcode -C $clone -p $barcode -d $input/PIPE/$barcode/checkpoints \
+		-r $chrom -b $genes_bed -m $minlen -M $maxlen -q $minqual -c 500 -n $maxreads -t $bwa_threads --classifier $classifier \
+		--fwd $run/For_primers.fasta --rev $run/Rev_primer.fasta || exit 1
+	genes=$(cat $input/PIPE/$barcode/clones.txt)
+else
+	# Coverage is still growing, so the routed reads of the clone get their own store
+	store=$input/PIPE/$barcode/$barcode-$clone_gene.store
+	genes=$clone_gene
+	name=$barcode-$clone_gene
+	# Only the chunks aligned so far are routed, so they, and not the whole barcode folder, are the inputs
+	chunks=$(cat $clone/chunks.txt)
+	$check -n route-$clone_gene -i $clone/reads.tsv $clone/Clonal_candidate.bed $clone/chunks.txt $chunks -p minlen=$minlen maxlen=$maxlen minqual=$minqual \
+		-o $input/PIPE/$barcode/$name.ids $store \
+		-c "python $run/NanoIgRoute.py -a $clone/reads.tsv -c $clone/Clonal_candidate.bed -i $input/fastq/$barcode -m $minlen -M $maxlen -q $minqual -o $input/PIPE/$barcode -p $barcode -g $clone_gene -l $clone/chunks.txt -s $store --build" || exit 1
+
+	# Filtering works on read numbers; only the sampled reads are written as FASTQ
+	$check -n filter-$name -i $input/PIPE/$barcode/$name.ids $store -p minlen=$minlen maxlen=$maxlen \
+		-o $input/PIPE/$barcode/$name-filtered.ids \
+		-c "python $run/NanoIgFilter.py --store $store -s $input/PIPE/$barcode/$name.ids -o $input/PIPE/$barcode/$name-filtered.ids -m $minlen -M $maxlen --log $input/PIPE/$barcode/$name-filter.log" || exit 1
+	$check -n sample-$name -i $input/PIPE/$barcode/$name-filtered.ids $store -p maxreads=$maxreads \
+		-o $input/PIPE/$barcode/$name-sampled.fastq \
+		-c "python $run/NanoIgSample.py --store $store -s $input/PIPE/$barcode/$name-filtered.ids -o $input/PIPE/$barcode/$name-sampled.fastq -n $maxreads --log $input/PIPE/$barcode/$name-sample.log" || exit 1
+fi
+
+model=r941_min_high_g303
+maskopts="--maxlen 50 --maxerror 0.5 --revmaxerror 0.7 --mode mask --pf VPRIMER --rpf JPRIMER"
+
+	for gene in $genes; do
 		name=$barcode-$gene
-		samtools view -h $input/PIPE/Clonality/$barcode/sample.sorted.bam chr14:$start-$end | cut -f1 | sort | uniq > $input/PIPE/$barcode/$name.txt
-		seqtk subseq $input/fastq/$barcode/total.fastq $input/PIPE/$barcode/$name.txt > $input/PIPE/$barcode/$name.fastq
-		$run/seqkit rmdup $input/PIPE/$barcode/$name.fastq -n -o $input/PIPE/$barcode/$name-clean.fastq -D $input/PIPE/$barcode/duplicates$j.txt
-		$run/seqkit seq -M 350 -g $input/PIPE/$barcode/$name-clean.fastq > $input/PIPE/$barcode/$name-filtered.fastq
-		$run/seqkit seq -m 200 -g $input/PIPE/$barcode/$name-filtered.fastq > $input/PIPE/$barcode/$name-filtered2.fastq
-		j=$(($j + 1))
+		asm=$input/PIPE/$barcode/Assembly-$name
 		cd $input/PIPE/$barcode/
-		error=0.2
-		test="0"
-
-		while [ "$test" -eq 0 ]; do
-			rm -rf $input/PIPE/$barcode/Assembly-$name/
-			error=$(echo $error + 0.2 | bc)
-			$run/canu-1.8/Linux-amd64/bin/canu -d Assembly-$name -p ighv  MhapMerSize=23 correctedErrorRate=$error minReadLength=200 minOverlapLength=100 genomeSize=1.0k rawErrorRate=0.5 -nanopore-raw $input/PIPE/$barcode/$name-filtered2.fastq
-			$run/canu-1.8/Linux-amd64/bin/canu -d Assembly-$name -p ighv  MhapMerSize=23 correctedErrorRate=$error minReadLength=200 minOverlapLength=100 genomeSize=1.0k rawErrorRate=0.5 -nanopore-raw $input/PIPE/$barcode/$name-filtered2.fastq
-			
-			test=$(wc -c < $input/PIPE/$barcode/Assembly-$name/ighv.contigs.fasta)
-		done
-		
-		cut -f1 -d"c" $input/PIPE/$barcode/Assembly-$name/ighv.contigs.fasta | $run/seqkit fx2tab | $run/csvtk mutate -H -t -f 1 -p "reads=(.+)" | awk -F "\t" '$4>20' | $run/seqkit tab2fx > $input/PIPE/$barcode/Assembly-$name/Filtered_contigs.fasta
-
-	
-		
-		$run/medaka_consensus -i $input/PIPE/$barcode/$name-filtered2.fastq -d $input/PIPE/$barcode/Assembly-$name/Filtered_contigs.fasta -o $input/PIPE/$barcode/Assembly-$name -t 1 -m r941_min_high_g303
-		python $run/MaskPrimers.py align -s $input/PIPE/$barcode/Assembly-$name/consensus.fasta -p $run/For_primers.fasta --maxlen 50 --maxerror 0.5 --mode mask --pf VPRIMER --outname Assembly-$name-FWD
-		python $run/MaskPrimers.py align -s $input/PIPE/$barcode/Assembly-$name/Assembly-$name-FWD_primers-pass.fasta -p $run/Rev_primer.fasta --maxlen 50 --maxerror 0.7 --mode mask --pf JPRIMER --revpr --skiprc --outname Assembly-$name-REV
-		sed 's/N//g' $input/PIPE/$barcode/Assembly-$name/Assembly-$name-REV_primers-pass.fasta | awk '/^[>;]/ { if (seq) { print seq }; seq=""; print } /^[^>;]/ { seq = seq $0 } END { print seq }' | sed "s/>/\>$name:/g" >> $input/Results.fasta
-	
+
+		draft="python $run/NanoIgAsm.py -s $input/PIPE/$barcode/$name-sampled.fastq -d $asm --canu $run/canu-1.8/Linux-amd64/bin/canu $canu_threads -j 2 && { cut -f1 -d\"c\" $asm/ighv.contigs.fasta | $run/seqkit fx2tab | $run/csvtk mutate -H -t -f 1 -p \"reads=(.+)\" | awk -F \"\t\" '\$4>20' | $run/seqkit tab2fx > $asm/Filtered_contigs.fasta; }"
+		if [ "$assembler" = fast ]; then
+			draft="python $run/NanoIgCons.py -s $input/PIPE/$barcode/$name-sampled.fastq -o $asm/Filtered_contigs.fasta --fwd $run/For_primers.fasta --rev $run/Rev_primer.fasta -m $minlen -M $maxlen || { $draft; }"
+		fi
+		$check -n draft-$name -i $input/PIPE/$barcode/$name-sampled.fastq $run/For_primers.fasta $run/Rev_primer.fasta -p assembler=$assembler minlen=$minlen maxlen=$maxlen \
+			-o $asm/Filtered_contigs.fasta -c "$draft" || { status=1; continue; }
+
+		# NanoIgPolish.py expects the reads and draft inputs in this order
+		if [ -n "$defer" ]; then
+			polishopts="--defer $asm/polish.json"
+		fi
+		$check -n polish-$name -i $input/PIPE/$barcode/$name-sampled.fastq $asm/Filtered_contigs.fasta -p model=$model \
+			-o $asm/consensus.fasta $polishopts \
+			-c "$run/medaka_consensus -i $input/PIPE/$barcode/$name-sampled.fastq -d $asm/Filtered_contigs.fasta -o $asm -t $medaka_threads -m $model" || { status=1; continue; }
+		if [ -n "$defer" ] && [ -e $asm/polish.json ]; then
+			continue
+		fi
+		$check -n mask-$name -i $asm/consensus.fasta $run/For_primers.fasta $run/Rev_primer.fasta -p "mask=$maskopts" \
+			-o $asm/Results.fasta \
+			-c "$mask -s $asm/consensus.fasta -p $run/For_primers.fasta -r $run/Rev_primer.fasta $maskopts --stdout --prefix $name > $asm/Results.fasta" || { status=1; continue; }
+		if [ ! -s $asm/consensus.fasta ]; then
+			status=1
+		elif [ -z "$clone_gene" ]; then
+			cat $asm/Results.fasta >> $input/PIPE/$barcode/Results.fasta
+		fi
+
 	done
 
+exit $status
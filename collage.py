@@ -1,61 +1,139 @@
 #!/usr/bin/python
+"""
+Draws the clonality bar chart of every barcode into one fixed tile grid image
+"""
 
-import sys
-import math
+# Imports
 import os
-import matplotlib
-matplotlib.use('pdf')
-import matplotlib.pyplot as plt
-
-path = sys.argv[1]
-
-# Config:
-images_dir = path+'/PIPE/Clonality'
-result_grid_filename = path + '/PIPE/Clonality/grid.jpg'
-result_figsize_resolution = 50
-
-images_list =[]
-
-for i in os.listdir(images_dir):
-    images_list.append(images_dir+'/'+i+'/barchart.'+i+'.png')
-
-images_list.sort()
-
-print(images_list)
-
-images_count = len(images_list)
-print('Images: ', images_list)
-print('Images count: ', images_count)
-
-# Calculate the grid size:
-grid_size = int(math.ceil(float(images_count)/4.0))
-grid_cells=grid_size * 4
-empty_cells=grid_cells-images_count
-
-
-# Create plt plot:
-fig, axes = plt.subplots(grid_size, 4, figsize=(result_figsize_resolution, result_figsize_resolution), squeeze=False)
-
-current_file_number = 0
-for image_filename in images_list:
-    x_position = current_file_number % 4
-    y_position = current_file_number // 4
-    plt_image = plt.imread(image_filename)
-    if grid_size>1:
-        axes[y_position, x_position].imshow(plt_image)
-        axes[y_position, x_position].axis('off')
-    else:
-        axes[0, x_position].imshow(plt_image)
-        axes[0, x_position].axis('off')
-        
-    print((current_file_number + 1), '/', images_count, ': ', image_filename)
-    current_file_number += 1
-
-empty_x=range((grid_cells-1), (images_count-1), -1)
-
-for i in empty_x:
-    fig.delaxes(axes[images_count // 4][i % 4])
-
-
-plt.subplots_adjust(left=0.0, right=1.0, bottom=0.0, top=1.0, wspace=None, hspace=None)
-plt.savefig(result_grid_filename)
+import sys
+from argparse import ArgumentParser
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.image import imsave
+
+# NanoIg imports
+from NanoIgProf import profileProcess
+
+
+def readCandidates(bed_file):
+    """
+    Reads the gene depths of a Clonal_candidate.bed or coverage.bed file
+
+    Arguments:
+      bed_file : NanoIgCov.py output; the gene name is the fourth column and
+                 the read count the last one.
+
+    Returns:
+      list: (gene name, depth) tuples in file order; empty if the file is missing.
+    """
+    genes = []
+    if not os.path.exists(bed_file):
+        return genes
+    with open(bed_file) as f:
+        for line in f:
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) >= 5:
+                genes.append((fields[3].strip(), int(fields[-1])))
+
+    return genes
+
+
+def drawTile(canvas, ax, barcode, genes):
+    """
+    Draws the bar chart of a barcode on a reused figure
+
+    Arguments:
+      canvas : FigureCanvasAgg of the tile figure.
+      ax : axes of the tile figure.
+      barcode : barcode name, used as title.
+      genes : list of (gene name, depth) tuples.
+
+    Returns:
+      numpy.ndarray: the RGB pixels of the tile.
+    """
+    ax.clear()
+    ax.bar(range(len(genes)), [d for g, d in genes], width=0.3)
+    ax.set_xticks(range(len(genes)))
+    ax.set_xticklabels([g for g, d in genes], fontsize=8)
+    ax.set_xlim(-0.5, max(len(genes), 1) - 0.5)
+    if not genes:
+        ax.set_ylim(0, 1)
+    ax.set_title(barcode, fontsize=12)
+    ax.set_ylabel('Depth of Coverage')
+    canvas.draw()
+
+    return np.asarray(canvas.buffer_rgba())[:, :, :3]
+
+
+def renderGrid(clonality_dir, out_file, bed_name='Clonal_candidate.bed', columns=4,
+               tile_width=480, tile_height=360, dpi=100):
+    """
+    Renders the bar charts of all barcodes into one grid image
+
+    A single figure of the tile size is redrawn for every barcode and its
+    pixels are copied into the grid, so memory depends on the grid size only.
+
+    Arguments:
+      clonality_dir : PIPE/Clonality folder holding one folder per barcode.
+      out_file : output image, e.g. grid.jpg.
+      bed_name : per barcode file to plot, Clonal_candidate.bed or coverage.bed.
+      columns : tiles per grid row.
+      tile_width : tile width in pixels.
+      tile_height : tile height in pixels.
+      dpi : tile resolution, which scales the text relative to the tile.
+
+    Returns:
+      list: the barcodes drawn, in grid order.
+    """
+    barcodes = sorted(d for d in os.listdir(clonality_dir) if os.path.isdir(os.path.join(clonality_dir, d)))
+    rows = max(1, -(-len(barcodes) // columns))
+    grid = np.full((rows * tile_height, columns * tile_width, 3), 255, dtype=np.uint8)
+
+    fig = Figure(figsize=(tile_width / dpi, tile_height / dpi), dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    fig.subplots_adjust(left=0.18, right=0.97, bottom=0.15, top=0.9)
+    for k, barcode in enumerate(barcodes):
+        genes = readCandidates(os.path.join(clonality_dir, barcode, bed_name))
+        y, x = (k // columns) * tile_height, (k % columns) * tile_width
+        grid[y:y + tile_height, x:x + tile_width] = drawTile(canvas, ax, barcode, genes)
+        print('%i/%i> %s %i genes' % (k + 1, len(barcodes), barcode, len(genes)))
+
+    imsave(out_file, grid)
+
+    return barcodes
+
+
+def getArgParser():
+    """
+    Defines the ArgumentParser
+
+    Returns:
+      argparse.ArgumentParser: argument parser object.
+    """
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('input', help='Data folder containing the PIPE/Clonality folder.')
+    parser.add_argument('--bed', action='store', dest='bed_name', default='Clonal_candidate.bed',
+                        help='Per barcode file to plot; coverage.bed plots every VH gene.')
+    parser.add_argument('--columns', action='store', dest='columns', type=int, default=4,
+                        help='Tiles per grid row.')
+    parser.add_argument('--tile', nargs=2, action='store', dest='tile_size', type=int, default=[480, 360],
+                        metavar=('WIDTH', 'HEIGHT'), help='Tile size in pixels.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    """
+    Parses command line arguments and writes PIPE/Clonality/grid.jpg
+    """
+    args = getArgParser().parse_args()
+    telemetry = profileProcess('collage')
+    clonality_dir = os.path.join(args.input, 'PIPE', 'Clonality')
+
+    barcodes = renderGrid(clonality_dir, os.path.join(clonality_dir, 'grid.jpg'), bed_name=args.bed_name,
+                          columns=args.columns, tile_width=args.tile_size[0], tile_height=args.tile_size[1])
+    telemetry['counts'] = {'BARCODES': len(barcodes)}
+    sys.stderr.write('BARCODES> %i\n' % len(barcodes))
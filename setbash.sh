@@ -7,10 +7,9 @@ sudo apt-get install -y seqtk
 sudo apt install samtools
 sudo apt install bedtools
 sudo apt install python3-pip
-sudo apt install gnuplot
 pip3 install setuptools
 pip3 install biopython==1.75
 pip3 install presto
-pip3 install selenium
 pip3 install python-docx
 pip3 install matplotlib
+pip3 install numpy
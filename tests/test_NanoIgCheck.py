@@ -0,0 +1,126 @@
+"""
+Stage checkpoints: skipping current stages and running stale ones again
+"""
+
+# Imports
+import json
+import os
+
+# NanoIg imports
+from NanoIgCheck import recordStage, runStage, stageCurrent
+
+
+def write(name, text):
+    with open(name, 'w') as f:
+        f.write(text)
+
+
+def read(name):
+    with open(name) as f:
+        return f.read()
+
+
+class Stage:
+    """
+    A stage copying an input file to an output file and counting its runs
+    """
+    def __init__(self, folder):
+        self.check_dir = str(folder / 'checkpoints')
+        self.input, self.output = str(folder / 'in.txt'), str(folder / 'out.txt')
+        self.runs = str(folder / 'runs.txt')
+        write(self.input, 'ACGT\n')
+
+    def run(self, params=('k=1',), command=None):
+        command = command or 'cp %s %s && echo >> %s' % (self.input, self.output, self.runs)
+        return runStage(self.check_dir, 'copy', command, inputs=[self.input], params=list(params),
+                        outputs=[self.output])
+
+    def count(self):
+        return len(read(self.runs)) if os.path.exists(self.runs) else 0
+
+
+def test_skip(tmp_path):
+    stage = Stage(tmp_path)
+    assert stage.run() == (0, True)
+    assert stage.run() == (0, False)
+    assert stage.count() == 1
+    assert read(stage.output) == 'ACGT\n'
+
+
+def test_input_changed(tmp_path):
+    stage = Stage(tmp_path)
+    stage.run()
+    write(stage.input, 'ACGTACGT\n')
+    assert stage.run() == (0, True)
+    assert read(stage.output) == 'ACGTACGT\n'
+    assert stage.run() == (0, False)
+
+
+def test_params_changed(tmp_path):
+    stage = Stage(tmp_path)
+    stage.run()
+    assert stage.run(params=('k=2',)) == (0, True)
+    assert stage.run(params=('k=2',)) == (0, False)
+    assert stage.run() == (0, True)
+
+
+def test_output_changed(tmp_path):
+    stage = Stage(tmp_path)
+    stage.run()
+    write(stage.output, 'edited by hand\n')
+    assert stage.run() == (0, True)
+    assert read(stage.output) == 'ACGT\n'
+    os.remove(stage.output)
+    assert stage.run() == (0, True)
+    assert stage.count() == 3
+
+
+def test_failure(tmp_path):
+    stage = Stage(tmp_path)
+    stage.run()
+    write(stage.input, 'TTTTT\n')
+    status, ran = stage.run(command='echo partial > %s; exit 3' % stage.output)
+    assert (status, ran) == (3, True)
+    assert not os.path.exists(os.path.join(stage.check_dir, 'copy.json'))
+    # The stale output was removed before the failed run, which left its own partial output
+    assert read(stage.output) == 'partial\n'
+    assert stage.run() == (0, True)
+    assert read(stage.output) == 'TTTTT\n'
+
+
+def test_failure_removes_stale_outputs(tmp_path):
+    stage = Stage(tmp_path)
+    stage.run()
+    write(stage.input, 'TTTTT\n')
+    assert stage.run(command='exit 1') == (1, True)
+    assert not os.path.exists(stage.output)
+
+
+def test_defer(tmp_path):
+    stage = Stage(tmp_path)
+    defer_file = str(tmp_path / 'job.json')
+    command = 'cp %s %s' % (stage.input, stage.output)
+    assert runStage(stage.check_dir, 'copy', command, inputs=[stage.input], outputs=[stage.output],
+                    defer_file=defer_file) == (0, False)
+    with open(defer_file) as f:
+        job = json.load(f)
+    assert job['command'] == command and job['outputs'] == [stage.output]
+    assert not os.path.exists(stage.output)
+
+    # A batch runner runs the deferred stage; the next pass finds it current and drops the job file
+    assert runStage(job['check_dir'], job['name'], job['command'], inputs=job['inputs'], params=job['params'],
+                    outputs=job['outputs']) == (0, True)
+    assert runStage(stage.check_dir, 'copy', command, inputs=[stage.input], outputs=[stage.output],
+                    defer_file=defer_file) == (0, False)
+    assert not os.path.exists(defer_file)
+
+
+def test_record_in_process(tmp_path):
+    stage = Stage(tmp_path)
+    assert not stageCurrent(stage.check_dir, 'copy', inputs=[stage.input], params=['k=1'], outputs=[stage.output])
+    write(stage.output, read(stage.input))
+    recordStage(stage.check_dir, 'copy', inputs=[stage.input], params=['k=1'], outputs=[stage.output])
+    assert stageCurrent(stage.check_dir, 'copy', inputs=[stage.input], params=['k=1'], outputs=[stage.output])
+    assert stage.run() == (0, False)
+    write(stage.input, 'ACGTACGT\n')
+    assert not stageCurrent(stage.check_dir, 'copy', inputs=[stage.input], params=['k=1'], outputs=[stage.output])
@@ -0,0 +1,107 @@
+"""
+Duplicate and length filtering, in memory and through the spill partitions
+"""
+
+# Imports
+import os
+import random
+from collections import OrderedDict
+
+# NanoIg imports
+from NanoIgFilter import NameSet, filterIds, filterReads, nameHash
+from NanoIgStore import ReadStore, StoreWriter
+
+
+def makeReads(n=6000, seed=1):
+    """
+    Returns reads with duplicate names spread over the whole input, lengths 1 to 60
+    """
+    rng = random.Random(seed)
+    reads = []
+    for i in range(n):
+        name = 'read%i' % (rng.randrange(i) if i and rng.random() < 0.2 else i)
+        length = rng.randint(1, 60)
+        reads.append(('%s ordinal=%i' % (name, i), 'A' * length, 'I' * length))
+    return reads
+
+
+def expected(reads, min_len=0, max_len=None):
+    seen, kept = set(), []
+    for header, seq, qual in reads:
+        name = header.split()[0]
+        if name in seen:
+            continue
+        seen.add(name)
+        if len(seq) >= min_len and (max_len is None or len(seq) <= max_len):
+            kept.append((header, seq, qual))
+    return kept
+
+
+def test_name_set_cap():
+    names = NameSet(max_bytes=1, capacity=8)
+    added = [names.add(nameHash('read%i' % i)) for i in range(8)]
+    assert added == [True] * 4 + [False] * 4
+    assert all(nameHash('read%i' % i) in names for i in range(4))
+    assert nameHash('read4') not in names
+
+
+def test_name_set_grow():
+    names = NameSet(capacity=8)
+    for i in range(1000):
+        assert names.add(nameHash('read%i' % i))
+    assert names.size == 1000
+    assert all(nameHash('read%i' % i) in names for i in range(1000))
+
+
+def test_in_memory():
+    reads = makeReads()
+    stats = OrderedDict()
+    assert list(filterReads(reads, min_len=10, max_len=50, stats=stats)) == expected(reads, 10, 50)
+    assert stats['SPILLED'] == 0
+    assert stats['IN'] == len(reads)
+    assert stats['DUPLICATE'] + stats['LONG'] + stats['SHORT'] + stats['OUT'] == len(reads)
+
+
+def test_spill_order(tmp_path):
+    # The smallest name set holds 2048 names, so the later reads are spilled
+    reads = makeReads()
+    stats = OrderedDict()
+    kept = list(filterReads(reads, min_len=10, max_len=50, max_mem=1, tmp_dir=str(tmp_path), parts=4,
+                            stats=stats))
+    assert kept == expected(reads, 10, 50)
+    assert stats['SPILLED'] > 0
+    assert stats['DUPLICATE'] + stats['LONG'] + stats['SHORT'] + stats['OUT'] == len(reads)
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_spill_matches_memory(tmp_path):
+    reads = makeReads(seed=2)
+    memory, spilled = OrderedDict(), OrderedDict()
+    in_memory = list(filterReads(reads, stats=memory))
+    assert list(filterReads(reads, max_mem=1, tmp_dir=str(tmp_path), stats=spilled)) == in_memory
+    assert {k: v for k, v in spilled.items() if k != 'SPILLED'} == \
+        {k: v for k, v in memory.items() if k != 'SPILLED'}
+
+
+def test_spill_cleanup_on_close(tmp_path):
+    kept = filterReads(makeReads(), max_mem=1, tmp_dir=str(tmp_path))
+    for record in kept:
+        pass
+    assert os.listdir(str(tmp_path)) == []
+    partial = filterReads(makeReads(), max_mem=1, tmp_dir=str(tmp_path))
+    for i, record in zip(range(3000), partial):
+        pass
+    partial.close()
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_filter_ids(tmp_path):
+    reads = makeReads(n=500)
+    writer = StoreWriter(str(tmp_path / 'reads.store'))
+    for record in reads:
+        writer.add(record)
+    writer.close()
+    ordinals = list(range(len(reads) - 1, -1, -1))
+    with ReadStore(str(tmp_path / 'reads.store')) as store:
+        kept = [store.record(i) for i in filterIds(store, ordinals, min_len=10, max_len=50)]
+    assert kept == expected([reads[i] for i in ordinals], 10, 50)
@@ -0,0 +1,67 @@
+"""
+Round trip of reads through the 2-bit packed read store
+"""
+
+# Imports
+import pytest
+
+# NanoIg imports
+from NanoIgStore import ReadStore, StoreWriter, packSequence, readIds, unpackSequence, writeIds
+
+records = [('read1 runid=1 ch=7', 'ACGTACGTTGCA', '!#%&()*+,-./'),
+           ('read2', 'ACGNNTTGCAN', 'IIIIIIIIIII'),
+           ('read3', 'acgtACGTnacg', '555555555555'),
+           ('read4', '', ''),
+           ('read5 after the empty read', 'GATTACA', '???????'),
+           ('read6', 'NNNN', '!!!!'),
+           ('read7', 'ACGTRYKMacgt', 'ABCDEFGHIJKL')]
+
+
+@pytest.fixture
+def store(tmp_path):
+    writer = StoreWriter(str(tmp_path / 'reads.store'))
+    numbers = [writer.add(r) for r in records]
+    writer.close()
+    assert numbers == list(range(len(records)))
+    with ReadStore(str(tmp_path / 'reads.store')) as store:
+        yield store
+
+
+@pytest.mark.parametrize('seq', ['', 'A', 'ACG', 'ACGT', 'ACGTA', 'TTTTGGGGCCCCAAAAT'])
+def test_pack_lengths(seq):
+    packed, other = packSequence(seq)
+    assert len(packed) == (len(seq) + 3) // 4
+    assert other == []
+    assert unpackSequence(packed, len(seq)) == seq
+
+
+def test_pack_other_bases():
+    packed, other = packSequence('ACnGN')
+    assert other == [(2, 'n'), (4, 'N')]
+    assert unpackSequence(packed, 5) == 'ACAGA'
+
+
+def test_round_trip(store):
+    assert len(store) == len(records)
+    for i, (header, seq, qual) in enumerate(records):
+        assert store.record(i) == (header, seq, qual)
+        assert store.length(i) == len(seq)
+        assert store.name(i) == header.split()[0]
+
+
+def test_records_order(store):
+    assert list(store.records([6, 3, 0, 3])) == [records[6], records[3], records[0], records[3]]
+    assert list(store.records()) == records
+
+
+def test_empty_store(tmp_path):
+    StoreWriter(str(tmp_path / 'empty.store')).close()
+    with ReadStore(str(tmp_path / 'empty.store')) as store:
+        assert len(store) == 0
+        assert list(store.records()) == []
+
+
+def test_ids(tmp_path):
+    id_file = str(tmp_path / 'reads.ids')
+    assert writeIds(id_file, iter([5, 0, 12])) == 3
+    assert readIds(id_file) == [5, 0, 12]